@@ -0,0 +1,133 @@
+import argparse
+import time
+
+import numpy as np
+from scipy.spatial.transform import Rotation as R
+
+from mcr_sim import mcr_emns, mcr_magnet
+
+# run in terminal from the python directory:
+# python3 benchmark_mag_controller.py --backend numpy
+
+# Calibration file for eMNS
+cal_path = '../calib/Navion_2_Calibration_24-02-2020.yaml'
+
+# Parameter magnet
+magnet = mcr_magnet.Magnet(
+    length=4e-3,
+    outer_diam=1.33e-3,
+    inner_diam=0.86e-3,
+    remanence=1.45)
+
+T_sim_mns = [0., 0., 0., 0., 0., 0., 1.]
+field_des = np.array([0.01, 0.01, 0.])
+
+
+def step_per_magnet(e_mns, positions, index_mag, forces):
+    '''
+    Per-magnet loop of the original MagController: two model evaluations,
+    a Rotation and small arrays per magnet, row by row force write-back.
+    '''
+
+    num_nodes = len(positions)
+
+    for i in range(0, len(index_mag)):
+        pos = positions[num_nodes-index_mag[i]-1]
+
+        actualPos = np.array(pos[0:3]) + np.array(T_sim_mns[0:3])
+        currents = e_mns.field_to_currents(
+            field=field_des, position=actualPos)
+        field = e_mns.currents_to_field(
+            currents=currents, position=actualPos)
+
+        B = np.array(field)*magnet.dipole_moment
+
+        r = R.from_quat(pos[3:7])
+        X = r.apply([1., 0., 0.])
+        T = np.cross(X, B)
+
+        forces[index_mag[i]][:] = [0, 0, 0, T[0], T[1], T[2]]
+
+
+def step_vectorized(e_mns, positions, index_mag, forces):
+    '''
+    Single vectorized pass of the current MagController, which also
+    computes the gradient forces.
+    '''
+
+    num_nodes = len(positions)
+    poses = positions[num_nodes-index_mag-1]
+    magnet_table = magnet_tables[len(index_mag)]
+
+    actualPos = poses[:, 0:3] + np.array(T_sim_mns[0:3])
+    actuation_matrices, currents, bg = e_mns.field_gradient_to_currents_batch(
+        fields=field_des, positions=actualPos)
+
+    forces[index_mag] = mcr_magnet.magnetic_wrenches(
+        poses, bg, magnet_table.moments)
+
+
+def random_poses(num_nodes, rng):
+    ''' Random node poses in the workspace [x, y, z, qx, qy, qz, qw]. '''
+
+    positions = rng.uniform(-0.05, 0.05, size=(num_nodes, 3))
+    quats = R.random(num_nodes, random_state=rng.integers(1e9)).as_quat()
+
+    return np.hstack((positions, quats))
+
+
+def time_step(step, e_mns, positions, index_mag, forces, repeat):
+    ''' Return the median time of a controller step (s). '''
+
+    times = np.empty(repeat)
+    for i in range(repeat):
+        start = time.perf_counter()
+        step(e_mns, positions, index_mag, forces)
+        times[i] = time.perf_counter() - start
+
+    return np.median(times)
+
+
+if __name__ == '__main__':
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        '--backend', default='mag_manip',
+        help='eMNS forward model, mag_manip or numpy')
+    ap.add_argument(
+        '--num-mag', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32, 64],
+        help='number of magnetic nodes')
+    ap.add_argument('--repeat', type=int, default=200)
+    args = ap.parse_args()
+
+    e_mns = mcr_emns.EMNS(
+        name='Navion',
+        calibration_path=cal_path,
+        backend=args.backend)
+
+    rng = np.random.default_rng(0)
+
+    magnet_tables = {
+        num_mag: mcr_magnet.MagnetTable([magnet]*num_mag)
+        for num_mag in args.num_mag}
+
+    print('num_mag   per_magnet (us)   vectorized (us)   speedup')
+    for num_mag in args.num_mag:
+        num_nodes = num_mag + 30
+        positions = random_poses(num_nodes, rng)
+        index_mag = np.arange(num_mag)
+
+        forces_loop = np.zeros((num_nodes, 6))
+        forces_vec = np.zeros((num_nodes, 6))
+
+        t_loop = time_step(
+            step_per_magnet, e_mns, positions, index_mag, forces_loop,
+            args.repeat)
+        t_vec = time_step(
+            step_vectorized, e_mns, positions, index_mag, forces_vec,
+            args.repeat)
+
+        assert np.allclose(forces_loop[:, 3:6], forces_vec[:, 3:6])
+
+        print('{:7d}   {:15.1f}   {:15.1f}   {:7.1f}'.format(
+            num_mag, 1e6*t_loop, 1e6*t_vec, t_loop/t_vec))
@@ -0,0 +1,298 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from mcr_sim import mcr_collision, mcr_scene
+
+# Benchmark the throughput of the flat model and aortic arch scenes while
+# varying one parameter at a time around the default scene. Run in terminal
+# from the python directory:
+# python3 benchmark_scenes.py run results.json
+# python3 benchmark_scenes.py compare baseline.json results.json
+# The collision profiles are compared in the contact-heavy aortic arch with:
+# python3 benchmark_scenes.py run collision.json --scenes aortic_arch \
+#     --axes collision_profile proximity collision_culling collision_groups
+
+scenes = {
+    'flat': mcr_scene.flat_params,
+    'aortic_arch': mcr_scene.aortic_arch_params,
+    }
+
+# values of each parameter, the first one is the default of the benchmark
+axes = {
+    'num_elem_body': [30, 15, 60],
+    'num_elem_tip': [3, 6],
+    'nume_nodes_viz': [600, 300, 1200],
+    'num_magnets': [2, 1, 3],
+    'gradient_force': [False, True],
+    'solver_profile': ['accurate', 'interactive', 'batch', 'adaptive'],
+    'lcp_tolerance': [None, 1e-4, 1e-8],
+    'collision_triangles': [None, 1000, 500, 250],
+    'collision_profile': [
+        'brute_force', 'bvh_narrow', 'sap', 'incremental_sap', 'parallel_bvh'],
+    'proximity': ['fixed', 'radius'],
+    'collision_culling': [False, True],
+    'collision_groups': [1, 8],
+    'adaptive_dt': [False, True],
+    'pipelined': [False, True],
+    }
+
+
+def cases(scene_names, axis_names):
+    '''
+    Return the benchmark cases: the default of each scene and the cases
+    varying one parameter.
+
+    :rtype: list[dict]
+    '''
+
+    cases = []
+    for scene in scene_names:
+        default = {axis: values[0] for axis, values in axes.items()}
+        cases.append({'name': scene + '/default', 'scene': scene,
+                      'params': default})
+        for axis in axis_names:
+            for value in axes[axis][1:]:
+                params = dict(default)
+                params[axis] = value
+                cases.append({
+                    'name': '{:s}/{:s}={}'.format(scene, axis, value),
+                    'scene': scene,
+                    'params': params})
+
+    return cases
+
+
+def scene_params(case, visual):
+    ''' Translate the parameters of a case to build_scene parameters. '''
+
+    params = scenes[case['scene']]()
+    params.update(case['params'])
+    params['visual'] = visual
+
+    # the groups of the collision mesh are only culled with the culling
+    if params['collision_groups'] > 1:
+        params['collision_culling'] = True
+
+    num_magnets = params.pop('num_magnets')
+    if num_magnets > params['num_elem_tip']:
+        raise ValueError('More magnets than tip elements')
+    params['magnet_index'] = list(range(num_magnets))
+
+    return params
+
+
+def run_case(case, steps, visual):
+    '''
+    Build a scene, insert the instrument and time a number of steps. Runs
+    in a fresh process, so that the memory high-water mark is the one of
+    this scene.
+
+    :rtype: dict
+    '''
+
+    import Sofa.Simulation
+    from mcr_sim import run
+
+    params = scene_params(case, visual)
+
+    root_node = run.create_root()
+    build_start = time.perf_counter()
+    scene = mcr_scene.build_scene(root_node, **params)
+    listeners = mcr_collision.add_contact_listeners(
+        root_node, scene.instrument, scene.environment)
+    run.init(root_node)
+    build_time = time.perf_counter() - build_start
+
+    # insertion, not timed, the time step may change between steps
+    while not scene.insert(root_node.dt.value):
+        Sofa.Simulation.animate(root_node, root_node.dt.value)
+
+    iterations = np.full(steps, np.nan)
+    residuals = np.full(steps, np.nan)
+    contacts = np.zeros(steps)
+    scene.mag_controller.reset_timing()
+    sim_start = root_node.time.value
+    start = time.perf_counter()
+    for i in range(steps):
+        Sofa.Simulation.animate(root_node, root_node.dt.value)
+        value = scene.simulator.constraint_iterations()
+        if value is not None:
+            iterations[i] = value
+        value = scene.simulator.constraint_residual()
+        if value is not None:
+            residuals[i] = value
+        contacts[i] = mcr_collision.count_contacts(listeners)
+    wall_time = time.perf_counter() - start
+    sim_time = root_node.time.value - sim_start
+
+    # fraction of the worker time of the pipelined controller hidden behind
+    # the timed SOFA steps
+    overlap = None
+    if params['pipelined']:
+        overlap = scene.mag_controller.timing_summary()['overlap']
+
+    scene.mag_controller.shutdown()
+    Sofa.Simulation.unload(root_node)
+
+    # kilobytes on Linux, bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        max_rss *= 1024
+
+    return {
+        'build_time': build_time,
+        'steps_per_s': steps/wall_time,
+        'real_time_factor': sim_time/wall_time,
+        'max_rss_mb': max_rss/2**20,
+        'lcp_iterations_mean': (
+            None if np.all(np.isnan(iterations))
+            else float(np.nanmean(iterations))),
+        'lcp_iterations_max': (
+            None if np.all(np.isnan(iterations))
+            else float(np.nanmax(iterations))),
+        'lcp_residual_max': (
+            None if np.all(np.isnan(residuals))
+            else float(np.nanmax(residuals))),
+        'lcp_capped_steps': int(np.sum(
+            iterations >= scene.simulator.max_iterations)),
+        'contacts_mean': float(np.mean(contacts)),
+        'pipeline_overlap': overlap,
+        }
+
+
+def metadata():
+    ''' Describe the machine and the code of a benchmark run. '''
+
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], text=True,
+            stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        }
+
+
+def run_benchmark(args):
+
+    selected = cases(args.scenes, args.axes)
+    results = {
+        'meta': metadata(),
+        'settings': {'steps': args.steps, 'repeat': args.repeat,
+                     'visual': not args.no_visual},
+        'cases': [],
+        }
+
+    # one process per run, started fresh so that runs do not share state
+    context = multiprocessing.get_context('spawn')
+    for case in selected:
+        runs = []
+        for i in range(args.repeat):
+            with context.Pool(1, maxtasksperchild=1) as pool:
+                runs.append(pool.apply(
+                    run_case, (case, args.steps, not args.no_visual)))
+
+        # the median run by throughput is reported
+        runs.sort(key=lambda run: run['steps_per_s'])
+        result = dict(case)
+        result.update(runs[len(runs)//2])
+        results['cases'].append(result)
+
+        print('{:45s} {:8.1f} steps/s {:8.1f} MB {:6.1f} contacts{:s}'.format(
+            case['name'], result['steps_per_s'], result['max_rss_mb'],
+            result['contacts_mean'],
+            '' if result['pipeline_overlap'] is None
+            else ' {:4.2f} overlap'.format(result['pipeline_overlap'])))
+
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def compare(args):
+    '''
+    Flag the cases that are slower or use more memory in the new results
+    than in the baseline by more than the threshold.
+    '''
+
+    with open(args.baseline, 'r') as f:
+        baseline = {case['name']: case for case in json.load(f)['cases']}
+    with open(args.results, 'r') as f:
+        results = json.load(f)['cases']
+
+    regressions = 0
+    print('{:45s} {:>10s} {:>10s} {:>8s} {:>8s}'.format(
+        'case', 'base st/s', 'new st/s', 'speed', 'memory'))
+    for case in results:
+        base = baseline.get(case['name'])
+        if base is None:
+            continue
+
+        speed = case['steps_per_s']/base['steps_per_s']
+        memory = case['max_rss_mb']/base['max_rss_mb']
+        flag = ''
+        if speed < 1. - args.threshold or memory > 1. + args.threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+
+        print('{:45s} {:10.1f} {:10.1f} {:8.2f} {:8.2f}{:s}'.format(
+            case['name'], base['steps_per_s'], case['steps_per_s'],
+            speed, memory, flag))
+
+    if regressions:
+        print('{:d} regression(s)'.format(regressions))
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+
+    ap = argparse.ArgumentParser()
+    subparsers = ap.add_subparsers(dest='command', required=True)
+
+    ap_run = subparsers.add_parser('run', help='run the benchmark')
+    ap_run.add_argument('output', help='results file (.json)')
+    ap_run.add_argument(
+        '--scenes', nargs='+', default=list(scenes), choices=list(scenes))
+    ap_run.add_argument(
+        '--axes', nargs='*', default=list(axes), choices=list(axes),
+        help='parameters varied around the default scene')
+    ap_run.add_argument(
+        '--steps', type=int, default=500,
+        help='number of timed steps after the insertion')
+    ap_run.add_argument(
+        '--repeat', type=int, default=3,
+        help='number of runs per case, the median is reported')
+    ap_run.add_argument(
+        '--no-visual', action='store_true',
+        help='build the scenes without visual models')
+
+    ap_compare = subparsers.add_parser(
+        'compare', help='compare two results files')
+    ap_compare.add_argument('baseline')
+    ap_compare.add_argument('results')
+    ap_compare.add_argument(
+        '--threshold', type=float, default=0.1,
+        help='relative change flagged as a regression')
+
+    args = ap.parse_args()
+
+    if args.command == 'run':
+        run_benchmark(args)
+    else:
+        compare(args)
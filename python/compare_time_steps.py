@@ -0,0 +1,78 @@
+import argparse
+import json
+import time
+
+from mcr_sim import mcr_command_player
+from replay_tip_pose import replay
+
+# Compare the fixed and adaptive time steps on a replayed experiment of
+# data/01_tip_pose against a reference with a small fixed time step: number
+# of steps, wall time and tip distance to the reference. Run in terminal from
+# the python directory:
+# python3 compare_time_steps.py ../data/01_tip_pose/21_rod_sim_tip_topic_9976/tip_pose_9976_2022-02-15-17-31-18.csv
+
+
+def compare(recording, dt_ref=0.001, dt=0.01, dt_min=0.001, dt_max=0.02):
+    '''
+    Replay a recording with the reference time step, the fixed time step
+    dt and the adaptive time step.
+
+    :return: The number of steps, the wall time (s) and the RMS and maximal
+        tip distance to the reference (m) of each run
+    :rtype: dict
+    '''
+
+    runs = {
+        'reference': {'dt': dt_ref},
+        'fixed': {'dt': dt},
+        'adaptive': {
+            'dt': dt, 'adaptive_dt': True, 'dt_min': dt_min,
+            'dt_max': dt_max},
+        }
+
+    trajectories = {}
+    results = {}
+    for name, kwargs in runs.items():
+        start = time.perf_counter()
+        sim_time, poses, _ = replay(recording, **kwargs)
+        trajectories[name] = (sim_time, poses[:, 0:3])
+        results[name] = {
+            'steps': len(sim_time),
+            'wall_time': time.perf_counter() - start,
+            }
+
+    time_ref, positions_ref = trajectories['reference']
+    for name, (sim_time, positions) in trajectories.items():
+        rms, max_error = mcr_command_player.tracking_error(
+            sim_time, positions, time_ref, positions_ref)
+        results[name].update({'rms_error': rms, 'max_error': max_error})
+
+    return results
+
+
+if __name__ == '__main__':
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument('recording', help='tip pose topic CSV of data/01_tip_pose')
+    ap.add_argument('--dt-ref', type=float, default=0.001,
+                    help='time step of the reference (s)')
+    ap.add_argument('--dt', type=float, default=0.01,
+                    help='fixed time step, initial adaptive time step (s)')
+    ap.add_argument('--dt-min', type=float, default=0.001)
+    ap.add_argument('--dt-max', type=float, default=0.02)
+    ap.add_argument('--output', help='store the results in a .json file')
+    args = ap.parse_args()
+
+    results = compare(
+        args.recording, args.dt_ref, args.dt, args.dt_min, args.dt_max)
+
+    print('{:10s} {:>8s} {:>10s} {:>10s} {:>10s}'.format(
+        'run', 'steps', 'wall (s)', 'rms (mm)', 'max (mm)'))
+    for name, result in results.items():
+        print('{:10s} {:8d} {:10.2f} {:10.2f} {:10.2f}'.format(
+            name, result['steps'], result['wall_time'],
+            1e3*result['rms_error'], 1e3*result['max_error']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -27,6 +27,9 @@ magnet_id = 0.86e-3         # (m)
 magnet_od = 1.33e-3         # (m)
 magnet_remanence = 1.45     # (T)
 
+# Build the visual models, set to False for headless batch runs
+visual = True
+
 # Parameter for beams
 nume_nodes_viz = 600
 num_elem_body = 30
@@ -78,7 +81,8 @@ def createScene(root_node):
 
     # simulator
     simulator = mcr_simulator.Simulator(
-        root_node=root_node)
+        root_node=root_node,
+        visual=visual)
 
     # eMNS
     navion = mcr_emns.EMNS(
@@ -92,7 +96,8 @@ def createScene(root_node):
         name='aortic_arch',
         T_env_sim=T_env_sim,
         flip_normals=True,
-        color=[1., 0., 0., 0.3])
+        color=[1., 0., 0., 0.3],
+        visual=visual)
 
     # magnet
     magnet = mcr_magnet.Magnet(
@@ -121,7 +126,8 @@ def createScene(root_node):
         num_elem_tip=num_elem_tip,
         nume_nodes_viz=nume_nodes_viz,
         T_start_sim=T_start_sim,
-        color=[.2, .8, 1., 1.]
+        color=[.2, .8, 1., 1.],
+        visual=visual
         )
 
     # sofa-based controller
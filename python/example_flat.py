@@ -32,6 +32,9 @@ magnet_id = 0.86e-3         # (m)
 magnet_od = 1.33e-3         # (m)
 magnet_remanence = 1.45     # (T)
 
+# Build the visual models, set to False for headless batch runs
+visual = True
+
 # Parameter for beams
 nume_nodes_viz = 600
 num_elem_body = 30
@@ -99,7 +102,8 @@ def createScene(root_node):
 
     # simulator
     simulator = mcr_simulator.Simulator(
-        root_node=root_node)
+        root_node=root_node,
+        visual=visual)
 
     # eMNS
     navion = mcr_emns.EMNS(
@@ -111,7 +115,8 @@ def createScene(root_node):
         root_node=root_node,
         environment_stl=environment_stl,
         T_env_sim=T_env_sim,
-        color=[1., 0., 0., 0.3])
+        color=[1., 0., 0., 0.3],
+        visual=visual)
 
     # magnet
     magnet = mcr_magnet.Magnet(
@@ -142,7 +147,8 @@ def createScene(root_node):
         nume_nodes_viz=nume_nodes_viz,
         T_start_sim=T_start_sim,
         fixed_directions=[0, 0, 1, 0, 0, 0],
-        color=[0.2, .8, 1., 1.]
+        color=[0.2, .8, 1., 1.],
+        visual=visual
         )
 
     # ros-based controller
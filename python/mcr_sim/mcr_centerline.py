@@ -0,0 +1,362 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.spatial import cKDTree
+
+
+def winding_numbers(points, corners, chunk_size=500):
+    '''
+    Return the generalized winding numbers of points with respect to a
+    triangle mesh (Van Oosterom and Strackee solid angles). It is close to
+    +1 or -1 inside a surface, depending on its orientation, and to 0
+    outside, also when the surface has holes such as the open ends of a
+    vessel.
+
+    :param points: The query points, shape (N, 3)
+    :type points: ndarray
+    :param corners: The corners of the triangles, shape (M, 3, 3)
+    :type corners: ndarray
+    :rtype: ndarray
+    '''
+
+    points = np.atleast_2d(points)
+    winding = np.empty(len(points))
+
+    for start in range(0, len(points), chunk_size):
+        chunk = points[start:start + chunk_size]
+        a, b, c = (corners[None, :, i] - chunk[:, None] for i in range(3))
+        la, lb, lc = (np.linalg.norm(x, axis=2) for x in (a, b, c))
+        det = np.einsum('ijk,ijk->ij', a, np.cross(b, c))
+        denom = (
+            la*lb*lc
+            + np.einsum('ijk,ijk->ij', a, b)*lc
+            + np.einsum('ijk,ijk->ij', b, c)*la
+            + np.einsum('ijk,ijk->ij', c, a)*lb)
+        winding[start:start + len(chunk)] = np.sum(
+            np.arctan2(det, denom), axis=1)/(2.*np.pi)
+
+    return winding
+
+
+def resample(points, spacing, smoothing=0):
+    '''
+    Smooth a polyline with a moving average and resample it with a constant
+    distance between points. The end points are kept.
+
+    :param points: The points of the polyline, shape (N, 3)
+    :type points: ndarray
+    :param spacing: The distance between the resampled points (m)
+    :type spacing: float
+    :param smoothing: The half width of the moving average (points)
+    :type smoothing: int
+    :rtype: ndarray
+    '''
+
+    if smoothing > 0 and len(points) > 2:
+        padded = np.concatenate((
+            np.repeat(points[:1], smoothing, axis=0), points,
+            np.repeat(points[-1:], smoothing, axis=0)))
+        kernel = np.ones(2*smoothing + 1)/(2*smoothing + 1)
+        smoothed = np.stack([
+            np.convolve(padded[:, i], kernel, mode='valid')
+            for i in range(3)], axis=1)
+        smoothed[0], smoothed[-1] = points[0], points[-1]
+        points = smoothed
+
+    lengths = np.concatenate((
+        [0.], np.cumsum(np.linalg.norm(np.diff(points, axis=0), axis=1))))
+    num = max(int(np.ceil(lengths[-1]/spacing)), 1) + 1
+    s = np.linspace(0., lengths[-1], num)
+
+    return np.stack(
+        [np.interp(s, lengths, points[:, i]) for i in range(3)], axis=1)
+
+
+def extract_centerline(
+        distance_field,
+        start,
+        min_clearance=0.001,
+        min_branch_length=0.02,
+        max_branches=8,
+        spacing=0.001,
+        smoothing=2):
+    '''
+    Extract the centerline of a vessel from the distance field of its
+    walls. The lumen is the set of grid nodes in the free space and inside
+    the mesh by winding number, which excludes the space leaking through
+    the open ends of the vessel. The centerline follows the paths of
+    largest clearance from the start point, Dijkstra on the grid with a
+    cost of length/clearance**2, first to the farthest node, then to the
+    farthest nodes away from the previous branches.
+
+    :param distance_field: The distance field of the vessel walls
+    :type distance_field: DistanceField
+    :param start: The start point in the simulation frame, usually the insertion point
+    :type start: list[float]
+    :param min_clearance: The minimal distance of the centerline to the walls (m)
+    :type min_clearance: float
+    :param min_branch_length: The minimal length of a side branch (m)
+    :type min_branch_length: float
+    :param max_branches: The maximal number of branches
+    :type max_branches: int
+    :param spacing: The distance between the points of the centerline (m)
+    :type spacing: float
+    :param smoothing: The half width of the moving average of the paths (grid nodes)
+    :type smoothing: int
+    :return: The branches, each a dict of points, arc lengths from the start point and parent branch
+    :rtype: list[dict]
+    '''
+
+    field = distance_field
+    values = np.asarray(field.flat)
+    candidates = np.flatnonzero(values > min_clearance)
+    index = np.stack(np.unravel_index(candidates, field.shape), axis=1)
+    positions = field.origin + field.spacing*index
+
+    # the winding number is only needed for the few nodes in the free space
+    winding = winding_numbers(positions, field.signed_distance.corners)
+    lumen = np.abs(winding) > 0.5
+    nodes, index, positions = candidates[lumen], index[lumen], positions[lumen]
+    if len(nodes) == 0:
+        raise ValueError('The mesh does not enclose a lumen')
+    clearance = values[nodes]
+
+    # graph of the 26-neighbourhood of the lumen nodes
+    ids = np.full(values.size, -1)
+    ids[nodes] = np.arange(len(nodes))
+    shape = np.array(field.shape)
+    rows, cols, lengths, costs = [], [], [], []
+    for offset in np.stack(np.meshgrid(
+            [-1, 0, 1], [-1, 0, 1], [-1, 0, 1], indexing='ij'),
+            axis=-1).reshape(-1, 3)[14:]:
+        neighbours = index + offset
+        valid = np.all((neighbours >= 0) & (neighbours < shape), axis=1)
+        j = np.full(len(nodes), -1)
+        j[valid] = ids[neighbours[valid] @ field.strides]
+        i = np.flatnonzero(j >= 0)
+        j = j[i]
+        length = field.spacing*np.linalg.norm(offset)
+        rows.append(i)
+        cols.append(j)
+        lengths.append(np.full(len(i), length))
+        costs.append(length/(0.5*(clearance[i] + clearance[j]))**2)
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+
+    def graph(weights):
+        return sparse.coo_matrix(
+            (np.concatenate(weights), (rows, cols)),
+            shape=(len(nodes), len(nodes))).tocsr()
+
+    source = int(np.argmin(np.linalg.norm(positions - start, axis=1)))
+    _, predecessors = csgraph.dijkstra(
+        graph(costs), directed=False, indices=source,
+        return_predecessors=True)
+    geodesic = csgraph.dijkstra(
+        graph(lengths), directed=False, indices=source)
+    geodesic[np.isinf(geodesic)] = -1.
+
+    branches = []
+    on_centerline = np.zeros(len(nodes), dtype=bool)
+    on_centerline[source] = True
+    tree = None
+    for _ in range(max_branches):
+        # the farthest node away from the lumen around the branches
+        if tree is None:
+            remaining = geodesic
+        else:
+            distance, nearest = tree.query(positions)
+            remaining = np.where(
+                distance - clearance[centerline_nodes[nearest]]
+                > min_branch_length, geodesic, -1.)
+        end = int(np.argmax(remaining))
+        if remaining[end] <= 0.:
+            break
+
+        path = [end]
+        while not on_centerline[path[-1]]:
+            path.append(predecessors[path[-1]])
+        path = path[::-1]
+        junction = path[0]
+        on_centerline[path] = True
+
+        # a side branch starts at the arc length of its junction
+        parent = None
+        arc_start = 0.
+        for k, branch in enumerate(branches):
+            if np.any(branch['nodes'] == junction):
+                parent = k
+                arc_start = branch['arc_length'][np.argmin(np.linalg.norm(
+                    branch['points'] - positions[junction], axis=1))]
+                break
+
+        points = resample(positions[path], spacing, smoothing)
+        branches.append({
+            'nodes': np.asarray(path),
+            'points': points,
+            'arc_length': arc_start + np.concatenate(([0.], np.cumsum(
+                np.linalg.norm(np.diff(points, axis=0), axis=1)))),
+            'parent': parent,
+            })
+
+        centerline_nodes = np.flatnonzero(on_centerline)
+        tree = cKDTree(positions[centerline_nodes])
+
+    for branch in branches:
+        del branch['nodes']
+
+    return branches
+
+
+class Centerline():
+    '''
+    A class that holds the centerline of a vessel, as branches of points at
+    a constant spacing with their arc length from the start point, and
+    projects points onto it. The centerline is extracted once and cached on
+    disk as a .npz file keyed by the distance field and the parameters.
+
+    :param distance_field: The distance field of the vessel walls
+    :type distance_field: DistanceField
+    :param start: The start point in the simulation frame, usually the insertion point
+    :type start: list[float]
+    :param min_clearance: The minimal distance of the centerline to the walls (m)
+    :type min_clearance: float
+    :param min_branch_length: The minimal length of a side branch (m)
+    :type min_branch_length: float
+    :param max_branches: The maximal number of branches
+    :type max_branches: int
+    :param spacing: The distance between the points of the centerline (m)
+    :type spacing: float
+    :param cache_dir: The directory where centerlines are stored
+    :type cache_dir: str
+    '''
+
+    def __init__(
+            self,
+            distance_field,
+            start,
+            min_clearance=0.001,
+            min_branch_length=0.02,
+            max_branches=8,
+            spacing=0.001,
+            cache_dir=os.path.join('~', '.cache', 'mcr_sim')):
+
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.start = [float(x) for x in start[0:3]]
+
+        key = hashlib.sha1(json.dumps([
+            os.path.basename(distance_field.path), self.start,
+            min_clearance, min_branch_length, max_branches, spacing,
+            ]).encode()).hexdigest()[:16]
+        self.path = os.path.join(self.cache_dir, 'centerline_' + key + '.npz')
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            branches = extract_centerline(
+                distance_field, np.array(self.start), min_clearance,
+                min_branch_length, max_branches, spacing)
+
+            # write to a temporary file first so that concurrent workers
+            # never load a partially written centerline
+            tmp_path = self.path + '.' + str(os.getpid()) + '.tmp.npz'
+            np.savez(
+                tmp_path,
+                points=np.concatenate([b['points'] for b in branches]),
+                arc_length=np.concatenate(
+                    [b['arc_length'] for b in branches]),
+                branch=np.concatenate([
+                    np.full(len(b['points']), k)
+                    for k, b in enumerate(branches)]),
+                parent=np.array([
+                    -1 if b['parent'] is None else b['parent']
+                    for b in branches]))
+            os.replace(tmp_path, self.path)
+
+        with np.load(self.path) as data:
+            self.points = data['points']
+            self.arc_length = data['arc_length']
+            self.branch = data['branch']
+            self.parent = data['parent']
+        self.radius = distance_field.distance(self.points)
+        self.tree = cKDTree(self.points)
+
+        # the neighbours of each point along its branch, itself at the ends
+        index = np.arange(len(self.points))
+        self.previous = np.where(
+            np.roll(self.branch, 1) == self.branch, index - 1, index)
+        self.next = np.where(
+            np.roll(self.branch, -1) == self.branch, index + 1, index)
+        self.previous[0] = 0
+        self.next[-1] = len(self.points) - 1
+
+    @property
+    def length(self):
+        ''' The largest arc length of the centerline (m). '''
+
+        return float(np.max(self.arc_length))
+
+    def project(self, points):
+        '''
+        Project points onto the centerline, on the segments around the
+        nearest point of the centerline. Points of any leading shape are
+        accepted, for instance (frames, nodes, 3). Points with NaN
+        coordinates, such as the padding of sweep trajectories, give NaN.
+
+        :param points: The points in the simulation frame, shape (..., 3)
+        :type points: ndarray
+        :return: The arc length of the projection (m), the distance to the
+            centerline (m), the radius of the lumen at the projection (m)
+            and the branch index
+        :rtype: tuple[ndarray]
+        '''
+
+        points = np.asarray(points, dtype=float)
+        shape = points.shape[:-1]
+        points = points.reshape(-1, 3)
+
+        finite = np.all(np.isfinite(points), axis=1)
+        nearest = np.zeros(len(points), dtype=int)
+        _, nearest[finite] = self.tree.query(points[finite], workers=-1)
+
+        best = None
+        for neighbour in (self.previous[nearest], self.next[nearest]):
+            a = self.points[nearest]
+            ab = self.points[neighbour] - a
+            t = np.einsum('ij,ij->i', points - a, ab)/np.maximum(
+                np.einsum('ij,ij->i', ab, ab), 1e-30)
+            t = np.clip(t, 0., 1.)
+            distance = np.linalg.norm(points - a - t[:, None]*ab, axis=1)
+            if best is None:
+                best = (distance, t, neighbour)
+            else:
+                closer = distance < best[0]
+                best = tuple(
+                    np.where(closer, new, old)
+                    for new, old in zip((distance, t, neighbour), best))
+
+        distance, t, neighbour = best
+        arc_length = (
+            (1. - t)*self.arc_length[nearest] + t*self.arc_length[neighbour])
+        radius = (1. - t)*self.radius[nearest] + t*self.radius[neighbour]
+        branch = self.branch[nearest]
+        arc_length[~finite] = distance[~finite] = radius[~finite] = np.nan
+        branch[~finite] = -1
+
+        return (
+            arc_length.reshape(shape), distance.reshape(shape),
+            radius.reshape(shape), branch.reshape(shape))
+
+    def progress(self, points):
+        '''
+        Return the arc length of the projection of points onto the
+        centerline (m).
+
+        :param points: The points in the simulation frame, shape (..., 3)
+        :type points: ndarray
+        :rtype: ndarray
+        '''
+
+        return self.project(points)[0]
@@ -0,0 +1,248 @@
+import io
+import json
+import os
+
+import numpy as np
+
+# data of the mechanical object of the instrument stored in a checkpoint, the
+# collision and visual models are mapped from it
+INSTRUMENT_STATE = (
+    'position', 'velocity', 'rest_position', 'free_position',
+    'free_velocity')
+
+# parameters of the scene that are not carried over to the scenes built
+# from a checkpoint, each continuation has its own outputs
+PRIVATE_PARAMS = ('visual', 'record_path', 'profile')
+
+
+def _to_list(value):
+    ''' Make numpy values of the scene parameters JSON serializable. '''
+
+    return np.asarray(value).tolist()
+
+
+class Checkpoint():
+    '''
+    A class that holds a snapshot of a scene built by mcr_scene.build_scene:
+    the simulated time and time step, the positions, velocities and rest
+    shape of the instrument, the insertion of the
+    InterventionalRadiologyController, the magnetic forces, the desired
+    field and gradient of the MagController, the tolerance of the
+    constraint solver and the parameters of the scene.
+
+    A checkpoint is restored in the same scene to try alternative commands
+    from the same configuration, or saved as a compact .npz file and
+    restored in a scene built from its parameters in another process, see
+    build_scene and fork. The InterventionalRadiologyController is
+    reinitialized from the restored insertion. The contact forces that warm
+    start the constraint solver are internal to SOFA and not part of the
+    checkpoint, so a restored continuation matches the original one up to
+    the tolerance of the constraint solver, not bit for bit.
+
+    :param state: The arrays of the state
+    :type state: dict
+    :param params: The parameters of the scene
+    :type params: dict
+    '''
+
+    def __init__(self, state, params=None):
+
+        self.state = state
+        self.params = params or {}
+
+    @property
+    def time(self):
+        ''' The simulated time of the checkpoint (s). '''
+
+        return float(self.state['time'])
+
+    @classmethod
+    def capture(cls, scene):
+        '''
+        Capture the state of a scene after a step.
+
+        :param scene: The scene
+        :type scene: mcr_scene.Scene
+        :rtype: Checkpoint
+        '''
+
+        root_node = scene.root_node
+        instrument = scene.instrument
+        mag_controller = scene.mag_controller
+
+        state = {
+            'time': np.array(root_node.time.value),
+            'dt': np.array(root_node.dt.value),
+            'xtip': np.array(instrument.IRC.xtip.value, dtype=float),
+            'rotation': np.array(
+                instrument.IRC.rotationInstrument.value, dtype=float),
+            'forces': np.array(instrument.CFF.forces.value, dtype=float),
+            'field_des': np.array(mag_controller.field_des, dtype=float),
+            'bg': np.array(mag_controller.BG, dtype=float),
+            'tolerance': np.array(scene.simulator.tolerance),
+            }
+        if mag_controller.gradient_des is not None:
+            state['gradient_des'] = np.array(
+                mag_controller.gradient_des, dtype=float)
+        if mag_controller.currents is not None:
+            state['currents'] = np.array(mag_controller.currents, dtype=float)
+
+        for name in INSTRUMENT_STATE:
+            data = instrument.MO.getData(name)
+            if data is not None:
+                state['MO_' + name] = np.array(data.value, dtype=float)
+
+        return cls(state, json.loads(json.dumps(
+            scene.params, default=_to_list)))
+
+    def restore(self, scene):
+        '''
+        Restore the state in a scene with the same instrument, which has
+        been initialized. The recorder and the profiler of the scene keep
+        their data, their next rows start at the restored time.
+
+        :param scene: The scene
+        :type scene: mcr_scene.Scene
+        '''
+
+        state = self.state
+        root_node = scene.root_node
+        instrument = scene.instrument
+        mag_controller = scene.mag_controller
+
+        root_node.time.value = float(state['time'])
+        root_node.dt.value = float(state['dt'])
+        scene.simulator.dt = float(state['dt'])
+        if float(state['tolerance']) != scene.simulator.tolerance:
+            scene.simulator.set_tolerance(float(state['tolerance']))
+
+        instrument.IRC.xtip.value = state['xtip'].tolist()
+        instrument.IRC.rotationInstrument.value = state['rotation'].tolist()
+        instrument.insertion_len = instrument.IRC.xtip.value
+
+        # rebuild the discretization of the beams for the restored
+        # insertion, before the nodes are set
+        instrument.IRC.reinit()
+
+        for name in INSTRUMENT_STATE:
+            data = instrument.MO.getData(name)
+            if data is None or 'MO_' + name not in state:
+                continue
+            if len(data.value) != len(state['MO_' + name]):
+                raise ValueError(
+                    'The checkpoint holds {:d} instrument nodes, the scene '
+                    '{:d}'.format(len(state['MO_' + name]), len(data.value)))
+            data.value = state['MO_' + name].tolist()
+
+        instrument.CFF.forces.value = state['forces'].tolist()
+
+        # a prediction of the pipelined controller belongs to another state
+        mag_controller.prediction = None
+        mag_controller.field_des = state['field_des'].copy()
+        mag_controller.gradient_des = (
+            state['gradient_des'].copy() if 'gradient_des' in state
+            else None)
+        mag_controller.BG = state['bg'].tolist()
+        mag_controller.currents = (
+            state['currents'].copy() if 'currents' in state else None)
+
+    def to_bytes(self):
+        ''' Return the checkpoint as the bytes of a .npz file. '''
+
+        buffer = io.BytesIO()
+        np.savez(
+            buffer, params=np.array(json.dumps(self.params)), **self.state)
+
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        ''' Return the checkpoint stored in the bytes of a .npz file. '''
+
+        with np.load(io.BytesIO(data)) as arrays:
+            state = {
+                name: arrays[name] for name in arrays.files
+                if name != 'params'}
+            params = json.loads(str(arrays['params']))
+
+        return cls(state, params)
+
+    def save(self, path):
+        ''' Store the checkpoint in a .npz file. '''
+
+        # write to a temporary file first so that workers never load a
+        # partially written checkpoint
+        tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.to_bytes())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        ''' Load a checkpoint from a .npz file. '''
+
+        with open(path, 'rb') as f:
+            return cls.from_bytes(f.read())
+
+
+def build_scene(
+        root_node, checkpoint, builder='mcr_sim.mcr_scene:build_scene',
+        **params):
+    '''
+    Build and initialize a scene with the parameters of a checkpoint and
+    restore its state. The keyword arguments override the parameters, for
+    instance commands, the recorder and visual models of the original scene
+    are not carried over.
+
+    :param root_node: The sofa root node
+    :param checkpoint: The checkpoint or the path to its file
+    :type checkpoint: Checkpoint or str
+    :param builder: The scene builder 'module:function'
+    :type builder: str
+    :return: The scene
+    :rtype: mcr_scene.Scene
+    '''
+
+    from mcr_sim import mcr_sweep, run
+
+    if not isinstance(checkpoint, Checkpoint):
+        checkpoint = Checkpoint.load(checkpoint)
+
+    scene_params = {
+        key: value for key, value in checkpoint.params.items()
+        if key not in PRIVATE_PARAMS}
+    scene_params.update(params)
+
+    scene = mcr_sweep.load_builder(builder)(root_node, **scene_params)
+    run.init(root_node)
+    checkpoint.restore(scene)
+
+    return scene
+
+
+def fork(checkpoint_path, continuations, output_dir, steps=500, **kwargs):
+    '''
+    Run alternative continuations of a saved checkpoint in parallel worker
+    processes, each restoring the checkpoint instead of simulating the
+    shared prefix again.
+
+    :param checkpoint_path: The path to the checkpoint file
+    :type checkpoint_path: str
+    :param continuations: The parameters of each continuation, for instance a field_sequence or commands, see mcr_sweep.run_sample
+    :type continuations: list[dict]
+    :param output_dir: The directory of the results
+    :type output_dir: str
+    :param steps: The number of simulation steps of each continuation
+    :type steps: int
+    :param `**kwargs`: The keyword arguments are passed to mcr_sweep.Sweep
+    :return: The summary rows of the continuations
+    :rtype: list[dict]
+    '''
+
+    from mcr_sim import mcr_sweep
+
+    samples = [
+        dict(continuation, checkpoint=os.path.abspath(checkpoint_path))
+        for continuation in continuations]
+
+    return mcr_sweep.Sweep(samples, output_dir, steps=steps, **kwargs).run()
@@ -0,0 +1,222 @@
+import Sofa
+import numpy as np
+
+from mcr_sim import mcr_mesh
+
+# collision detection components of each profile of the collision pipeline,
+# with the plugins they need. 'brute_force' is the pipeline of the original
+# scenes, which tests every pair of collision models and traverses their
+# bounding trees in one component. 'bvh_narrow' separates the broad phase,
+# still brute force over the pairs of models, from the traversal of the
+# bounding volume hierarchies in the narrow phase. The sweep and prune profiles
+# sort the bounding boxes along the axes, 'incremental_sap' updates the
+# sorting from the previous step.
+COLLISION_PROFILES = {
+    'brute_force': {
+        'components': [('BruteForceDetection', {'name': 'N2'})],
+        'plugins': []},
+    'bvh_narrow': {
+        'components': [
+            ('BruteForceBroadPhase', {'name': 'broadPhase'}),
+            ('BVHNarrowPhase', {'name': 'narrowPhase'})],
+        'plugins': []},
+    'parallel_bvh': {
+        'components': [
+            ('ParallelBruteForceBroadPhase', {'name': 'broadPhase'}),
+            ('ParallelBVHNarrowPhase', {'name': 'narrowPhase'})],
+        'plugins': ['MultiThreading']},
+    'sap': {
+        'components': [('DirectSAP', {'name': 'sap'})],
+        'plugins': []},
+    'incremental_sap': {
+        'components': [('IncrSAP', {'name': 'sap'})],
+        'plugins': []},
+    }
+
+
+def proximity_distances(outer_diam, alarm_margin=0.001):
+    '''
+    Return the contact and alarm distances of the collision pipeline for an
+    instrument, whose collision models are its centerline. The contact
+    distance is the radius of the instrument, so that contacts hold its
+    surface on the walls, and the alarm distance adds a margin for the
+    motion during a time step.
+
+    :param outer_diam: The outer diameter of the instrument (m)
+    :type outer_diam: float
+    :param alarm_margin: The distance between the contact and alarm distances (m)
+    :type alarm_margin: float
+    :return: The contact and alarm distances (m)
+    :rtype: tuple[float]
+    '''
+
+    return outer_diam/2., outer_diam/2. + alarm_margin
+
+
+def add_contact_listeners(
+        root_node, instrument, environment, name='contacts'):
+    '''
+    Add contact listeners between all collision models of an instrument and
+    an environment, before the initialization of the scene.
+
+    :param root_node: The sofa root node
+    :param instrument: The object defining the instrument
+    :param environment: The object defining the environment
+    :param name: The prefix of the names of the listeners
+    :type name: str
+    :return: The contact listeners, the listener of the instrument model i
+        and the environment model j at index i*len(environment.collision_models) + j
+    :rtype: list
+    '''
+
+    listeners = []
+    for i, model_instrument in enumerate(instrument.collision_models):
+        for j, model_env in enumerate(environment.collision_models):
+            listeners.append(root_node.addObject(
+                'ContactListener',
+                name='{:s}_{:d}{:d}'.format(name, i, j),
+                collisionModel1=model_instrument.getLinkPath(),
+                collisionModel2=model_env.getLinkPath()))
+
+    return listeners
+
+
+def count_contacts(listeners):
+    ''' Return the number of contacts of the last step. '''
+
+    return sum(listener.getNumberOfContacts() for listener in listeners)
+
+
+class CollisionCulling(Sofa.Core.Controller):
+    '''
+    A class that deactivates the collision models of an instrument while
+    all of its nodes are farther from the walls than the alarm distance, so
+    that the collision detection skips it. The distances are interpolated
+    in the distance field of the environment. A margin covers the
+    interpolation error of the field, the length of the segments between
+    nodes and the motion of the nodes in a step. The collision models stay
+    active while the contact listeners report contacts.
+
+    If the collision mesh of the environment is split into groups, see
+    mcr_environment.Environment, the groups whose bounding box is farther
+    from every node than the alarm distance, with the same margins for the
+    segments and the motion, are deactivated too, so that the collision
+    detection only tests the walls near the instrument. The groups with
+    contacts stay active.
+
+    :param instrument: The object defining the instrument
+    :param environment: The object defining the environment
+    :param alarm_distance: The alarm distance of the collision pipeline (m)
+    :type alarm_distance: float
+    :param margin: The bound of the error of the distances (m), the one of the distance field if None
+    :type margin: float
+    :param contact_listeners: The contact listeners between the instrument and the environment, in the order of add_contact_listeners
+    :type contact_listeners: list
+    :param `*args`: The variable arguments are passed to the SofaCoreController
+    :param `**kwargs`: The keyword arguments arguments are passed to the SofaCoreController
+    '''
+
+    def __init__(
+            self,
+            instrument,
+            environment,
+            alarm_distance=0.003,
+            margin=None,
+            contact_listeners=None,
+            *args, **kwargs):
+
+        # These are needed (and the normal way to override from a python class)
+        Sofa.Core.Controller.__init__(self, *args, **kwargs)
+
+        self.instrument = instrument
+        self.environment = environment
+        self.alarm_distance = alarm_distance
+        self.contact_listeners = contact_listeners or []
+        self.previous = None
+        self.active = True
+        self.culled_steps = 0
+
+        # group of the environment model of each listener
+        self.groups = environment.collision_groups
+        model_groups = [
+            i for i, group in enumerate(self.groups) for model in group]
+        self.listener_groups = [
+            model_groups[i % len(model_groups)]
+            for i in range(len(self.contact_listeners))]
+        self.group_active = [True]*len(self.groups)
+        self.culled_groups = 0  # sum over the steps of the culled groups
+
+        if self.environment.distance_field is None:
+            self.environment.enable_distance_field()
+        self.margin = (
+            self.environment.distance_field.error if margin is None
+            else margin)
+
+    def set_active(self, active, group_active=None):
+        '''
+        Activate or deactivate the collision models of the instrument, and
+        of the groups of the environment if group_active is given.
+        '''
+
+        if active != self.active:
+            for model in self.instrument.collision_models:
+                model.active.value = active
+            self.active = active
+
+        if group_active is not None:
+            for group, previous, value in zip(
+                    self.groups, self.group_active, group_active):
+                if value != previous:
+                    for model in group:
+                        model.active.value = value
+            # a new list, the state may be copied, see mcr_jacobian.suspended
+            self.group_active = list(group_active)
+
+    def apply(self):
+        ''' Set the collision models to the state of the culling. '''
+
+        for model in self.instrument.collision_models:
+            model.active.value = self.active
+        for group, active in zip(self.groups, self.group_active):
+            for model in group:
+                model.active.value = active
+
+    def onAnimateBeginEvent(self, event):
+
+        nodes = np.array(self.instrument.MO.position.value)[:, 0:3]
+        if self.previous is None or len(self.previous) != len(nodes):
+            motion = np.inf
+        else:
+            motion = np.max(np.linalg.norm(nodes - self.previous, axis=1))
+        self.previous = nodes
+
+        # a point of a segment is at most half its length from a node
+        segment = 0.5*np.max(np.linalg.norm(np.diff(nodes, axis=0), axis=1))
+        reach = self.alarm_distance + segment + 2.*motion
+
+        contact_groups = [False]*len(self.groups)
+        for listener, group in zip(
+                self.contact_listeners, self.listener_groups):
+            if listener.getNumberOfContacts() > 0:
+                contact_groups[group] = True
+
+        # the bounding boxes bound the distances to the walls from below
+        group_active = None
+        if len(self.groups) > 1:
+            distances = mcr_mesh.box_distances(
+                nodes, self.environment.group_lower,
+                self.environment.group_upper)
+            group_active = [
+                contact or distance < reach
+                for contact, distance in zip(contact_groups, distances)]
+            self.culled_groups += len(group_active) - sum(group_active)
+
+        # never deactivate the collision models of an instrument in contact
+        if any(contact_groups):
+            self.set_active(True, group_active)
+            return
+
+        clearance = np.min(self.environment.distance(nodes))
+        self.set_active(clearance < reach + self.margin, group_active)
+        if not self.active:
+            self.culled_steps += 1
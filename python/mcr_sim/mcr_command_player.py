@@ -0,0 +1,227 @@
+import Sofa
+import numpy as np
+from scipy.spatial.transform import Rotation as R
+
+
+def load_commands(path):
+    '''
+    Load a command file. The CSV file has the header t,bx,by,bz and an
+    optional insertion column, with the time (s), the desired field (T) and
+    the inserted length of the instrument (m).
+
+    :param path: The path to the CSV file
+    :type path: str
+    :return: The time, fields and insertion lengths (None if not given)
+    :rtype: dict
+    '''
+
+    data = np.genfromtxt(path, delimiter=',', names=True)
+
+    return {
+        'time': np.atleast_1d(data['t']),
+        'fields': np.atleast_2d(
+            np.stack((data['bx'], data['by'], data['bz']), axis=-1)),
+        'insertions': (
+            np.atleast_1d(data['insertion'])
+            if 'insertion' in data.dtype.names else None),
+        }
+
+
+def save_commands(path, time, fields, insertions=None):
+    '''
+    Store commands in a CSV file readable by load_commands.
+    '''
+
+    columns = [np.asarray(time)[:, None], np.asarray(fields)]
+    header = 't,bx,by,bz'
+    if insertions is not None:
+        columns.append(np.asarray(insertions)[:, None])
+        header += ',insertion'
+
+    np.savetxt(
+        path, np.hstack(columns), delimiter=',', header=header, comments='')
+
+
+def load_tip_pose(path):
+    '''
+    Load a recorded tip pose topic of data/01_tip_pose/2*_rod_sim_tip_topic_*.
+
+    :param path: The path to the CSV file
+    :type path: str
+    :return: The time from the first sample (s) and the tip poses [x, y, z, qx, qy, qz, qw]
+    :rtype: tuple[ndarray]
+    '''
+
+    data = np.genfromtxt(path, delimiter=',', skip_header=1)
+
+    return (data[:, 0] - data[0, 0])*1e-9, data[:, 1:8]
+
+
+def load_tip_tracker(path):
+    '''
+    Load a video tracker file of data/01_tip_pose/1*_video_tracker_*.
+
+    :param path: The path to the CSV file
+    :type path: str
+    :return: The time (s), the tip positions [x, y] (m) and the tip angles (rad)
+    :rtype: tuple[ndarray]
+    '''
+
+    data = np.genfromtxt(path, delimiter=',', skip_header=1)
+
+    return data[:, 0], data[:, 1:3], data[:, 3]
+
+
+def commands_from_tip_pose(
+        time,
+        poses,
+        field_magnitude=0.015,
+        insertion_init=0.001):
+    '''
+    Derive commands from a recorded tip pose, for recordings that do not
+    contain the commands themselves. The desired field points along the
+    tip, where the magnets align with it under a quasi-static field, and
+    the insertion length follows the displacement of the tip along its own
+    axis, the lateral displacement being due to the steering.
+
+    :param time: The time of the recording (s)
+    :type time: ndarray
+    :param poses: The tip poses [x, y, z, qx, qy, qz, qw]
+    :type poses: ndarray
+    :param field_magnitude: The magnitude of the desired field (T)
+    :type field_magnitude: float
+    :param insertion_init: The inserted length at the first sample (m)
+    :type insertion_init: float
+    :return: The commands, see load_commands
+    :rtype: dict
+    '''
+
+    poses = np.asarray(poses)
+    directions = R.from_quat(poses[:, 3:7]).apply([1., 0., 0.])
+    steps = np.sum(
+        directions[:-1]*np.diff(poses[:, 0:3], axis=0), axis=1)
+    travelled = np.concatenate(([0.], np.cumsum(steps)))
+
+    return {
+        'time': np.asarray(time),
+        'fields': field_magnitude*directions,
+        'insertions': insertion_init + travelled,
+        }
+
+
+def tracking_error(time, positions, time_ref, positions_ref):
+    '''
+    Return the RMS and maximal distance between a trajectory and a
+    reference, interpolated at the reference times within the common time
+    range.
+
+    :rtype: tuple[float]
+    '''
+
+    positions = np.asarray(positions)
+    positions_ref = np.asarray(positions_ref)
+    num_dims = positions_ref.shape[1]
+
+    mask = (time_ref >= time[0]) & (time_ref <= time[-1])
+    interp = np.stack([
+        np.interp(time_ref[mask], time, positions[:, i])
+        for i in range(num_dims)], axis=-1)
+    distances = np.linalg.norm(interp - positions_ref[mask], axis=1)
+
+    return float(np.sqrt(np.mean(distances**2))), float(np.max(distances))
+
+
+class CommandPlayer(Sofa.Core.Controller):
+    '''
+    A class that applies timestamped field and insertion commands to the
+    controllers at simulation time, so that a recorded experiment replays
+    as fast as the solver allows. A command is held until the next one
+    (zero-order hold), or linearly interpolated.
+
+    The commands of a step are applied at the end of the previous step, so
+    that the magnetic controller uses them in the same step regardless of
+    the order of the controllers in the scene.
+
+    :param controller_sofa: The sofa-based controller
+    :param time: The time of the commands (s), in increasing order
+    :type time: ndarray
+    :param fields: The desired fields in the eMNS frame (T), shape (N, 3), None to keep the field
+    :type fields: ndarray
+    :param insertions: The inserted lengths of the instrument (m), None to keep the insertion
+    :type insertions: ndarray
+    :param interpolate: A flag that interpolates between commands
+    :type interpolate: bool
+    :param `*args`: The variable arguments are passed to the SofaCoreController
+    :param `**kwargs`: The keyword arguments arguments are passed to the SofaCoreController
+    '''
+
+    def __init__(
+            self,
+            controller_sofa,
+            time,
+            fields=None,
+            insertions=None,
+            interpolate=False,
+            *args, **kwargs):
+
+        # These are needed (and the normal way to override from a python class)
+        Sofa.Core.Controller.__init__(self, *args, **kwargs)
+
+        self.controller_sofa = controller_sofa
+        self.mag_controller = controller_sofa.mag_controller
+        self.instrument = controller_sofa.instrument
+
+        self.time = np.asarray(time, dtype=float)
+        self.fields = None if fields is None else np.asarray(
+            fields, dtype=float).reshape(-1, 3)
+        self.insertions = None if insertions is None else np.asarray(
+            insertions, dtype=float)
+        self.interpolate = interpolate
+
+        if np.any(np.diff(self.time) < 0.):
+            raise ValueError('The command times must be increasing')
+
+        self.step_time = self.controller_sofa.root_node.time.value
+        self.apply(self.step_time)
+
+    @property
+    def end_time(self):
+        ''' The time of the last command (s). '''
+
+        return float(self.time[-1])
+
+    def _sample(self, values, t):
+
+        if self.interpolate:
+            if values.ndim == 1:
+                return np.interp(t, self.time, values)
+            return np.array([
+                np.interp(t, self.time, values[:, i])
+                for i in range(values.shape[1])])
+
+        index = np.searchsorted(self.time, t, side='right') - 1
+
+        return values[max(index, 0)]
+
+    def apply(self, t):
+        '''
+        Send the commands at time t (s) to the controllers. Before the first
+        command the first one is used.
+        '''
+
+        if self.fields is not None:
+            self.mag_controller.field_des = self._sample(self.fields, t)
+
+        if self.insertions is not None:
+            self.instrument.IRC.xtip.value = [
+                float(self._sample(self.insertions, t))]
+            self.instrument.insertion_len = self.instrument.IRC.xtip.value
+
+    def onAnimateBeginEvent(self, event):
+
+        self.step_time = self.controller_sofa.root_node.time.value
+
+    def onAnimateEndEvent(self, event):
+        ''' Apply the commands of the next step. '''
+
+        self.apply(self.step_time + event['dt'])
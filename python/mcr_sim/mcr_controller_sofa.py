@@ -1,7 +1,7 @@
 import Sofa
 import numpy as np
 
-from mcr_sim import mcr_mag_controller
+from mcr_sim import mcr_mag_controller, mcr_command_player
 from scipy.spatial.transform import Rotation as R
 
 
@@ -20,6 +20,12 @@ class ControllerSofa(Sofa.Core.Controller):
     :type T_sim_mns: list[float]
     :param T_sim_mns: The inital magnetic field direction and magnitude (T)
     :type T_sim_mns: ndarray
+    :param gradient_force: A flag that enables the magnetic gradient force on the magnets
+    :type gradient_force: bool
+    :param pipelined: A flag that computes the magnetic model of the next step in the background while SOFA solves the current step
+    :type pipelined: bool
+    :param commands: Scripted commands {'time', 'fields', 'insertions'} applied at simulation time, see mcr_command_player.load_commands
+    :type commands: dict
     '''
 
     def __init__(
@@ -29,6 +35,9 @@ class ControllerSofa(Sofa.Core.Controller):
             instrument,
             T_sim_mns,
             mag_field_init=np.array([0.01, 0.01, 0.]),
+            gradient_force=False,
+            pipelined=False,
+            commands=None,
             *args, **kwargs):
 
         # These are needed (and the normal way to override from a python class)
@@ -48,11 +57,21 @@ class ControllerSofa(Sofa.Core.Controller):
             e_mns=self.e_mns,
             instrument=self.instrument,
             T_sim_mns=self.T_sim_mns,
+            gradient_force=gradient_force,
+            pipelined=pipelined,
             )
         self.root_node.addObject(self.mag_controller)
 
         self.mag_controller.field_des = self.mag_field_init
 
+        self.command_player = None
+        if commands is not None:
+            self.command_player = mcr_command_player.CommandPlayer(
+                name='command_player',
+                controller_sofa=self,
+                **commands)
+            self.root_node.addObject(self.command_player)
+
         self.print_insertion_length = False
 
     def onKeypressedEvent(self, event):
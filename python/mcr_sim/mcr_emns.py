@@ -1,6 +1,10 @@
+from collections import OrderedDict
+
 import numpy as np
 from mag_manip import mag_manip
 
+from mcr_sim import mcr_field_grid, mcr_mpem
+
 
 class EMNS():
     '''
@@ -10,19 +14,117 @@ class EMNS():
     :type name: str
     :param calibration_path: The path to the eMNS calibartion file
     :type name: str
+    :param backend: The forward model, 'mag_manip' or 'numpy' for the
+        vectorized model of mcr_mpem
+    :type backend: str
+    :param max_current: The maximal absolute current of the coils, a scalar or one value per coil (A). None for unbounded currents.
+    :type max_current: float
+    :param bucket_size: The edge length of the position buckets whose actuation matrices and factorizations are reused (m). None to evaluate the model at every query.
+    :type bucket_size: float
     '''
 
     def __init__(
            self,
            name='emns',
            calibration_path='../calib/Navion_2_Calibration_24-02-2020.yaml',
+           backend='mag_manip',
+           max_current=None,
+           bucket_size=None,
            ):
 
         self.name = name
         self.calibration_path = calibration_path
-        self.forward_model = mag_manip.ForwardModelMPEM()
+        self.backend = backend
+
+        if backend == 'mag_manip':
+            self.forward_model = mag_manip.ForwardModelMPEM()
+        elif backend == 'numpy':
+            self.forward_model = mcr_mpem.ForwardModelMPEM()
+        else:
+            raise ValueError('Unknown eMNS backend: ' + str(backend))
         self.forward_model.setCalibrationFile(calibration_path)
 
+        self.grid = None
+
+        self.allocator = CurrentAllocator(
+            e_mns=self,
+            max_current=max_current,
+            bucket_size=bucket_size)
+        self.allocators = [self.allocator]
+
+    def create_allocator(self):
+        '''
+        Return a new current allocator with the settings of allocator but
+        its own cache and warm start, for a thread that allocates currents
+        concurrently. Its cache is cleared with the one of allocator.
+
+        :rtype: CurrentAllocator
+        '''
+
+        allocator = CurrentAllocator(
+            e_mns=self,
+            max_current=self.allocator.max_current,
+            bucket_size=self.allocator.bucket_size,
+            cache_size=self.allocator.cache_size,
+            max_iter=self.allocator.max_iter,
+            tol=self.allocator.tol)
+        self.allocators.append(allocator)
+
+        return allocator
+
+    def _clear_allocators(self):
+
+        for allocator in self.allocators:
+            allocator.clear()
+
+    def enable_grid_cache(
+            self,
+            T_sim_mns=[0., 0., 0., 0., 0., 0., 1.],
+            half_extent=0.1,
+            spacing=0.005,
+            order=1,
+            cache_dir=None):
+        '''
+        Answer all actuation matrix queries by interpolation on a grid
+        sampled once around the simulation frame. The grid is loaded from
+        the cache directory if it was already computed.
+
+        :param T_sim_mns: The transform defining the pose of the sofa_sim frame center in Navion frame [x, y, z, qx, qy, qz, qw]
+        :type T_sim_mns: list[float]
+        :param half_extent: The half size of the grid along each axis (m)
+        :type half_extent: float
+        :param spacing: The distance between grid nodes (m)
+        :type spacing: float
+        :param order: The interpolation order, 1 (trilinear) or 3 (tricubic)
+        :type order: int
+        :param cache_dir: The directory where grids are stored, defaults to
+            ~/.cache/mcr_sim
+        :type cache_dir: str
+        :return: The estimated interpolation error bound
+        :rtype: dict
+        '''
+
+        kwargs = {} if cache_dir is None else {'cache_dir': cache_dir}
+
+        self.grid = mcr_field_grid.ActuationGrid(
+            actuation_function=self._model_actuation_matrices,
+            calibration_path=self.calibration_path,
+            center=T_sim_mns[0:3],
+            half_extent=half_extent,
+            spacing=spacing,
+            order=order,
+            tag=self.backend,
+            **kwargs)
+        self._clear_allocators()
+
+        return self.grid.error_bound
+
+    def disable_grid_cache(self):
+        ''' Evaluate the model again at every query. '''
+
+        self.grid = None
+        self._clear_allocators()
+
     def currents_to_field(
             self,
             currents=np.array([0., 0., 0.]),
@@ -32,7 +134,7 @@ class EMNS():
         Apply forward model to compute the magnetic field at a given position.
         '''
 
-        bg_jac = self.forward_model.getFieldActuationMatrix(position)
+        bg_jac = self._field_actuation_matrix(position)
         field = bg_jac.dot(currents)
 
         return field
@@ -46,7 +148,510 @@ class EMNS():
         magnetic field at a given position.
         '''
 
-        bg_jac = self.forward_model.getFieldActuationMatrix(position)
-        currents = np.linalg.inv(bg_jac).dot(field)
+        return self.fields_to_currents(field, positions=position)[0]
+
+    def _field_actuation_matrix(self, position):
+        ''' Return the field actuation matrix at a single position. '''
+
+        if self.grid is not None:
+            return self.grid.get_actuation_matrices(position)[0, 0:3]
+
+        return self.forward_model.getFieldActuationMatrix(position)
+
+    def get_field_actuation_matrices(
+            self,
+            positions):
+        '''
+        Compute the field actuation matrices at several positions.
+
+        :param positions: The positions in the eMNS frame, shape (N, 3)
+        :type positions: ndarray
+        :return: The stacked field actuation matrices, shape (N, 3, num_coils)
+        :rtype: ndarray
+        '''
+
+        positions = np.atleast_2d(np.asarray(positions, dtype=float))
+
+        if self.grid is not None:
+            return self.grid.get_actuation_matrices(positions)[:, 0:3]
+
+        if self.backend == 'numpy':
+            return self.forward_model.get_field_actuation_matrices(positions)
+
+        return np.stack([
+            self.forward_model.getFieldActuationMatrix(position)
+            for position in positions])
+
+    def get_actuation_matrices(
+            self,
+            positions):
+        '''
+        Compute the field and gradient actuation matrices at several
+        positions. The rows are [Bx, By, Bz, dBx/dx, dBx/dy, dBx/dz, dBy/dy,
+        dBy/dz].
+
+        :param positions: The positions in the eMNS frame, shape (N, 3)
+        :type positions: ndarray
+        :return: The stacked actuation matrices, shape (N, 8, num_coils)
+        :rtype: ndarray
+        '''
+
+        positions = np.atleast_2d(np.asarray(positions, dtype=float))
+
+        if self.grid is not None:
+            return self.grid.get_actuation_matrices(positions)
+
+        return self._model_actuation_matrices(positions)
+
+    def _model_actuation_matrices(self, positions):
+        ''' Evaluate the forward model at several positions. '''
+
+        if self.backend == 'numpy':
+            return self.forward_model.get_actuation_matrices(positions)
+
+        return np.stack([
+            self.forward_model.getActuationMatrix(position)
+            for position in positions])
+
+    def currents_to_fields(
+            self,
+            currents,
+            positions=None,
+            bg_jacs=None):
+        '''
+        Apply forward model to compute the magnetic fields at several
+        positions.
+
+        :param currents: The coil currents, shape (num_coils,) to use the same
+            currents at every position or (N, num_coils)
+        :type currents: ndarray
+        :param positions: The positions in the eMNS frame, shape (N, 3)
+        :type positions: ndarray
+        :param bg_jacs: Precomputed field actuation matrices, shape
+            (N, 3, num_coils). If given, positions is ignored.
+        :type bg_jacs: ndarray
+        :return: The magnetic fields, shape (N, 3)
+        :rtype: ndarray
+        '''
+
+        if bg_jacs is None:
+            bg_jacs = self.get_field_actuation_matrices(positions)
+
+        currents = np.broadcast_to(
+            currents, bg_jacs.shape[:1] + bg_jacs.shape[2:])
+
+        return np.einsum('nij,nj->ni', bg_jacs, currents)
+
+    def fields_to_currents(
+            self,
+            fields,
+            positions=None,
+            bg_jacs=None,
+            allocator=None):
+        '''
+        Apply backward model to compute the currents needed to generate a
+        magnetic field at several positions. Each position is solved
+        independently.
+
+        :param fields: The desired magnetic fields, shape (3,) to request the
+            same field at every position or (N, 3)
+        :type fields: ndarray
+        :param positions: The positions in the eMNS frame, shape (N, 3)
+        :type positions: ndarray
+        :param bg_jacs: Precomputed field actuation matrices, shape (N, 3, 3).
+            If given, positions is only used for the bucket cache of the
+            allocator.
+        :type bg_jacs: ndarray
+        :param allocator: The current allocator, allocator if None
+        :type allocator: CurrentAllocator
+        :return: The coil currents, shape (N, 3)
+        :rtype: ndarray
+        '''
+
+        allocator = allocator or self.allocator
+
+        return allocator.allocate(
+            fields, positions=positions, matrices=bg_jacs).currents
+
+    def field_to_currents_batch(
+            self,
+            fields,
+            positions):
+        '''
+        Compute in one call the field actuation matrices at several
+        positions, the currents needed to generate the desired fields there
+        and the resulting fields.
+
+        :param fields: The desired magnetic fields, shape (3,) or (N, 3)
+        :type fields: ndarray
+        :param positions: The positions in the eMNS frame, shape (N, 3)
+        :type positions: ndarray
+        :return: The field actuation matrices (N, 3, 3), the currents (N, 3)
+            and the generated fields (N, 3)
+        :rtype: tuple[ndarray]
+        '''
+
+        bg_jacs = self.allocator.get_matrices(positions, num_rows=3)
+        currents = self.fields_to_currents(
+            fields, positions=positions, bg_jacs=bg_jacs)
+        fields = self.currents_to_fields(currents, bg_jacs=bg_jacs)
+
+        return bg_jacs, currents, fields
+
+    def fields_gradients_to_currents(
+            self,
+            fields,
+            gradients,
+            positions=None,
+            actuation_matrices=None,
+            allocator=None):
+        '''
+        Apply backward model to compute the currents that generate the
+        desired magnetic fields and field gradients at several positions in
+        the least-squares sense.
+
+        :param fields: The desired magnetic fields, shape (3,) or (N, 3)
+        :type fields: ndarray
+        :param gradients: The desired gradients [dBx/dx, dBx/dy, dBx/dz, dBy/dy, dBy/dz], shape (5,) or (N, 5)
+        :type gradients: ndarray
+        :param positions: The positions in the eMNS frame, shape (N, 3)
+        :type positions: ndarray
+        :param actuation_matrices: Precomputed actuation matrices, shape
+            (N, 8, num_coils). If given, positions is only used for the
+            bucket cache of the allocator.
+        :type actuation_matrices: ndarray
+        :param allocator: The current allocator, allocator if None
+        :type allocator: CurrentAllocator
+        :return: The coil currents, shape (N, num_coils)
+        :rtype: ndarray
+        '''
+
+        allocator = allocator or self.allocator
+
+        if actuation_matrices is None:
+            num = len(np.atleast_2d(positions))
+        else:
+            num = len(actuation_matrices)
+
+        targets = np.concatenate((
+            np.broadcast_to(fields, (num, 3)),
+            np.broadcast_to(gradients, (num, 5))), axis=1)
+
+        return allocator.allocate(
+            targets, positions=positions,
+            matrices=actuation_matrices).currents
+
+    def field_gradient_to_currents(
+            self,
+            field=np.array([0., 0., 0.]),
+            gradient=np.array([0., 0., 0., 0., 0.]),
+            position=np.array([0., 0., 0.])):
+        '''
+        Apply backward model to compute the currents that generate a
+        magnetic field and field gradient at a given position in the
+        least-squares sense.
+        '''
+
+        return self.fields_gradients_to_currents(
+            field, gradient, positions=position)[0]
+
+    def field_gradient_to_currents_batch(
+            self,
+            fields,
+            positions,
+            gradients=None,
+            allocator=None):
+        '''
+        Compute in one call the field and gradient actuation matrices at
+        several positions, the currents and the resulting fields and
+        gradients. Without desired gradients the currents only generate the
+        desired fields.
+
+        :param fields: The desired magnetic fields, shape (3,) or (N, 3)
+        :type fields: ndarray
+        :param positions: The positions in the eMNS frame, shape (N, 3)
+        :type positions: ndarray
+        :param gradients: The desired gradients, shape (5,) or (N, 5)
+        :type gradients: ndarray
+        :param allocator: The current allocator, allocator if None
+        :type allocator: CurrentAllocator
+        :return: The actuation matrices (N, 8, num_coils), the currents
+            (N, num_coils) and the generated fields and gradients (N, 8)
+        :rtype: tuple[ndarray]
+        '''
+
+        allocator = allocator or self.allocator
+        actuation_matrices = allocator.get_matrices(positions)
+
+        if gradients is None:
+            currents = self.fields_to_currents(
+                fields, positions=positions,
+                bg_jacs=actuation_matrices[:, 0:3], allocator=allocator)
+        else:
+            currents = self.fields_gradients_to_currents(
+                fields, gradients, positions=positions,
+                actuation_matrices=actuation_matrices, allocator=allocator)
+
+        bg = np.einsum('nij,nj->ni', actuation_matrices, currents)
+
+        return actuation_matrices, currents, bg
+
+
+class AllocationResult():
+    '''
+    The result of a current allocation.
+
+    :param currents: The coil currents, shape (N, num_coils)
+    :type currents: ndarray
+    :param residual: The norm of the difference between the generated and the requested fields (and gradients), shape (N,)
+    :type residual: ndarray
+    :param saturated: True where the request is unreachable within the current limits, shape (N,)
+    :type saturated: ndarray
+    :param iterations: The iterations of the bounded solver, 0 if the unbounded solution was within the limits
+    :type iterations: int
+    '''
+
+    def __init__(
+            self,
+            currents,
+            residual,
+            saturated,
+            iterations=0):
+
+        self.currents = currents
+        self.residual = residual
+        self.saturated = saturated
+        self.iterations = iterations
+
+
+class CurrentAllocator():
+    '''
+    A class that computes the coil currents generating desired fields (and
+    gradients) at several positions in one call.
+    The actuation matrices and their pseudo-inverses can be cached per
+    position bucket. Currents are bounded by the coil limits with a
+    projected gradient solver warm-started from the previous solution.
+
+    :param e_mns: The object defining the eMNS
+    :param max_current: The maximal absolute current of the coils, a scalar or one value per coil (A). None for unbounded currents.
+    :type max_current: float
+    :param bucket_size: The edge length of the position buckets (m). The matrices of a bucket are evaluated at its center. None to evaluate them at every query.
+    :type bucket_size: float
+    :param cache_size: The maximal number of cached buckets
+    :type cache_size: int
+    :param max_iter: The maximal iterations of the bounded solver
+    :type max_iter: int
+    :param tol: The relative residual above which a bounded request is reported as saturated
+    :type tol: float
+    '''
+
+    def __init__(
+            self,
+            e_mns,
+            max_current=None,
+            bucket_size=None,
+            cache_size=4096,
+            max_iter=500,
+            tol=1e-6):
+
+        self.e_mns = e_mns
+        self.max_current = max_current
+        self.bucket_size = bucket_size
+        self.cache_size = cache_size
+        self.max_iter = max_iter
+        self.tol = tol
+
+        self.cache = OrderedDict()
+        self.warm_start = None
+        self.last_result = None
+
+    def clear(self):
+        ''' Drop the cached matrices and the warm start. '''
+
+        self.cache.clear()
+        self.warm_start = None
+
+    def _buckets(self, positions):
+        '''
+        Return the cache entries of the buckets of the positions, evaluating
+        the missing buckets in one batched call.
+        '''
+
+        keys = [tuple(key) for key in
+                np.floor(positions/self.bucket_size).astype(int)]
+
+        missing = list(OrderedDict.fromkeys(
+            key for key in keys if key not in self.cache))
+        if missing:
+            centers = (np.array(missing) + 0.5)*self.bucket_size
+            matrices = self.e_mns.get_actuation_matrices(centers)
+            for key, matrix in zip(missing, matrices):
+                self.cache[key] = {'matrix': matrix}
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        entries = []
+        for key in keys:
+            self.cache.move_to_end(key)
+            entries.append(self.cache[key])
+
+        return entries
+
+    @staticmethod
+    def _factorize(matrix):
+        ''' Pseudo-inverse and Lipschitz constant of a matrix. '''
+
+        return np.linalg.pinv(matrix), np.linalg.norm(matrix, 2)**2
+
+    def get_matrices(self, positions, num_rows=8):
+        '''
+        Return the actuation matrices at several positions, from the bucket
+        cache if enabled.
+
+        :param positions: The positions in the eMNS frame, shape (N, 3)
+        :type positions: ndarray
+        :param num_rows: 3 for the field rows only, 8 for field and gradient
+        :type num_rows: int
+        :return: The actuation matrices, shape (N, num_rows, num_coils)
+        :rtype: ndarray
+        '''
+
+        positions = np.atleast_2d(np.asarray(positions, dtype=float))
+
+        if self.bucket_size is None:
+            if num_rows == 3:
+                return self.e_mns.get_field_actuation_matrices(positions)
+            return self.e_mns.get_actuation_matrices(positions)
+
+        return np.stack([
+            entry['matrix'][0:num_rows]
+            for entry in self._buckets(positions)])
+
+    def _factorizations(self, positions, matrices):
+        '''
+        Return the pseudo-inverses and Lipschitz constants of the matrices,
+        from the bucket cache when the matrices come from it.
+        '''
+
+        num_rows = matrices.shape[1]
+
+        if self.bucket_size is None or positions is None:
+            pinvs = np.linalg.pinv(matrices)
+            lipschitz = np.linalg.norm(matrices, 2, axis=(1, 2))**2
+            return pinvs, lipschitz
+
+        pinvs = []
+        lipschitz = []
+        for entry in self._buckets(positions):
+            if num_rows not in entry:
+                entry[num_rows] = self._factorize(entry['matrix'][0:num_rows])
+            pinvs.append(entry[num_rows][0])
+            lipschitz.append(entry[num_rows][1])
+
+        return np.stack(pinvs), np.array(lipschitz)
+
+    def allocate(
+            self,
+            targets,
+            positions=None,
+            matrices=None):
+        '''
+        Compute the currents generating the desired targets.
+
+        :param targets: The desired fields (3,) or fields and gradients (8,), one row per position or a single row for all positions
+        :type targets: ndarray
+        :param positions: The positions in the eMNS frame, shape (N, 3)
+        :type positions: ndarray
+        :param matrices: Precomputed actuation matrices with as many rows as the targets, shape (N, 3 or 8, num_coils). If None, or if position buckets are cached, they are taken from the positions.
+        :type matrices: ndarray
+        :return: The allocation result, also stored in last_result
+        :rtype: AllocationResult
+        '''
+
+        targets = np.asarray(targets, dtype=float)
+        num_rows = targets.shape[-1]
+
+        if positions is not None:
+            positions = np.atleast_2d(np.asarray(positions, dtype=float))
+        if matrices is None or (
+                self.bucket_size is not None and positions is not None):
+            matrices = self.get_matrices(positions, num_rows=num_rows)
+
+        targets = np.broadcast_to(targets, matrices.shape[:2])
+
+        if self.bucket_size is None and num_rows == matrices.shape[2]:
+            # square system, solve without forming the inverse
+            currents = np.linalg.solve(matrices, targets[..., None])[..., 0]
+            lipschitz = None
+        else:
+            pinvs, lipschitz = self._factorizations(positions, matrices)
+            currents = np.einsum('nij,nj->ni', pinvs, targets)
+
+        iterations = 0
+        saturated = np.zeros(len(currents), dtype=bool)
+
+        if self.max_current is not None:
+            limit = np.broadcast_to(
+                np.asarray(self.max_current, dtype=float),
+                currents.shape[1:])
+            over = np.any(np.abs(currents) > limit, axis=1)
+
+            if np.any(over):
+                if lipschitz is None:
+                    lipschitz = np.linalg.norm(
+                        matrices[over], 2, axis=(1, 2))**2
+                else:
+                    lipschitz = lipschitz[over]
+
+                x0 = currents[over]
+                if (self.warm_start is not None
+                        and self.warm_start.shape == currents.shape):
+                    x0 = self.warm_start[over]
+
+                currents[over], iterations = self._bounded_lstsq(
+                    matrices[over], targets[over], lipschitz,
+                    np.clip(x0, -limit, limit), limit)
+
+                # the clipped requests that are not met are unreachable
+                error = (
+                    np.einsum('nij,nj->ni', matrices[over], currents[over])
+                    - targets[over])
+                saturated[over] = np.linalg.norm(error, axis=1) > self.tol*(
+                    np.linalg.norm(targets[over], axis=1))
+
+        error = np.einsum('nij,nj->ni', matrices, currents) - targets
+
+        self.warm_start = currents.copy()
+        self.last_result = AllocationResult(
+            currents=currents,
+            residual=np.linalg.norm(error, axis=1),
+            saturated=saturated,
+            iterations=iterations)
+
+        return self.last_result
+
+    def _bounded_lstsq(self, matrices, targets, lipschitz, x0, limit):
+        '''
+        Solve min |A x - b|^2 subject to |x| <= limit for a batch of
+        problems with accelerated projected gradient descent.
+        '''
+
+        x = x0
+        y = x0.copy()
+        t = 1.
+        step = 1./lipschitz[:, None]
+
+        for iteration in range(1, self.max_iter + 1):
+            error = np.einsum('nij,nj->ni', matrices, y) - targets
+            gradient = np.einsum('nji,nj->ni', matrices, error)
+            x_new = np.clip(y - step*gradient, -limit, limit)
+
+            t_new = 0.5*(1. + np.sqrt(1. + 4.*t*t))
+            y = x_new + ((t - 1.)/t_new)*(x_new - x)
+
+            converged = np.max(np.abs(x_new - x)) <= 1e-9*np.max(limit)
+            x, t = x_new, t_new
+            if converged:
+                break
 
-        return currents
+        return x, iteration
@@ -1,6 +1,11 @@
+import os
+
 import Sofa
+import numpy as np
 from scipy.spatial.transform import Rotation as R
 
+from mcr_sim import mcr_centerline, mcr_mesh, mcr_sdf
+
 
 class Environment(Sofa.Core.Controller):
     '''
@@ -19,6 +24,20 @@ class Environment(Sofa.Core.Controller):
     :type flip_normals: bool
     :param color: The color of environment used for visualization [r, g, b, alpha]
     :type color: list[float]
+    :param visual: A flag that builds the visual model of the environment
+    :type visual: bool
+    :param collision_triangles: The maximal number of triangles of the collision mesh, the visual mesh keeps the full resolution
+    :type collision_triangles: int
+    :param collision_tolerance: The maximal displacement of a vertex of the collision mesh by the decimation (m)
+    :type collision_tolerance: float
+    :param collision_primitives: The collision models added on the mesh, among 'triangle', 'line' and 'point'
+    :type collision_primitives: list[str]
+    :param collision_groups: The number of spatial groups the collision mesh is split into, each with its own collision models, so that mcr_collision.CollisionCulling can deactivate the groups far from the instrument. The mesh is then cached in the simulation frame as with mesh_cache.
+    :type collision_groups: int
+    :param mesh_cache: A flag that loads the mesh from a binary cache already expressed in the simulation frame instead of parsing the STL file
+    :type mesh_cache: bool
+    :param cache_dir: The directory where processed meshes are stored
+    :type cache_dir: str
     :param `*args`: The variable arguments are passed to the SofaCoreController
     :param `**kwargs`: The keyword arguments arguments are passed to the SofaCoreController
     '''
@@ -31,6 +50,13 @@ class Environment(Sofa.Core.Controller):
            T_env_sim=[0., 0., 0., 1., 0., 0., 0.],
            flip_normals=False,
            color=[1., 0., 0., 0.3],
+           visual=True,
+           collision_triangles=None,
+           collision_tolerance=None,
+           collision_primitives=('triangle', 'line', 'point'),
+           collision_groups=1,
+           mesh_cache=False,
+           cache_dir=os.path.join('~', '.cache', 'mcr_sim'),
            *args, **kwargs):
 
         # These are needed (and the normal way to override from a python class)
@@ -41,6 +67,13 @@ class Environment(Sofa.Core.Controller):
         self.name_env = name
 
         self.color = color
+        self.visual = visual
+        self.flip_normals = flip_normals
+        self.cache_dir = cache_dir
+        self.distance_field = None
+        self.centerline = None
+        self.group_lower = None
+        self.group_upper = None
 
         self.T_env_sim = T_env_sim
         r = R.from_quat(self.T_env_sim[3:7])
@@ -48,43 +81,193 @@ class Environment(Sofa.Core.Controller):
 
         # collision model environment
         self.CollisionModel = root_node.addChild('CollisionModel')
-        self.CollisionModel.addObject(
-            'MeshSTLLoader',
-            filename=self.environment_stl,
-            flipNormals=flip_normals,
-            triangulate=True,
-            name='meshLoader',
-            rotation=rot_env_sim,
-            translation=self.T_env_sim[0:2],
-            scale='0.001')
-        self.CollisionModel.addObject(
+
+        # the meshes are prepared in the simulation frame, the loader is
+        # then not needed
+        self.simulation_mesh = None
+        if mesh_cache or collision_groups > 1:
+            self.simulation_mesh = mcr_mesh.SimulationMesh(
+                environment_stl=self.environment_stl,
+                T_env_sim=self.T_env_sim,
+                flip_normals=flip_normals,
+                cache_dir=cache_dir)
+
+        self.collision_mesh = None
+        if collision_triangles is not None or collision_tolerance is not None:
+            self.collision_mesh = mcr_mesh.CollisionMesh(
+                environment_stl=self.environment_stl,
+                T_env_sim=self.T_env_sim,
+                flip_normals=flip_normals,
+                target_triangles=collision_triangles,
+                tolerance=collision_tolerance,
+                cache_dir=cache_dir,
+                source=self.simulation_mesh)
+
+        if self.simulation_mesh is None and (
+                self.collision_mesh is None or self.visual):
+            self.CollisionModel.addObject(
+                'MeshSTLLoader',
+                filename=self.environment_stl,
+                flipNormals=flip_normals,
+                triangulate=True,
+                name='meshLoader',
+                rotation=rot_env_sim,
+                translation=self.T_env_sim[0:3],
+                scale='0.001')
+
+        collision_mesh = self.collision_mesh or self.simulation_mesh
+        if collision_groups > 1:
+            groups, self.group_lower, self.group_upper = mcr_mesh.partition(
+                np.asarray(collision_mesh.vertices),
+                np.asarray(collision_mesh.faces), collision_groups)
+            self.collision_groups = [
+                self._add_collision_models(
+                    self.CollisionModel.addChild('group_{:d}'.format(i)),
+                    collision_primitives, vertices, faces)
+                for i, (vertices, faces) in enumerate(groups)]
+        elif collision_mesh is None:
+            self.collision_groups = [self._add_collision_models(
+                self.CollisionModel, collision_primitives,
+                '@meshLoader.position', '@meshLoader.triangles')]
+        else:
+            self.collision_groups = [self._add_collision_models(
+                self.CollisionModel, collision_primitives,
+                np.asarray(collision_mesh.vertices),
+                np.asarray(collision_mesh.faces))]
+        self.collision_models = [
+            model for group in self.collision_groups for model in group]
+
+        # # visual model environment
+        if self.visual:
+            VisuModel = self.CollisionModel.addChild(
+                'VisuModel')
+            if self.simulation_mesh is None:
+                VisuModel.addObject(
+                    'OglModel',
+                    name="VisualOgl_model",
+                    src='@../meshLoader',
+                    color=self.color)
+            else:
+                VisuModel.addObject(
+                    'OglModel',
+                    name="VisualOgl_model",
+                    position=np.asarray(self.simulation_mesh.vertices),
+                    triangles=np.asarray(self.simulation_mesh.faces),
+                    color=self.color)
+
+    @staticmethod
+    def _add_collision_models(node, collision_primitives, position, triangles):
+        '''
+        Add a collision mesh and its collision models to a node.
+
+        :return: The collision models
+        :rtype: list
+        '''
+
+        node.addObject(
             'Mesh',
-            position='@meshLoader.position',
-            triangles='@meshLoader.triangles',
+            position=position,
+            triangles=triangles,
             drawTriangles='0')
-        self.CollisionModel.addObject(
+        node.addObject(
             'MechanicalObject',
             position=[0, 0, 0],
             scale=1,
             name='DOFs1')
-        self.CollisionModel.addObject(
-            'TriangleCollisionModel',
-            moving=False,
-            simulated=False)
-        self.CollisionModel.addObject(
-            'LineCollisionModel',
-            moving=False,
-            simulated=False)
-        self.CollisionModel.addObject(
-            'PointCollisionModel',
-            moving=False,
-            simulated=False)
 
-        # # visual model environment
-        VisuModel = self.CollisionModel.addChild(
-            'VisuModel')
-        VisuModel.addObject(
-            'OglModel',
-            name="VisualOgl_model",
-            src='@../meshLoader',
-            color=self.color)
+        collision_types = {
+            'triangle': ('TriangleCollisionModel', 'collisTriangle'),
+            'line': ('LineCollisionModel', 'collisLine'),
+            'point': ('PointCollisionModel', 'collisPoint'),
+            }
+
+        return [
+            node.addObject(
+                collision_types[primitive][0],
+                name=collision_types[primitive][1],
+                moving=False,
+                simulated=False)
+            for primitive in collision_primitives]
+
+    def enable_distance_field(self, spacing=0.002, padding=0.01):
+        '''
+        Sample the signed distance to the full resolution mesh on a grid,
+        which is cached on disk. The distance is positive on the side the
+        triangle normals point to, i.e. in the lumen of the anatomies.
+
+        :param spacing: The distance between grid nodes (m)
+        :type spacing: float
+        :param padding: The margin of the grid around the mesh (m)
+        :type padding: float
+        :return: The distance field
+        :rtype: mcr_sdf.DistanceField
+        '''
+
+        mesh = self.simulation_mesh
+        if mesh is None:
+            mesh = mcr_mesh.SimulationMesh(
+                environment_stl=self.environment_stl,
+                T_env_sim=self.T_env_sim,
+                flip_normals=self.flip_normals,
+                cache_dir=self.cache_dir)
+
+        self.distance_field = mcr_sdf.DistanceField(
+            vertices=mesh.vertices,
+            faces=mesh.faces,
+            spacing=spacing,
+            padding=padding,
+            cache_dir=self.cache_dir)
+
+        return self.distance_field
+
+    def distance(self, points):
+        '''
+        Return the signed distances of points in the simulation frame to the
+        walls of the environment (m). The distance field is built with the
+        default parameters if it is not enabled.
+
+        :param points: The points, shape (N, 3)
+        :type points: ndarray
+        :rtype: ndarray
+        '''
+
+        if self.distance_field is None:
+            self.enable_distance_field()
+
+        return self.distance_field.distance(points)
+
+    def enable_centerline(self, start, **kwargs):
+        '''
+        Extract the centerline of the vessel from the distance field, which
+        is built with the default parameters if it is not enabled. The
+        centerline is cached on disk.
+
+        :param start: The start point of the centerline in the simulation frame, usually the insertion point
+        :type start: list[float]
+        :param `**kwargs`: The keyword arguments are passed to mcr_centerline.Centerline
+        :return: The centerline
+        :rtype: mcr_centerline.Centerline
+        '''
+
+        if self.distance_field is None:
+            self.enable_distance_field()
+
+        self.centerline = mcr_centerline.Centerline(
+            self.distance_field, start, cache_dir=self.cache_dir, **kwargs)
+
+        return self.centerline
+
+    def progress(self, points):
+        '''
+        Return the arc length along the centerline of the projection of
+        points in the simulation frame (m).
+
+        :param points: The points, shape (..., 3)
+        :type points: ndarray
+        :rtype: ndarray
+        '''
+
+        if self.centerline is None:
+            raise RuntimeError('The centerline is not enabled')
+
+        return self.centerline.progress(points)
@@ -0,0 +1,261 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+from scipy import ndimage
+
+
+class ActuationGrid():
+    '''
+    A class that samples the field and gradient actuation matrix of an eMNS
+    once on a regular 3D grid and answers queries by interpolation.
+    The grid is stored as a .npy file keyed by the hash of the calibration
+    file and the grid parameters, and is memory-mapped when loaded so that
+    several processes share one copy.
+
+    :param actuation_function: A function returning the (N, 8, num_coils)
+        actuation matrices of the model at (N, 3) positions
+    :type actuation_function: callable
+    :param calibration_path: The path to the eMNS calibration file
+    :type calibration_path: str
+    :param center: The center of the grid in the eMNS frame (m)
+    :type center: list[float]
+    :param half_extent: The half size of the grid along each axis (m)
+    :type half_extent: float
+    :param spacing: The distance between grid nodes (m)
+    :type spacing: float
+    :param order: The interpolation order, 1 (trilinear) or 3 (tricubic)
+    :type order: int
+    :param cache_dir: The directory where grids are stored
+    :type cache_dir: str
+    :param tag: An additional string in the cache key, e.g. the model backend
+    :type tag: str
+    '''
+
+    def __init__(
+            self,
+            actuation_function,
+            calibration_path,
+            center=[0., 0., 0.],
+            half_extent=0.1,
+            spacing=0.005,
+            order=1,
+            cache_dir=os.path.join('~', '.cache', 'mcr_sim'),
+            tag=''):
+
+        if order not in (1, 3):
+            raise ValueError('The interpolation order must be 1 or 3')
+
+        self.actuation_function = actuation_function
+        self.calibration_path = calibration_path
+        self.order = order
+        self.spacing = float(spacing)
+        self.cache_dir = os.path.expanduser(cache_dir)
+
+        half_extent = np.broadcast_to(
+            np.asarray(half_extent, dtype=float), (3,))
+        num_cells = np.ceil(2.*half_extent/self.spacing)
+
+        # queries are answered inside [lower, upper], the cubic splines
+        # get extra nodes sampled from the model around this region. The
+        # mirror boundary condition of the spline filter perturbs the
+        # coefficients by a factor 2 - sqrt(3) ~ 0.27 per node inwards, 11
+        # nodes bring it below 1e-6 of its size at the edge of the region
+        self.lower = (
+            np.asarray(center, dtype=float) - 0.5*self.spacing*num_cells)
+        self.upper = self.lower + self.spacing*num_cells
+
+        pad = 11 if order == 3 else 0
+        self.shape = tuple(int(n) + 1 + 2*pad for n in num_cells)
+        self.origin = self.lower - pad*self.spacing
+
+        with open(calibration_path, 'rb') as f:
+            calibration_hash = hashlib.sha1(f.read()).hexdigest()
+        key = hashlib.sha1(json.dumps([
+            calibration_hash, tag, self.origin.round(9).tolist(),
+            self.shape, self.spacing, order]).encode()).hexdigest()[:16]
+
+        self.grid_path = os.path.join(self.cache_dir, key + '.npy')
+        self.meta_path = os.path.join(self.cache_dir, key + '.json')
+
+        if not (os.path.exists(self.grid_path)
+                and os.path.exists(self.meta_path)):
+            self._build()
+
+        self.values = np.load(self.grid_path, mmap_mode='r')
+        with open(self.meta_path, 'r') as f:
+            self.error_bound = json.load(f)['error_bound']
+
+    def _nodes(self):
+        ''' Return the positions of all grid nodes, shape (nx, ny, nz, 3). '''
+
+        axes = [
+            self.origin[i] + self.spacing*np.arange(self.shape[i])
+            for i in range(3)]
+
+        return np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1)
+
+    def _build(self):
+        '''
+        Sample the model on the grid, estimate the interpolation error and
+        store both in the cache directory.
+        '''
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        nodes = self._nodes().reshape(-1, 3)
+        values = self.actuation_function(nodes)
+        values = values.reshape(self.shape + values.shape[1:])
+
+        if self.order == 3:
+            # store the spline coefficients so that queries skip the filter
+            for axis in range(3):
+                values = ndimage.spline_filter1d(
+                    values, order=3, axis=axis, mode='mirror')
+
+        # write to temporary files first so that concurrent workers never
+        # load a partially written grid
+        pid = '.' + str(os.getpid()) + '.tmp'
+        np.save(self.grid_path + pid + '.npy', values)
+        os.replace(self.grid_path + pid + '.npy', self.grid_path)
+
+        self.values = np.load(self.grid_path, mmap_mode='r')
+        self.error_bound = self._estimate_error()
+
+        with open(self.meta_path + pid, 'w') as f:
+            json.dump({
+                'calibration_path': self.calibration_path,
+                'origin': self.origin.tolist(),
+                'shape': list(self.shape),
+                'spacing': self.spacing,
+                'order': self.order,
+                'error_bound': self.error_bound}, f, indent=2)
+        os.replace(self.meta_path + pid, self.meta_path)
+
+    def _estimate_error(self, num_samples=2000, seed=0):
+        '''
+        Estimate the interpolation error at cell centers, where it is the
+        largest for trilinear interpolation, at random points, and at random
+        points of the boundary cells, where the interpolation of the cubic
+        splines is the least accurate.
+
+        :return: The maximal absolute error of the field rows (T/A) and of
+            the gradient rows (T/m/A), and the maximal error relative to the
+            largest entry of each block, over all points and separately for
+            the 'interior' and 'boundary' cells
+        :rtype: dict
+        '''
+
+        rng = np.random.default_rng(seed)
+        cells = np.round((self.upper - self.lower)/self.spacing).astype(int)
+        index = rng.integers(0, cells, size=(num_samples, 3))
+        centers = self.lower + self.spacing*(index + 0.5)
+        random = rng.uniform(self.lower, self.upper, size=(num_samples, 3))
+        positions = np.concatenate((centers, random))
+
+        # move one coordinate of random points into the first or last cell
+        boundary = rng.uniform(self.lower, self.upper, size=(num_samples, 3))
+        axis = rng.integers(0, 3, size=num_samples)
+        offset = rng.uniform(0., self.spacing, size=num_samples)
+        boundary[np.arange(num_samples), axis] = np.where(
+            rng.integers(0, 2, size=num_samples) == 1,
+            self.upper[axis] - offset, self.lower[axis] + offset)
+        positions = np.concatenate((positions, boundary))
+
+        exact = self.actuation_function(positions)
+        error = np.abs(self.interpolate(positions) - exact)
+
+        field_scale = np.max(np.abs(exact[:, 0:3]))
+        gradient_scale = np.max(np.abs(exact[:, 3:]))
+
+        def summary(error):
+            return {
+                'field_abs': float(np.max(error[:, 0:3])),
+                'field_rel': float(np.max(error[:, 0:3])/field_scale),
+                'gradient_abs': float(np.max(error[:, 3:])),
+                'gradient_rel': float(np.max(error[:, 3:])/gradient_scale),
+                }
+
+        # a point is in a boundary cell if it is within a cell of a face
+        in_boundary = np.any(
+            (positions < self.lower + self.spacing)
+            | (positions > self.upper - self.spacing), axis=1)
+
+        error_bound = summary(error)
+        error_bound['interior'] = summary(error[~in_boundary])
+        error_bound['boundary'] = summary(error[in_boundary])
+
+        return error_bound
+
+    def contains(self, positions):
+        '''
+        Return a mask of the positions lying inside the grid.
+        '''
+
+        positions = np.atleast_2d(positions)
+
+        return np.all(
+            (positions >= self.lower) & (positions <= self.upper), axis=1)
+
+    def interpolate(self, positions):
+        '''
+        Interpolate the actuation matrices at positions inside the grid.
+
+        :param positions: The positions in the eMNS frame, shape (N, 3)
+        :type positions: ndarray
+        :return: The actuation matrices, shape (N, 8, num_coils)
+        :rtype: ndarray
+        '''
+
+        positions = np.atleast_2d(np.asarray(positions, dtype=float))
+        u = (positions - self.origin)/self.spacing
+
+        if self.order == 3:
+            num_values = self.values.shape[3:]
+            values = np.empty((len(u),) + num_values)
+            for index in np.ndindex(*num_values):
+                values[(slice(None),) + index] = ndimage.map_coordinates(
+                    self.values[(Ellipsis,) + index], u.T,
+                    order=3, mode='mirror', prefilter=False)
+            return values
+
+        i0 = np.clip(
+            np.floor(u).astype(int), 0, np.array(self.shape) - 2)
+        t = u - i0
+
+        values = 0.
+        for dx in (0, 1):
+            wx = t[:, 0] if dx else 1. - t[:, 0]
+            for dy in (0, 1):
+                wy = t[:, 1] if dy else 1. - t[:, 1]
+                for dz in (0, 1):
+                    wz = t[:, 2] if dz else 1. - t[:, 2]
+                    corner = self.values[
+                        i0[:, 0] + dx, i0[:, 1] + dy, i0[:, 2] + dz]
+                    values = values + (wx*wy*wz)[:, None, None]*corner
+
+        return values
+
+    def get_actuation_matrices(self, positions):
+        '''
+        Return the actuation matrices at several positions. Positions outside
+        the grid are evaluated with the model.
+
+        :param positions: The positions in the eMNS frame, shape (N, 3)
+        :type positions: ndarray
+        :return: The actuation matrices, shape (N, 8, num_coils)
+        :rtype: ndarray
+        '''
+
+        positions = np.atleast_2d(np.asarray(positions, dtype=float))
+        inside = self.contains(positions)
+
+        if np.all(inside):
+            return self.interpolate(positions)
+
+        values = np.empty((len(positions),) + self.values.shape[3:])
+        values[inside] = self.interpolate(positions[inside])
+        values[~inside] = self.actuation_function(positions[~inside])
+
+        return values
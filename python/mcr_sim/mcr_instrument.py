@@ -1,6 +1,8 @@
 import Sofa
 import numpy as np
 
+from mcr_sim import mcr_magnet, mcr_settle
+
 
 class Instrument(Sofa.Core.Controller):
     '''
@@ -8,7 +10,7 @@ class Instrument(Sofa.Core.Controller):
     collision and visual models of the magnetic instrument.
 
     :param root_node: The sofa root node
-    :param magnets: ...
+    :param magnets: The magnets per element of the distal segment, 0. for non-magnetic elements
     :type magnets: list[magnet]
     :param name: The name of the instrument object
     :type name: str
@@ -36,6 +38,10 @@ class Instrument(Sofa.Core.Controller):
     :type fixed_directions: list[int]
     :param color: The color of instrument used for visualization [r, g, b, alpha]
     :type color: list[float]
+    :param visual: A flag that builds the visual models and mappings of the instrument. Without them, the tip pose is available through tip_pose().
+    :type visual: bool
+    :param settled_state: A settled state of the instrument from mcr_settle, or the path to its file. The nodes start at its poses and the instrument at its inserted length instead of being inserted from the start pose.
+    :type settled_state: dict or str
     :param `*args`: The variable arguments are passed to the SofaCoreController
     :param `**kwargs`: The keyword arguments arguments are passed to the SofaCoreController
     '''
@@ -57,6 +63,8 @@ class Instrument(Sofa.Core.Controller):
             T_start_sim=[0., 0., 0., 0., 0., 0., 1.],
             fixed_directions=[0, 0, 0, 0, 0, 0],
             color=[0.2, .8, 1., 1.],
+            visual=True,
+            settled_state=None,
             *args, **kwargs):
 
         # These are needed (and the normal way to override from a python class)
@@ -65,7 +73,8 @@ class Instrument(Sofa.Core.Controller):
         self.root_node = root_node
 
         self.magnets = magnets
-        self.index_mag = np.nonzero(self.magnets)[0]
+        self.magnet_table = mcr_magnet.MagnetTable(magnets)
+        self.index_mag = self.magnet_table.index
         self.outer_diam = outer_diam
         self.inner_diam = inner_diam
         self.num_elem_body = num_elem_body
@@ -74,6 +83,11 @@ class Instrument(Sofa.Core.Controller):
         self.insertion_len = 0.
 
         self.color = color
+        self.visual = visual
+
+        if isinstance(settled_state, str):
+            settled_state = mcr_settle.load_state(settled_state)
+        self.settled_state = settled_state
 
         # the inner diameter of the beam is not accounted for to
         # compute the stiffness:
@@ -157,7 +171,21 @@ class Instrument(Sofa.Core.Controller):
 
         indicesList = list(range(0, self.num_elem_body+self.num_elem_tip))
 
-        self.MO.rest_position.value = restPos
+        if self.settled_state is None:
+            self.MO.rest_position.value = restPos
+            xtip = 0.001
+        else:
+            positions = self.settled_state['positions']
+            if len(positions) != len(restPos):
+                raise ValueError(
+                    'The settled state holds {:d} instrument nodes, the '
+                    'instrument {:d}'.format(len(positions), len(restPos)))
+            rest_positions = self.settled_state['rest_positions']
+            self.MO.rest_position.value = (
+                restPos if rest_positions is None
+                else np.asarray(rest_positions).tolist())
+            self.MO.position.value = np.asarray(positions).tolist()
+            xtip = self.settled_state['xtip']
 
         self.IC = self.InstrumentCombined.addObject(
             'WireBeamInterpolation',
@@ -178,16 +206,18 @@ class Instrument(Sofa.Core.Controller):
             forces=forcesList,
             indexFromEnd=True)
 
-        self.CFF_visu = self.InstrumentCombined.addObject(
-            'ConstantForceField',
-            name='ConstantForceFieldViz',
-            indices=0,
-            force='0 0 0 0 0 0',
-            showArrowSize=1.e2)
+        self.CFF_visu = None
+        if self.visual:
+            self.CFF_visu = self.InstrumentCombined.addObject(
+                'ConstantForceField',
+                name='ConstantForceFieldViz',
+                indices=0,
+                force='0 0 0 0 0 0',
+                showArrowSize=1.e2)
 
         self.IRC = self.InstrumentCombined.addObject(
             'InterventionalRadiologyController',
-            xtip=[0.001], name='m_ircontroller',
+            xtip=[xtip], name='m_ircontroller',
             instruments='InterpolGuide',
             step=0.0007,
             printLog=True,
@@ -239,68 +269,85 @@ class Instrument(Sofa.Core.Controller):
             controller='../m_ircontroller',
             useCurvAbs=True, printLog=False,
             name='collisMap')
-        Collis.addObject(
-            'LineCollisionModel',
-            proximity=0.0,
-            group=1)
-        Collis.addObject(
-            'PointCollisionModel',
-            proximity=0.0,
-            group=1)
-
-        # VISU ROS
-        CathVisuROS = self.InstrumentCombined.addChild(
-            'CathVisuROS')
-        CathVisuROS.addObject(
-            'RegularGrid',
-            name='meshLinesCombined',
-            zmax=0., zmin=0., nx=nume_nodes_viz, ny=1, nz=1,
-            xmax=1., xmin=0.0, ymin=0.0, ymax=0.0)
-        self.MO_visu = CathVisuROS.addObject(
-            'MechanicalObject',
-            name='ROSCatheterVisu',
-            template='Rigid3d')
-        CathVisuROS.addObject(
-            'AdaptiveBeamMapping',
-            interpolation='@../InterpolGuide',
-            printLog='1',
-            useCurvAbs='1')
-
-        # visualization sofa
-        CathVisu = self.InstrumentCombined.addChild(name+'_viz')
-        CathVisu.addObject('MechanicalObject', name='QuadsCatheter')
-        CathVisu.addObject('QuadSetTopologyContainer', name='ContainerCath')
-        CathVisu.addObject('QuadSetTopologyModifier', name='Modifier')
-        CathVisu.addObject( 
-            'QuadSetGeometryAlgorithms',
-            name='GeomAlgo',
-            template='Vec3d')
-        CathVisu.addObject(
-            'Edge2QuadTopologicalMapping',
-            flipNormals='true',
-            input='@../../'+name+'_topo_lines'+'/meshLinesGuide',
-            nbPointsOnEachCircle='10',
-            output='@ContainerCath',
-            radius=self.outer_diam_qu/2,
-            tags='catheter')
-        CathVisu.addObject(
-            'AdaptiveBeamMapping',
-            interpolation='@../InterpolTube0',
-            input='@../DOFs',
-            isMechanical='false',
-            name='VisuMapCath',
-            output='@QuadsCatheter',
-            printLog='1',
-            useCurvAbs='1')
-        VisuOgl = CathVisu.addChild('VisuOgl')
-        VisuOgl.addObject(
-            'OglModel',
-            quads='@../ContainerCath.quads',
-            color=self.color,
-            material='texture Ambient 1 0.2 0.2 0.2 0.0 Diffuse 1 1.0 1.0 1.0 1.0 Specular 1 1.0 1.0 1.0 1.0 Emissive 0 0.15 0.05 0.05 0.0 Shininess 1 20',
-            name='VisualCatheter')
-        VisuOgl.addObject(
-            'IdentityMapping',
-            input='@../QuadsCatheter',
-            output='@VisualCatheter',
-            name='VisuCathIM')
+        self.collision_models = [
+            Collis.addObject(
+                'LineCollisionModel',
+                name='collisLine',
+                proximity=0.0,
+                group=1),
+            Collis.addObject(
+                'PointCollisionModel',
+                name='collisPoint',
+                proximity=0.0,
+                group=1)]
+
+        # visual models
+        self.MO_visu = None
+        if self.visual:
+
+            # VISU ROS
+            CathVisuROS = self.InstrumentCombined.addChild(
+                'CathVisuROS')
+            CathVisuROS.addObject(
+                'RegularGrid',
+                name='meshLinesCombined',
+                zmax=0., zmin=0., nx=nume_nodes_viz, ny=1, nz=1,
+                xmax=1., xmin=0.0, ymin=0.0, ymax=0.0)
+            self.MO_visu = CathVisuROS.addObject(
+                'MechanicalObject',
+                name='ROSCatheterVisu',
+                template='Rigid3d')
+            CathVisuROS.addObject(
+                'AdaptiveBeamMapping',
+                interpolation='@../InterpolGuide',
+                printLog='1',
+                useCurvAbs='1')
+
+            # visualization sofa
+            CathVisu = self.InstrumentCombined.addChild(name+'_viz')
+            CathVisu.addObject('MechanicalObject', name='QuadsCatheter')
+            CathVisu.addObject('QuadSetTopologyContainer', name='ContainerCath')
+            CathVisu.addObject('QuadSetTopologyModifier', name='Modifier')
+            CathVisu.addObject( 
+                'QuadSetGeometryAlgorithms',
+                name='GeomAlgo',
+                template='Vec3d')
+            CathVisu.addObject(
+                'Edge2QuadTopologicalMapping',
+                flipNormals='true',
+                input='@../../'+name+'_topo_lines'+'/meshLinesGuide',
+                nbPointsOnEachCircle='10',
+                output='@ContainerCath',
+                radius=self.outer_diam_qu/2,
+                tags='catheter')
+            CathVisu.addObject(
+                'AdaptiveBeamMapping',
+                interpolation='@../InterpolTube0',
+                input='@../DOFs',
+                isMechanical='false',
+                name='VisuMapCath',
+                output='@QuadsCatheter',
+                printLog='1',
+                useCurvAbs='1')
+            VisuOgl = CathVisu.addChild('VisuOgl')
+            VisuOgl.addObject(
+                'OglModel',
+                quads='@../ContainerCath.quads',
+                color=self.color,
+                material='texture Ambient 1 0.2 0.2 0.2 0.0 Diffuse 1 1.0 1.0 1.0 1.0 Specular 1 1.0 1.0 1.0 1.0 Emissive 0 0.15 0.05 0.05 0.0 Shininess 1 20',
+                name='VisualCatheter')
+            VisuOgl.addObject(
+                'IdentityMapping',
+                input='@../QuadsCatheter',
+                output='@VisualCatheter',
+                name='VisuCathIM')
+
+    def tip_pose(self):
+        '''
+        Return the pose of the instrument tip in the simulation frame
+        [x, y, z, qx, qy, qz, qw].
+
+        :rtype: ndarray
+        '''
+
+        return np.array(self.MO.position.value[-1])
@@ -0,0 +1,366 @@
+import contextlib
+import multiprocessing
+import os
+import time
+
+import numpy as np
+from scipy.spatial.transform import Rotation as R
+
+from mcr_sim import mcr_checkpoint
+
+# inputs of the Jacobian, its columns: the components of the desired field of
+# the MagController (T) and the inserted length (m)
+INPUTS = ('field_x', 'field_y', 'field_z', 'insertion')
+
+# outputs of the Jacobian, its rows: the tip position (m) and the rotation
+# vector of the tip orientation (rad)
+OUTPUTS = ('x', 'y', 'z', 'rx', 'ry', 'rz')
+
+
+def perturbations(field_step=1e-3, insertion_step=1e-3, central=True):
+    '''
+    Return the perturbations of the inputs of the rollouts of a Jacobian,
+    the nominal rollout first for forward differences.
+
+    :param field_step: The perturbation of each field component (T)
+    :type field_step: float
+    :param insertion_step: The perturbation of the inserted length (m)
+    :type insertion_step: float
+    :param central: A flag that uses central instead of forward differences
+    :type central: bool
+    :return: The perturbations, shape (8, 4) for central differences, (5, 4) for forward differences
+    :rtype: ndarray
+    '''
+
+    steps = np.diag([field_step, field_step, field_step, insertion_step])
+    if central:
+        return np.vstack((steps, -steps))
+
+    return np.vstack((np.zeros(len(INPUTS)), steps))
+
+
+def pose_difference(pose, reference):
+    '''
+    Return the difference between two tip poses [x, y, z, qx, qy, qz, qw]:
+    the position difference and the rotation vector from the reference
+    orientation to the orientation of the pose, in the simulation frame.
+
+    :rtype: ndarray
+    '''
+
+    rotation = R.from_quat(pose[3:7])*R.from_quat(reference[3:7]).inv()
+
+    return np.concatenate((pose[0:3] - reference[0:3], rotation.as_rotvec()))
+
+
+def assemble(poses, perturbation, central=True):
+    '''
+    Return the finite-difference Jacobian from the tip poses of the
+    rollouts of perturbations().
+
+    :param poses: The tip pose at the end of each rollout, shape (M, 7)
+    :type poses: ndarray
+    :param perturbation: The perturbations of the rollouts, shape (M, 4)
+    :type perturbation: ndarray
+    :param central: A flag for central differences
+    :type central: bool
+    :return: The Jacobian, shape (6, 4)
+    :rtype: ndarray
+    '''
+
+    n = len(INPUTS)
+    jacobian = np.empty((len(OUTPUTS), n))
+    for i in range(n):
+        if central:
+            difference = pose_difference(poses[i], poses[n + i])
+            step = perturbation[i, i] - perturbation[n + i, i]
+        else:
+            difference = pose_difference(poses[1 + i], poses[0])
+            step = perturbation[1 + i, i]
+        jacobian[:, i] = difference/step
+
+    return jacobian
+
+
+def conditioning(jacobian, input_scale=None, output_scale=None):
+    '''
+    Return the singular values and the condition number of a Jacobian. The
+    inputs and outputs have different units, the columns are multiplied by
+    input_scale and the rows divided by output_scale before the
+    decomposition, for instance by the range of each input and the
+    tolerance of each output.
+
+    :param jacobian: The Jacobian, shape (6, 4)
+    :type jacobian: ndarray
+    :param input_scale: The scale of each input, ones if None
+    :type input_scale: list[float]
+    :param output_scale: The scale of each output, ones if None
+    :type output_scale: list[float]
+    :return: The singular values, in decreasing order, and the condition number (inf if rank deficient)
+    :rtype: tuple
+    '''
+
+    scaled = np.asarray(jacobian, dtype=float)
+    if input_scale is not None:
+        scaled = scaled*np.asarray(input_scale, dtype=float)[np.newaxis, :]
+    if output_scale is not None:
+        scaled = scaled/np.asarray(output_scale, dtype=float)[:, np.newaxis]
+
+    singular_values = np.linalg.svd(scaled, compute_uv=False)
+    if singular_values[-1] <= 0.:
+        return singular_values, np.inf
+
+    return singular_values, float(singular_values[0]/singular_values[-1])
+
+
+def rollout(scene, checkpoint, perturbation, steps):
+    '''
+    Restore a checkpoint in a scene, perturb the desired field and the
+    inserted length, and simulate a number of steps.
+
+    :param scene: The scene
+    :type scene: mcr_scene.Scene
+    :param checkpoint: The state the rollout starts from
+    :type checkpoint: mcr_checkpoint.Checkpoint
+    :param perturbation: The perturbation [field_x, field_y, field_z, insertion]
+    :type perturbation: ndarray
+    :param steps: The number of simulation steps
+    :type steps: int
+    :return: The tip pose at the end of the rollout
+    :rtype: ndarray
+    '''
+
+    import Sofa.Simulation
+
+    checkpoint.restore(scene)
+    scene.mag_controller.field_des = (
+        scene.mag_controller.field_des + perturbation[0:3])
+    scene.set_insertion_length(scene.insertion_length() + perturbation[3])
+
+    root_node = scene.root_node
+    for i in range(steps):
+        # the time step may change between steps, see mcr_time_step
+        Sofa.Simulation.animate(root_node, root_node.dt.value)
+
+    return scene.instrument.tip_pose()
+
+
+@contextlib.contextmanager
+def suspended(scene):
+    '''
+    Suspend the command player, the recorder and the profiler of a scene,
+    which would replace the perturbed inputs and log the rollouts, and
+    restore the python state of its solver monitor, adaptive time step and
+    collision culling at the exit, so that the rollouts leave no trace in
+    their logs.
+
+    :param scene: The scene
+    :type scene: mcr_scene.Scene
+    '''
+
+    listeners = [
+        controller for controller in (
+            scene.controller_sofa.command_player, scene.recorder,
+            scene.profiler)
+        if controller is not None]
+    monitors = [
+        controller for controller in (
+            scene.solver_monitor, scene.time_step, scene.culling)
+        if controller is not None]
+
+    states = [dict(vars(controller)) for controller in monitors]
+    for controller in listeners:
+        controller.listening.value = False
+
+    try:
+        yield
+    finally:
+        for controller in listeners:
+            controller.listening.value = True
+        for controller, state in zip(monitors, states):
+            vars(controller).update(state)
+        if scene.culling is not None:
+            scene.culling.apply()
+
+
+def jacobian(
+        scene, steps=20, field_step=1e-3, insertion_step=1e-3,
+        central=True):
+    '''
+    Estimate the Jacobian of the tip pose with respect to the desired field
+    and the inserted length from the current state of a scene, with serial
+    rollouts in the scene. The scripted commands, the recorder and the
+    profiler are suspended during the rollouts, see suspended, and the
+    scene is restored to its state at the end.
+
+    :param scene: The scene, after a step
+    :type scene: mcr_scene.Scene
+    :param steps: The number of simulation steps of each rollout
+    :type steps: int
+    :param field_step: The perturbation of each field component (T)
+    :type field_step: float
+    :param insertion_step: The perturbation of the inserted length (m)
+    :type insertion_step: float
+    :param central: A flag that uses central instead of forward differences
+    :type central: bool
+    :return: The Jacobian, its singular values and condition number, the tip pose of the state and the wall time (s), see JacobianEstimator.estimate
+    :rtype: dict
+    '''
+
+    start = time.perf_counter()
+    checkpoint = mcr_checkpoint.Checkpoint.capture(scene)
+    tip_pose = scene.instrument.tip_pose()
+
+    perturbation = perturbations(field_step, insertion_step, central)
+    with suspended(scene):
+        poses = np.array([
+            rollout(scene, checkpoint, p, steps) for p in perturbation])
+        checkpoint.restore(scene)
+
+    return _result(
+        assemble(poses, perturbation, central), perturbation, tip_pose,
+        time.perf_counter() - start)
+
+
+def _result(jacobian, perturbation, tip_pose, wall_time):
+
+    singular_values, condition = conditioning(
+        jacobian, np.max(np.abs(perturbation), axis=0))
+
+    return {
+        'jacobian': jacobian,
+        'singular_values': singular_values,
+        'condition': condition,
+        'tip_pose': tip_pose,
+        'wall_time': wall_time,
+        }
+
+
+# scene of a worker process of a JacobianEstimator, built once
+_worker_scene = None
+
+
+def _init_worker(checkpoint_bytes, builder):
+    ''' Build the scene of a worker process from a checkpoint. '''
+
+    global _worker_scene
+    from mcr_sim import run
+
+    # the rollouts only apply the perturbed inputs
+    _worker_scene = mcr_checkpoint.build_scene(
+        run.create_root(), mcr_checkpoint.Checkpoint.from_bytes(
+            checkpoint_bytes),
+        builder, visual=False, commands=None, settled_state=None)
+
+
+def _worker_rollout(checkpoint_bytes, perturbation, steps):
+    ''' Run a rollout in the scene of a worker process. '''
+
+    return rollout(
+        _worker_scene, mcr_checkpoint.Checkpoint.from_bytes(checkpoint_bytes),
+        perturbation, steps)
+
+
+class JacobianEstimator():
+    '''
+    A class that estimates the Jacobian of the tip pose with respect to the
+    desired field and the inserted length, with the perturbed rollouts in
+    parallel worker processes.
+
+    Each worker builds the scene once, from the parameters of the first
+    checkpoint, and keeps it between estimates. An estimate sends the
+    checkpoint of the current state (a few kB) to the workers, which restore
+    it before each rollout, so the cost of a Jacobian is the one of a single
+    rollout when there is a worker per perturbation. The scenes of the
+    checkpoints must have the instrument of the first one.
+
+    Example:
+
+    .. code-block:: python
+
+        with JacobianEstimator(scene.checkpoint()) as estimator:
+            for i in range(100):
+                Sofa.Simulation.animate(root_node, root_node.dt.value)
+                result = estimator.estimate(scene.checkpoint())
+
+    :param checkpoint: A checkpoint of the scene, or the path to its file
+    :type checkpoint: mcr_checkpoint.Checkpoint or str
+    :param steps: The number of simulation steps of each rollout
+    :type steps: int
+    :param field_step: The perturbation of each field component (T)
+    :type field_step: float
+    :param insertion_step: The perturbation of the inserted length (m)
+    :type insertion_step: float
+    :param central: A flag that uses central instead of forward differences
+    :type central: bool
+    :param workers: The number of worker processes, one per perturbation if None
+    :type workers: int
+    :param builder: The scene builder 'module:function'
+    :type builder: str
+    '''
+
+    def __init__(
+            self,
+            checkpoint,
+            steps=20,
+            field_step=1e-3,
+            insertion_step=1e-3,
+            central=True,
+            workers=None,
+            builder='mcr_sim.mcr_scene:build_scene'):
+
+        if not isinstance(checkpoint, mcr_checkpoint.Checkpoint):
+            checkpoint = mcr_checkpoint.Checkpoint.load(checkpoint)
+
+        self.steps = steps
+        self.central = central
+        self.perturbation = perturbations(
+            field_step, insertion_step, central)
+        self.workers = workers or min(
+            len(self.perturbation), os.cpu_count())
+
+        # SOFA is not fork-safe, workers start a fresh interpreter
+        context = multiprocessing.get_context('spawn')
+        self.pool = context.Pool(
+            self.workers, initializer=_init_worker,
+            initargs=(checkpoint.to_bytes(), builder))
+
+    def estimate(self, checkpoint):
+        '''
+        Estimate the Jacobian from the state of a checkpoint.
+
+        :param checkpoint: The checkpoint of the state
+        :type checkpoint: mcr_checkpoint.Checkpoint
+        :return: The Jacobian, shape (6, 4), with the rows OUTPUTS and the
+            columns INPUTS, its singular values and condition number with
+            the inputs scaled by their perturbations, the tip pose of the
+            state and the wall time (s)
+        :rtype: dict
+        '''
+
+        start = time.perf_counter()
+        checkpoint_bytes = checkpoint.to_bytes()
+        tip_pose = checkpoint.state['MO_position'][-1].copy()
+
+        poses = np.array(self.pool.starmap(
+            _worker_rollout,
+            [(checkpoint_bytes, p, self.steps) for p in self.perturbation],
+            chunksize=1))
+
+        return _result(
+            assemble(poses, self.perturbation, self.central),
+            self.perturbation, tip_pose, time.perf_counter() - start)
+
+    def close(self):
+        ''' Stop the worker processes. '''
+
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *args):
+
+        self.close()
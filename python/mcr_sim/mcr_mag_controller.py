@@ -1,14 +1,27 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import Sofa
 import numpy as np
-from splib3.numerics import Quat, Vec3
-from scipy.spatial.transform import Rotation as R
+
+from mcr_sim import mcr_magnet
 
 
 class MagController(Sofa.Core.Controller):
     '''
     A class that takes the desired magnetic field inputs and calculates the
-    torque applied on the magnets of the magnetic instrument. The torques are
-    applied to the SOFA mechanical model at every time step.
+    torque and the gradient force applied on the magnets of the magnetic
+    instrument. The wrenches are applied to the SOFA mechanical model at
+    every time step.
+
+    In pipelined mode, a worker thread computes the actuation matrices and
+    currents for the magnet positions predicted for the next step while
+    SOFA solves the current step. The prediction is used if it is within
+    prediction_threshold of the true positions, otherwise the magnetic
+    model is evaluated again. The worker allocates the currents with its
+    own allocator of the eMNS, see EMNS.create_allocator. The overlap of
+    timing_summary() is the fraction of the worker time hidden behind the
+    SOFA step, it stays near 0 if the step holds the GIL.
 
     :param e_mns: The object defining the eMNS
     :param instrument: The object defining the instrument
@@ -16,6 +29,14 @@ class MagController(Sofa.Core.Controller):
     :type T_sim_mns: list[float]
     :param field_des: The desired magnetic field (m)
     :type field_des: float
+    :param gradient_des: The desired field gradient [dBx/dx, dBx/dy, dBx/dz, dBy/dy, dBy/dz] (T/m). If None, the currents only generate the desired field.
+    :type gradient_des: ndarray
+    :param gradient_force: A flag that enables the magnetic gradient force on the magnets, off by default
+    :type gradient_force: bool
+    :param pipelined: A flag that enables the background computation of the next step
+    :type pipelined: bool
+    :param prediction_threshold: The maximal distance between predicted and true magnet positions for the prediction to be used (m)
+    :type prediction_threshold: float
     :param `*args`: The variable arguments are passed to the SofaCoreController
     :param `**kwargs`: The keyword arguments arguments are passed to the SofaCoreController
     '''
@@ -26,6 +47,10 @@ class MagController(Sofa.Core.Controller):
             instrument,
             T_sim_mns,
             field_des=np.array([0., 0., 0.]),
+            gradient_des=None,
+            gradient_force=False,
+            pipelined=False,
+            prediction_threshold=1e-4,
             *args, **kwargs):
 
         # These are needed (and the normal way to override from a python class)
@@ -35,9 +60,18 @@ class MagController(Sofa.Core.Controller):
         self.instrument = instrument
         self.T_sim_mns = T_sim_mns
         self.field_des = field_des
+        self.gradient_des = gradient_des
+        self.gradient_force = gradient_force
 
-        self.magnet_moment = instrument.magnets[0].dipole_moment
+        self.pipelined = pipelined
+        self.prediction_threshold = prediction_threshold
+        self.executor = None
+        self.worker_allocator = None
+        self.prediction = None
+
+        self.magnet_table = instrument.magnet_table
         self.BG = [0., 0., 0., 0., 0., 0., 0., 0.]
+        self.currents = None
         self.num_nodes = len(self.instrument.index_mag)
 
         # Position of the entry point
@@ -46,58 +80,181 @@ class MagController(Sofa.Core.Controller):
             self.T_sim_mns[1],
             self.T_sim_mns[2]])
 
+        self.reset_timing()
+
+    def reset_timing(self):
+        ''' Reset the timing counters. '''
+
+        self.last_step_start = None
+        self.timing = {
+            'steps': 0,
+            'prediction_hits': 0,
+            'prediction_misses': 0,
+            'controller_time': 0.,  # time spent in the controller (s)
+            'compute_time': 0.,     # synchronous magnetic model time (s)
+            'wait_time': 0.,        # time waiting for the worker (s)
+            'worker_time': 0.,      # magnetic model time of the worker (s)
+            'frame_time': 0.,       # time between animate begin events (s)
+            }
+
+    def timing_summary(self):
+        '''
+        Return the mean times per step (s) and the prediction hit rate.
+
+        :rtype: dict
+        '''
+
+        steps = max(self.timing['steps'], 1)
+        predictions = (
+            self.timing['prediction_hits'] + self.timing['prediction_misses'])
+        worker_time = self.timing['worker_time']
+
+        return {
+            'steps': self.timing['steps'],
+            'controller_time': self.timing['controller_time']/steps,
+            'compute_time': self.timing['compute_time']/steps,
+            'wait_time': self.timing['wait_time']/steps,
+            'worker_time': worker_time/steps,
+            'overlap': (
+                max(worker_time - self.timing['wait_time'], 0.)/worker_time
+                if worker_time > 0. else 0.),
+            'frame_time': self.timing['frame_time']/max(steps - 1, 1),
+            'prediction_hit_rate': (
+                self.timing['prediction_hits']/max(predictions, 1)),
+            }
+
+    def compute(self, positions, field_des, gradient_des, allocator=None):
+        '''
+        Evaluate the actuation matrices, currents and fields and gradients at
+        the magnet positions in the eMNS frame.
+        '''
+
+        return self.e_mns.field_gradient_to_currents_batch(
+            fields=field_des,
+            positions=positions,
+            gradients=gradient_des,
+            allocator=allocator)
+
+    def _predict(self, positions, field_des, gradient_des):
+        ''' Worker task of the pipelined mode. '''
+
+        start = time.perf_counter()
+        result = self.compute(
+            positions, field_des, gradient_des, self.worker_allocator)
+
+        return positions, result, time.perf_counter() - start
+
+    def _use_prediction(self, positions):
+        '''
+        Wait for the prediction of the previous step and return its result
+        if it matches the true positions and the current targets.
+        '''
+
+        future, field_des, gradient_des = self.prediction
+        self.prediction = None
+
+        start = time.perf_counter()
+        predicted_positions, result, worker_time = future.result()
+        self.timing['wait_time'] += time.perf_counter() - start
+        self.timing['worker_time'] += worker_time
+
+        valid = (
+            predicted_positions.shape == positions.shape
+            and np.array_equal(field_des, self.field_des)
+            and (
+                (gradient_des is None and self.gradient_des is None)
+                or np.array_equal(gradient_des, self.gradient_des))
+            and np.max(np.linalg.norm(
+                predicted_positions - positions, axis=1))
+            <= self.prediction_threshold)
+
+        if valid:
+            self.timing['prediction_hits'] += 1
+            return result
+
+        self.timing['prediction_misses'] += 1
+        return None
+
     def onAnimateBeginEvent(self, event):
         '''
-        Apply the torque on the magntic nodes given a desired field and
-        the pose of the nodes.
+        Apply the torque and the gradient force on the magntic nodes given a
+        desired field and the pose of the nodes.
         '''
 
+        start = time.perf_counter()
+        if self.last_step_start is not None:
+            self.timing['frame_time'] += start - self.last_step_start
+        self.last_step_start = start
+        self.timing['steps'] += 1
+
         self.num_nodes = len(self.instrument.MO.position)
 
-        for i in range(0, len(self.instrument.index_mag)):
-
-            pos = self.instrument.MO.position[
-                self.num_nodes-self.instrument.index_mag[i]-1]
-            quat = Quat(pos[3], pos[4], pos[5], pos[6])
-
-            # Update magnetic model with new pose of catheters
-            actualPos = (
-                np.array([
-                    pos[0],
-                    pos[1],
-                    pos[2]]) +
-                np.array([
-                    self.T_sim_mns[0],
-                    self.T_sim_mns[1],
-                    self.T_sim_mns[2]]))  # pose of the tip in Navion frame
-
-            currents = self.e_mns.field_to_currents(
-                field=self.field_des,
-                position=actualPos
-            )
-            field = self.e_mns.currents_to_field(
-                currents=currents,
-                position=actualPos
-            )
-
-            self.BG = field
-
-            B = Vec3(
-                self.BG[0]*self.magnet_moment,
-                self.BG[1]*self.magnet_moment,
-                self.BG[2]*self.magnet_moment)
-            magnetic_field = B
-
-            # torque on magnet
-            r = R.from_quat(quat)
-            X = r.apply([1., 0., 0.])
-            T = Vec3()
-            T = T.cross(X, magnetic_field)
-
-            # Update forces and torques
-            self.instrument.CFF.forces[self.instrument.index_mag[i]][:] = [
-                0, 0, 0, T[0], T[1], T[2]]
+        # pose of the magnetic nodes, the CFF indices count from the end
+        index_nodes = self.num_nodes-self.instrument.index_mag-1
+        poses = np.array(self.instrument.MO.position.value)[index_nodes]
+
+        # Update magnetic model with new pose of catheters, the field and
+        # gradient actuation matrices are evaluated once for all magnetic
+        # nodes
+        actualPos = poses[:, 0:3] + np.array(self.T_sim_mns[0:3])
+
+        result = None
+        if self.prediction is not None:
+            result = self._use_prediction(actualPos)
+        if result is None:
+            compute_start = time.perf_counter()
+            result = self.compute(
+                actualPos, self.field_des, self.gradient_des)
+            self.timing['compute_time'] += time.perf_counter() - compute_start
+        actuation_matrices, currents, bg = result
+        fields = bg[:, 0:3]
+
+        self.BG = bg[-1]
+        self.currents = currents
+
+        # torque and force on magnets
+        wrenches = mcr_magnet.magnetic_wrenches(
+            poses, bg, self.magnet_table.moments)
+        if not self.gradient_force:
+            wrenches[:, 0:3] = 0.
+
+        # Update forces and torques
+        with self.instrument.CFF.forces.writeableArray() as forces:
+            forces[self.instrument.index_mag] = wrenches
 
         # visualze magnetic field arrow in SOFA gui
-        self.instrument.CFF_visu.force = [
-            magnetic_field[0], magnetic_field[1], magnetic_field[2], 0, 0, 0]
+        if self.instrument.CFF_visu is not None:
+            magnetic_field = fields[-1]*self.magnet_table.dipole_moment[-1]
+            self.instrument.CFF_visu.force = [
+                magnetic_field[0], magnetic_field[1], magnetic_field[2],
+                0, 0, 0]
+
+        # compute the next step in the background while SOFA solves this one,
+        # the positions are extrapolated with the node velocities
+        if self.pipelined:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=1)
+            if self.worker_allocator is None:
+                self.worker_allocator = self.e_mns.create_allocator()
+            velocities = np.array(
+                self.instrument.MO.velocity.value)[index_nodes, 0:3]
+            predicted = actualPos + velocities*event['dt']
+            field_des = np.array(self.field_des)
+            gradient_des = (
+                None if self.gradient_des is None
+                else np.array(self.gradient_des))
+            self.prediction = (
+                self.executor.submit(
+                    self._predict, predicted, field_des, gradient_des),
+                field_des,
+                gradient_des)
+
+        self.timing['controller_time'] += time.perf_counter() - start
+
+    def shutdown(self):
+        ''' Stop the worker thread of the pipelined mode. '''
+
+        self.prediction = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
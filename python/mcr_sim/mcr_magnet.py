@@ -1,6 +1,117 @@
 import numpy as np
 
 
+def cross(a, b):
+    '''
+    Row-wise cross product of two (N, 3) arrays. Cheaper than np.cross for
+    the small arrays of a single time step.
+    '''
+
+    return np.stack((
+        a[:, 1]*b[:, 2] - a[:, 2]*b[:, 1],
+        a[:, 2]*b[:, 0] - a[:, 0]*b[:, 2],
+        a[:, 0]*b[:, 1] - a[:, 1]*b[:, 0]), axis=1)
+
+
+def rotate(quats, vectors):
+    '''
+    Rotate vectors by unit quaternions.
+
+    :param quats: The quaternions [qx, qy, qz, qw], shape (N, 4)
+    :type quats: ndarray
+    :param vectors: The vectors, shape (3,) or (N, 3)
+    :type vectors: ndarray
+    :return: The rotated vectors, shape (N, 3)
+    :rtype: ndarray
+    '''
+
+    q = quats[:, 0:3]
+    w = quats[:, 3:4]
+    t = 2.*cross(q, np.broadcast_to(vectors, q.shape))
+
+    return vectors + w*t + cross(q, t)
+
+
+def magnetic_torques(poses, fields, moments):
+    '''
+    Compute the magnetic torques T = m x B on the magnetic nodes.
+
+    :param poses: The poses of the magnetic nodes [x, y, z, qx, qy, qz, qw], shape (N, 7)
+    :type poses: ndarray
+    :param fields: The magnetic fields at the nodes (T), shape (N, 3)
+    :type fields: ndarray
+    :param moments: The dipole moments in the body frame of the nodes (A.m^2), shape (N, 3)
+    :type moments: ndarray
+    :return: The torques, shape (N, 3)
+    :rtype: ndarray
+    '''
+
+    m = rotate(poses[:, 3:7], moments)
+
+    return cross(m, fields)
+
+
+def gradient_matrices(gradients):
+    '''
+    Build the full field gradient matrices from the five independent
+    gradient components of a divergence and curl free field.
+
+    :param gradients: The gradients [dBx/dx, dBx/dy, dBx/dz, dBy/dy, dBy/dz], shape (N, 5)
+    :type gradients: ndarray
+    :return: The gradient matrices dB_i/dx_j, shape (N, 3, 3)
+    :rtype: ndarray
+    '''
+
+    # entries of the symmetric, traceless gradient matrix in row-major order
+    index = [0, 1, 2, 1, 3, 4, 2, 4, 5]
+    gradients = np.concatenate(
+        (gradients, -gradients[:, 0:1]-gradients[:, 3:4]), axis=1)
+
+    return gradients[:, index].reshape(-1, 3, 3)
+
+
+def magnetic_forces(poses, gradients, moments):
+    '''
+    Compute the magnetic forces F = (m.grad)B on the magnetic nodes.
+
+    :param poses: The poses of the magnetic nodes [x, y, z, qx, qy, qz, qw], shape (N, 7)
+    :type poses: ndarray
+    :param gradients: The gradients [dBx/dx, dBx/dy, dBx/dz, dBy/dy, dBy/dz] at the nodes (T/m), shape (N, 5)
+    :type gradients: ndarray
+    :param moments: The dipole moments in the body frame of the nodes (A.m^2), shape (N, 3)
+    :type moments: ndarray
+    :return: The forces, shape (N, 3)
+    :rtype: ndarray
+    '''
+
+    m = rotate(poses[:, 3:7], moments)
+
+    # F_j = m_i dB_i/dx_j
+    return np.einsum('ni,nij->nj', m, gradient_matrices(gradients))
+
+
+def magnetic_wrenches(poses, bg, moments):
+    '''
+    Compute the magnetic forces and torques on the magnetic nodes in one
+    pass.
+
+    :param poses: The poses of the magnetic nodes [x, y, z, qx, qy, qz, qw], shape (N, 7)
+    :type poses: ndarray
+    :param bg: The fields and gradients [Bx, By, Bz, dBx/dx, dBx/dy, dBx/dz, dBy/dy, dBy/dz] at the nodes, shape (N, 8)
+    :type bg: ndarray
+    :param moments: The dipole moments in the body frame of the nodes (A.m^2), shape (N, 3)
+    :type moments: ndarray
+    :return: The wrenches [fx, fy, fz, tx, ty, tz], shape (N, 6)
+    :rtype: ndarray
+    '''
+
+    m = rotate(poses[:, 3:7], moments)
+
+    return np.concatenate((
+        np.einsum('ni,nij->nj', m, gradient_matrices(bg[:, 3:8])),
+        cross(m, bg[:, 0:3])), axis=1)
+
+
 class Magnet():
     '''
     A class used to build a magnet object.
@@ -13,6 +124,8 @@ class Magnet():
     :type inner_diam: float
     :param remanence: The remanence of the magnet (T)
     :type remanence: float
+    :param direction: The magnetization direction in the body frame of the instrument node
+    :type direction: list[float]
     :param color: The color of instrument used for visualization [r, g, b, alpha]
     :type color: list[float]
     '''
@@ -23,12 +136,15 @@ class Magnet():
            outer_diam,
            inner_diam,
            remanence,
+           direction=[1., 0., 0.],
            color=[.2, .2, .2, 1.]):
 
         self.length = length
         self.outer_diam = outer_diam
         self.inner_diam = inner_diam
         self.remanence = remanence
+        self.direction = np.array(direction, dtype=float)/np.linalg.norm(
+            direction)
 
         self.color = color
 
@@ -39,3 +155,38 @@ class Magnet():
 
         # dipole moment
         self.dipole_moment = (1./self.mu_0)*self.remanence*self.volume
+
+
+class MagnetTable():
+    '''
+    A class that stores the magnets of an instrument as arrays, one row per
+    magnetic node.
+
+    :param magnets: The magnets per element of the instrument tip, entries that are not a magnet (e.g. 0.) mark non-magnetic elements
+    :type magnets: list[magnet]
+    '''
+
+    def __init__(
+           self,
+           magnets):
+
+        index = [i for i, magnet in enumerate(magnets)
+                 if isinstance(magnet, Magnet)]
+
+        # index of the magnetic nodes, counted from the instrument tip
+        self.index = np.array(index, dtype=int)
+        self.magnets = [magnets[i] for i in index]
+
+        self.dipole_moment = np.array(
+            [magnet.dipole_moment for magnet in self.magnets], dtype=float)
+        self.direction = np.array(
+            [magnet.direction for magnet in self.magnets],
+            dtype=float).reshape(-1, 3)
+        self.length = np.array(
+            [magnet.length for magnet in self.magnets], dtype=float)
+
+        # dipole moment vectors in the body frame of the nodes
+        self.moments = self.dipole_moment[:, None]*self.direction
+
+    def __len__(self):
+        return len(self.index)
@@ -0,0 +1,384 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+from scipy.spatial.transform import Rotation as R
+
+
+def read_stl(path):
+    '''
+    Read an STL file, binary or ASCII.
+
+    :param path: The path to the STL file
+    :type path: str
+    :return: The corners of the triangles, shape (M, 3, 3)
+    :rtype: ndarray
+    '''
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if len(data) >= 84:
+        num_triangles = int(np.frombuffer(data, dtype='<u4', count=1,
+                                          offset=80)[0])
+        if len(data) == 84 + 50*num_triangles:
+            records = np.frombuffer(data, offset=84, dtype=np.dtype([
+                ('normal', '<f4', (3,)),
+                ('corners', '<f4', (3, 3)),
+                ('attribute', '<u2')]))
+            return records['corners'].astype(float)
+
+    corners = [
+        line.split()[1:4] for line in data.decode('ascii').splitlines()
+        if line.strip().startswith('vertex')]
+
+    return np.array(corners, dtype=float).reshape(-1, 3, 3)
+
+
+def weld(triangles, tolerance=0.):
+    '''
+    Merge the corners of a triangle soup into shared vertices.
+
+    :param triangles: The corners of the triangles, shape (M, 3, 3)
+    :type triangles: ndarray
+    :param tolerance: The distance under which corners are merged
+    :type tolerance: float
+    :return: The vertices (V, 3) and the vertex indices of the triangles (M, 3)
+    :rtype: tuple[ndarray]
+    '''
+
+    corners = triangles.reshape(-1, 3)
+    keys = corners if tolerance == 0. else np.round(corners/tolerance)
+    _, first, inverse = np.unique(
+        keys, axis=0, return_index=True, return_inverse=True)
+
+    return corners[first], inverse.reshape(-1, 3)
+
+
+def transform(vertices, T_env_sim, scale=0.001):
+    '''
+    Express vertices given in the mesh file in the simulation frame, as
+    MeshSTLLoader does with scale, rotation and translation.
+
+    :param T_env_sim: The pose of the environment in the simulation frame [x, y, z, qx, qy, qz, qw]
+    :type T_env_sim: list[float]
+    :param scale: The scale from the mesh units to m
+    :type scale: float
+    '''
+
+    r = R.from_quat(T_env_sim[3:7])
+
+    return r.apply(scale*vertices) + np.asarray(T_env_sim[0:3])
+
+
+def clean(vertices, faces):
+    '''
+    Remove degenerate and duplicate triangles and unused vertices.
+
+    :return: The vertices and faces
+    :rtype: tuple[ndarray]
+    '''
+
+    faces = faces[
+        (faces[:, 0] != faces[:, 1])
+        & (faces[:, 1] != faces[:, 2])
+        & (faces[:, 2] != faces[:, 0])]
+
+    # the same corners in any order and orientation are one triangle
+    _, unique = np.unique(np.sort(faces, axis=1), axis=0, return_index=True)
+    faces = faces[np.sort(unique)]
+
+    used, faces = np.unique(faces, return_inverse=True)
+
+    return vertices[used], faces.reshape(-1, 3)
+
+
+def cluster(vertices, faces, cell_size):
+    '''
+    Decimate a mesh by merging the vertices that fall in the same cell of
+    a regular grid into their mean.
+
+    :return: The vertices, the faces and the largest distance between a
+        vertex and the vertex it was merged into
+    :rtype: tuple
+    '''
+
+    cells = np.floor((vertices - vertices.min(axis=0))/cell_size)
+    _, labels, counts = np.unique(
+        cells, axis=0, return_inverse=True, return_counts=True)
+    labels = labels.reshape(-1)
+
+    merged = np.zeros((len(counts), 3))
+    np.add.at(merged, labels, vertices)
+    merged /= counts[:, None]
+
+    error = float(np.max(np.linalg.norm(vertices - merged[labels], axis=1)))
+    merged, faces = clean(merged, labels[faces])
+
+    return merged, faces, error
+
+
+def decimate(vertices, faces, target_triangles=None, tolerance=None):
+    '''
+    Decimate a mesh by vertex clustering, down to a number of triangles or
+    so that no vertex moves by more than a tolerance.
+
+    :param target_triangles: The maximal number of triangles
+    :type target_triangles: int
+    :param tolerance: The maximal displacement of a vertex (m)
+    :type tolerance: float
+    :return: The vertices, the faces and the largest vertex displacement (m)
+    :rtype: tuple
+    '''
+
+    if tolerance is not None:
+        # the mean of the vertices of a cell lies in the cell
+        result = cluster(vertices, faces, tolerance/np.sqrt(3.))
+        if target_triangles is None or len(result[1]) <= target_triangles:
+            return result
+
+    if target_triangles is None or len(faces) <= target_triangles:
+        return vertices, faces, 0.
+
+    # bisection on the cell size, the number of triangles decreases with it
+    low = 0.
+    high = float(np.max(np.ptp(vertices, axis=0)))
+    best = cluster(vertices, faces, high)
+    for i in range(30):
+        size = 0.5*(low + high)
+        result = cluster(vertices, faces, size)
+        if len(result[1]) <= target_triangles:
+            high, best = size, result
+        else:
+            low = size
+        if len(best[1]) >= 0.98*target_triangles:
+            break
+
+    return best
+
+
+def partition(vertices, faces, num_groups):
+    '''
+    Split a mesh into spatial groups of about the same number of triangles,
+    by recursive median cuts of the triangle centroids along the longest
+    axis of their bounding box.
+
+    :param num_groups: The number of groups
+    :type num_groups: int
+    :return: The vertices and faces of each group, which has its own vertex
+        indices, and the bounding boxes of the groups, lower and upper
+        corners of shape (num_groups, 3)
+    :rtype: tuple
+    '''
+
+    centroids = vertices[faces].mean(axis=1)
+
+    def split(indices, num):
+        if num == 1 or len(indices) < 2:
+            return [indices]
+        points = centroids[indices]
+        axis = np.argmax(np.ptp(points, axis=0))
+        order = indices[np.argsort(points[:, axis], kind='stable')]
+        cut = len(order)*(num//2)//num
+        return split(order[:cut], num//2) + split(order[cut:], num - num//2)
+
+    groups = []
+    for indices in split(np.arange(len(faces)), num_groups):
+        used, group_faces = np.unique(faces[indices], return_inverse=True)
+        groups.append((vertices[used], group_faces.reshape(-1, 3)))
+
+    lower = np.array([group[0].min(axis=0) for group in groups])
+    upper = np.array([group[0].max(axis=0) for group in groups])
+
+    return groups, lower, upper
+
+
+def box_distances(points, lower, upper):
+    '''
+    Return the distance of each axis-aligned box to the nearest of several
+    points, 0 for a box that contains a point.
+
+    :param points: The points, shape (N, 3)
+    :type points: ndarray
+    :param lower: The lower corners of the boxes, shape (M, 3)
+    :type lower: ndarray
+    :param upper: The upper corners of the boxes, shape (M, 3)
+    :type upper: ndarray
+    :rtype: ndarray
+    '''
+
+    points = np.asarray(points)[np.newaxis]
+    offsets = np.maximum(
+        np.maximum(lower[:, np.newaxis] - points,
+                   points - upper[:, np.newaxis]), 0.)
+
+    return np.min(np.linalg.norm(offsets, axis=2), axis=1)
+
+
+def file_hash(path):
+    ''' Return the sha1 hash of a file. '''
+
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class CachedMesh():
+    '''
+    A base class for meshes stored in the cache directory as a pair of
+    .npy files, vertices (V, 3) and triangles (M, 3), with a .json file of
+    metadata written last. The arrays are memory-mapped when loaded.
+
+    :param key: The values the mesh depends on
+    :type key: list
+    :param cache_dir: The directory where meshes are stored
+    :type cache_dir: str
+    '''
+
+    def __init__(self, key, cache_dir):
+
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.prefix = os.path.join(
+            self.cache_dir, 'mesh_' + hashlib.sha1(
+                json.dumps(key).encode()).hexdigest()[:16])
+
+        if not os.path.exists(self.prefix + '.json'):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            vertices, faces, meta = self._build()
+
+            # write to temporary files first so that concurrent workers never
+            # load a partially written mesh
+            pid = '.' + str(os.getpid()) + '.tmp'
+            for name, values in (('vertices', vertices), ('faces', faces)):
+                np.save(self.prefix + pid + '.npy', values)
+                os.replace(
+                    self.prefix + pid + '.npy',
+                    self.prefix + '.' + name + '.npy')
+            with open(self.prefix + pid, 'w') as f:
+                json.dump(meta, f, indent=2)
+            os.replace(self.prefix + pid, self.prefix + '.json')
+
+        self.vertices = np.load(self.prefix + '.vertices.npy', mmap_mode='r')
+        self.faces = np.load(self.prefix + '.faces.npy', mmap_mode='r')
+        with open(self.prefix + '.json', 'r') as f:
+            self.meta = json.load(f)
+
+    def _build(self):
+        ''' Return the vertices, the faces and the metadata of the mesh. '''
+
+        raise NotImplementedError
+
+
+class SimulationMesh(CachedMesh):
+    '''
+    A class that holds an STL mesh with deduplicated vertices, expressed in
+    the simulation frame. The mesh is cached on disk, keyed by the hash of
+    the STL file and its transform, so that later scenes skip the parsing
+    and the transform of the STL file.
+
+    :param environment_stl: The path to the environment STL mesh file
+    :type environment_stl: str
+    :param T_env_sim: The pose of the environment in the simulation frame [x, y, z, qx, qy, qz, qw]
+    :type T_env_sim: list[float]
+    :param flip_normals: A flag that reverses the orientation of the triangles
+    :type flip_normals: bool
+    :param scale: The scale from the mesh units to m
+    :type scale: float
+    :param cache_dir: The directory where meshes are stored
+    :type cache_dir: str
+    '''
+
+    def __init__(
+            self,
+            environment_stl,
+            T_env_sim=[0., 0., 0., 0., 0., 0., 1.],
+            flip_normals=False,
+            scale=0.001,
+            cache_dir=os.path.join('~', '.cache', 'mcr_sim')):
+
+        self.environment_stl = environment_stl
+        self.T_env_sim = [float(x) for x in T_env_sim]
+        self.flip_normals = bool(flip_normals)
+        self.scale = float(scale)
+        self.stl_hash = file_hash(environment_stl)
+
+        CachedMesh.__init__(self, [
+            self.stl_hash, self.T_env_sim, self.flip_normals, self.scale],
+            cache_dir)
+
+    def _build(self):
+
+        vertices, faces = weld(read_stl(self.environment_stl))
+        vertices = transform(vertices, self.T_env_sim, self.scale)
+        if self.flip_normals:
+            faces = faces[:, ::-1]
+
+        return vertices, faces.astype(np.int32), {
+            'environment_stl': self.environment_stl,
+            'T_env_sim': self.T_env_sim,
+            'flip_normals': self.flip_normals,
+            'scale': self.scale,
+            }
+
+
+class CollisionMesh(CachedMesh):
+    '''
+    A class that holds the decimated collision mesh of an environment,
+    built from the SimulationMesh. The result is cached on disk, keyed by
+    the hash of the STL file, T_env_sim and the decimation parameters.
+
+    :param environment_stl: The path to the environment STL mesh file
+    :type environment_stl: str
+    :param T_env_sim: The pose of the environment in the simulation frame [x, y, z, qx, qy, qz, qw]
+    :type T_env_sim: list[float]
+    :param flip_normals: A flag that reverses the orientation of the triangles
+    :type flip_normals: bool
+    :param target_triangles: The maximal number of triangles
+    :type target_triangles: int
+    :param tolerance: The maximal displacement of a vertex (m)
+    :type tolerance: float
+    :param scale: The scale from the mesh units to m
+    :type scale: float
+    :param cache_dir: The directory where meshes are stored
+    :type cache_dir: str
+    :param source: The full resolution mesh, built if None
+    :type source: SimulationMesh
+    '''
+
+    def __init__(
+            self,
+            environment_stl,
+            T_env_sim=[0., 0., 0., 0., 0., 0., 1.],
+            flip_normals=False,
+            target_triangles=None,
+            tolerance=None,
+            scale=0.001,
+            cache_dir=os.path.join('~', '.cache', 'mcr_sim'),
+            source=None):
+
+        if source is None:
+            source = SimulationMesh(
+                environment_stl, T_env_sim, flip_normals, scale, cache_dir)
+        self.source = source
+        self.target_triangles = target_triangles
+        self.tolerance = tolerance
+
+        CachedMesh.__init__(self, [
+            source.stl_hash, source.T_env_sim, source.flip_normals,
+            source.scale, target_triangles, tolerance], cache_dir)
+
+        self.error = self.meta['error']
+        self.num_source = self.meta['num_source']
+
+    def _build(self):
+
+        vertices, faces, error = decimate(
+            np.asarray(self.source.vertices), np.asarray(self.source.faces),
+            self.target_triangles, self.tolerance)
+
+        return vertices, faces.astype(np.int32), {
+            'target_triangles': self.target_triangles,
+            'tolerance': self.tolerance,
+            'error': error,
+            'num_source': len(self.source.faces),
+            }
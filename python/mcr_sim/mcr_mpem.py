@@ -0,0 +1,197 @@
+import numpy as np
+import yaml
+
+
+class ForwardModelMPEM():
+    '''
+    A vectorized multipole electromagnet model (MPEM) of an eMNS, built from
+    the same calibration file as mag_manip.ForwardModelMPEM.
+    Every coil is the sum of point sources. Each source is placed at
+    Source_Position, oriented along Source_Direction and contributes
+    a dipole field scaled by its first B_Coeff per unit current.
+    The field and gradient actuation matrices are evaluated for all query
+    points in a single NumPy pass.
+
+    :param calibration_path: The path to the eMNS calibration file
+    :type calibration_path: str
+    '''
+
+    def __init__(
+            self,
+            calibration_path=None):
+
+        self.calibration_path = None
+        self.num_coils = 0
+        self.workspace = None
+
+        if calibration_path is not None:
+            self.setCalibrationFile(calibration_path)
+
+    def setCalibrationFile(
+            self,
+            calibration_path):
+        '''
+        Load the sources of every coil from a calibration file.
+        '''
+
+        with open(calibration_path, 'r') as f:
+            calibration = yaml.safe_load(f)
+
+        positions = []
+        directions = []
+        coefficients = []
+        coil_index = []
+
+        for i, coil_name in enumerate(calibration['Coil_List']):
+            coil = calibration[coil_name]
+            for source_name in coil['Source_List']:
+                source = coil[source_name]
+
+                if source.get('A_Coeff') or len(source['B_Coeff']) != 1:
+                    raise ValueError(
+                        'Only first order sources are supported, got '
+                        + coil_name + '/' + source_name + ' in '
+                        + calibration_path)
+
+                direction = np.array(source['Source_Direction'], dtype=float)
+                positions.append(source['Source_Position'])
+                directions.append(direction/np.linalg.norm(direction))
+                coefficients.append(source['B_Coeff'][0])
+                coil_index.append(i)
+
+        self.calibration_path = calibration_path
+        self.num_coils = len(calibration['Coil_List'])
+
+        self.source_positions = np.array(positions, dtype=float)
+        # dipole moment of every source per unit current
+        self.source_moments = (
+            np.array(coefficients)[:, None]*np.array(directions))
+        # maps every source to the coil it belongs to, shape (S, C)
+        self.source_to_coil = np.zeros(
+            (len(coil_index), self.num_coils))
+        self.source_to_coil[np.arange(len(coil_index)), coil_index] = 1.
+
+        if 'Workspace_Dimensions' in calibration:
+            self.workspace = np.array(
+                calibration['Workspace_Dimensions'], dtype=float)
+
+    def _source_terms(self, positions):
+        '''
+        Return the vectors from the sources to the query points, their
+        inverse norm and the projection of the source moments on them.
+        '''
+
+        positions = np.atleast_2d(np.asarray(positions, dtype=float))
+
+        r = positions[:, None, :] - self.source_positions[None, :, :]
+        inv_norm = 1./np.linalg.norm(r, axis=2)
+        m_dot_r = np.einsum('nsi,si->ns', r, self.source_moments)
+
+        return r, inv_norm, m_dot_r
+
+    def get_field_actuation_matrices(
+            self,
+            positions):
+        '''
+        Compute the field actuation matrices at several positions.
+
+        :param positions: The positions in the eMNS frame, shape (N, 3)
+        :type positions: ndarray
+        :return: The field actuation matrices, shape (N, 3, num_coils)
+        :rtype: ndarray
+        '''
+
+        r, inv_norm, m_dot_r = self._source_terms(positions)
+
+        # B = 3 (m.r) r / |r|^5 - m / |r|^3
+        field = (
+            3.*(m_dot_r*inv_norm**5)[..., None]*r
+            - (inv_norm**3)[..., None]*self.source_moments[None])
+
+        return np.einsum('nsi,sc->nic', field, self.source_to_coil)
+
+    def get_gradient_actuation_matrices(
+            self,
+            positions):
+        '''
+        Compute the full field gradient per unit current at several
+        positions.
+
+        :param positions: The positions in the eMNS frame, shape (N, 3)
+        :type positions: ndarray
+        :return: The gradient matrices dB_i/dx_j, shape (N, 3, 3, num_coils)
+        :rtype: ndarray
+        '''
+
+        r, inv_norm, m_dot_r = self._source_terms(positions)
+        m = self.source_moments[None]
+
+        # dB_i/dx_j = 3 (m_j r_i + m_i r_j + (m.r) d_ij) / |r|^5
+        #             - 15 (m.r) r_i r_j / |r|^7
+        inv5 = (3.*inv_norm**5)[..., None, None]
+        gradient = inv5*(
+            m[..., None, :]*r[..., :, None]
+            + m[..., :, None]*r[..., None, :]
+            + m_dot_r[..., None, None]*np.eye(3))
+        gradient -= (
+            (15.*m_dot_r*inv_norm**7)[..., None, None]
+            * r[..., :, None]*r[..., None, :])
+
+        return np.einsum('nsij,sc->nijc', gradient, self.source_to_coil)
+
+    def get_actuation_matrices(
+            self,
+            positions):
+        '''
+        Compute the field and gradient actuation matrices at several
+        positions. The rows follow the mag_manip convention
+        [Bx, By, Bz, dBx/dx, dBx/dy, dBx/dz, dBy/dy, dBy/dz].
+
+        :param positions: The positions in the eMNS frame, shape (N, 3)
+        :type positions: ndarray
+        :return: The actuation matrices, shape (N, 8, num_coils)
+        :rtype: ndarray
+        '''
+
+        field = self.get_field_actuation_matrices(positions)
+        gradient = self.get_gradient_actuation_matrices(positions)
+
+        return np.concatenate((
+            field,
+            gradient[:, 0, :, :],
+            gradient[:, 1, 1:, :]), axis=1)
+
+    def getFieldActuationMatrix(self, position):
+        '''
+        Compute the field actuation matrix at a single position, as
+        mag_manip.ForwardModelMPEM does.
+        '''
+
+        return self.get_field_actuation_matrices(position)[0]
+
+    def getActuationMatrix(self, position):
+        '''
+        Compute the field and gradient actuation matrix at a single
+        position, as mag_manip.ForwardModelMPEM does.
+        '''
+
+        return self.get_actuation_matrices(position)[0]
+
+    def getNumCoils(self):
+        ''' Return the number of coils of the eMNS. '''
+
+        return self.num_coils
+
+    def pointInWorkspace(self, position):
+        '''
+        Return True if a position lies inside the calibrated workspace.
+        '''
+
+        if self.workspace is None:
+            return True
+
+        position = np.asarray(position, dtype=float)
+
+        return bool(np.all(
+            (position >= self.workspace[:, 0])
+            & (position <= self.workspace[:, 1])))
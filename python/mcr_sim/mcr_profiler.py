@@ -0,0 +1,225 @@
+import json
+import time
+
+import Sofa
+import numpy as np
+
+from mcr_sim import mcr_collision
+
+# labels of the SOFA timer steps of the FreeMotionAnimationLoop grouped by
+# phase, the time of a label counts for the first phase it matches
+PHASES = {
+    'collision': (
+        'ComputeCollision', 'CollisionReset', 'CollisionDetection',
+        'CollisionResponse', 'BroadPhase', 'NarrowPhase'),
+    'constraint_solver': (
+        'ConstraintSolver', 'ConstraintCorrection', 'SolveConstraints'),
+    'free_motion': (
+        'FreeMotion', 'MechanicalVInitVisitor', 'ComputeFreeVelocity'),
+    'mappings': (
+        'UpdateMapping', 'UpdateMappingEndEvent', 'UpdateBBox'),
+    'visual': (
+        'UpdateVisual', 'VisualUpdate', 'UpdateVisualVisitor'),
+    }
+
+
+def phase_times(records):
+    '''
+    Sum the total times of the SOFA timer records per phase.
+
+    :param records: The records of Sofa.Timer.getRecords
+    :type records: dict
+    :return: The time of each phase (s)
+    :rtype: dict
+    '''
+
+    times = {phase: 0. for phase in PHASES}
+
+    def walk(node):
+        for label, child in node.items():
+            if not isinstance(child, dict):
+                continue
+            phase = next((
+                phase for phase, labels in PHASES.items()
+                if label in labels), None)
+            if phase is not None and 'total_time' in child:
+                # the timer reports milliseconds
+                times[phase] += 1e-3*float(child['total_time'])
+            else:
+                walk(child)
+
+    walk(records)
+
+    return times
+
+
+class Profiler(Sofa.Core.Controller):
+    '''
+    A class that measures every simulation step: the wall time of the step,
+    the time of the magnetic controller, the time of the solver phases
+    (collision, constraint solver, free motion, which includes the beam
+    force field, mappings and visual) from the SOFA timer, the iterations
+    and the residual of the constraint solver and the number of contacts.
+
+    The profiler is opt-in, it enables the SOFA timer, which has a cost of
+    its own. The contacts are counted by contact listeners between the
+    instrument and the environment, see
+    mcr_collision.add_contact_listeners. Add it to the root node before the
+    initialization of the scene.
+
+    :param root_node: The sofa root node
+    :param simulator: The object defining the simulator, for the solver iterations
+    :param contact_listeners: The contact listeners between the instrument and the environment
+    :type contact_listeners: list
+    :param mag_controller: The magnetic controller
+    :param timer: The SOFA timer of the animation steps
+    :type timer: str
+    :param capacity: The initial number of steps of the trace
+    :type capacity: int
+    :param `*args`: The variable arguments are passed to the SofaCoreController
+    :param `**kwargs`: The keyword arguments arguments are passed to the SofaCoreController
+    '''
+
+    def __init__(
+            self,
+            root_node,
+            simulator=None,
+            contact_listeners=None,
+            mag_controller=None,
+            timer='Animate',
+            capacity=10000,
+            *args, **kwargs):
+
+        # These are needed (and the normal way to override from a python class)
+        Sofa.Core.Controller.__init__(self, *args, **kwargs)
+
+        self.root_node = root_node
+        self.simulator = simulator
+        self.mag_controller = mag_controller
+        self.timer = timer
+
+        self.columns = (
+            ['time', 'step_time', 'mag_controller'] + list(PHASES)
+            + ['constraint_iterations', 'constraint_residual', 'contacts'])
+        self.trace = np.full((capacity, len(self.columns)), np.nan)
+        self.num_steps = 0
+        self.step_start = None
+        self.mag_time = 0.
+
+        self.contact_listeners = contact_listeners or []
+
+        try:
+            from Sofa import Timer
+            Timer.clear()
+            Timer.setEnabled(self.timer, True)
+            Timer.setInterval(self.timer, 1)
+            Timer.setOutputType(self.timer, 'json')
+            self.sofa_timer = Timer
+        except (ImportError, AttributeError):
+            self.sofa_timer = None
+
+    def _column(self, name):
+
+        return self.columns.index(name)
+
+    def _read_timer(self):
+        '''
+        Store the phase times of the last finished step, which the timer
+        reports once the step is over.
+        '''
+
+        if self.sofa_timer is None or self.num_steps == 0:
+            return
+
+        records = self.sofa_timer.getRecords(self.timer)
+        if not records:
+            return
+
+        for phase, duration in phase_times(records).items():
+            self.trace[self.num_steps - 1, self._column(phase)] = duration
+
+    def onAnimateBeginEvent(self, event):
+
+        self._read_timer()
+
+        if self.num_steps == len(self.trace):
+            self.trace = np.vstack(
+                (self.trace, np.full_like(self.trace, np.nan)))
+
+        if self.mag_controller is not None:
+            self.mag_time = self.mag_controller.timing['controller_time']
+        self.step_start = time.perf_counter()
+
+    def onAnimateEndEvent(self, event):
+
+        if self.step_start is None:
+            return
+
+        row = self.trace[self.num_steps]
+        row[self._column('time')] = self.root_node.time.value
+        row[self._column('step_time')] = time.perf_counter() - self.step_start
+
+        if self.mag_controller is not None:
+            row[self._column('mag_controller')] = (
+                self.mag_controller.timing['controller_time'] - self.mag_time)
+
+        if self.simulator is not None:
+            iterations = self.simulator.constraint_iterations()
+            if iterations is not None:
+                row[self._column('constraint_iterations')] = iterations
+            residual = self.simulator.constraint_residual()
+            if residual is not None:
+                row[self._column('constraint_residual')] = residual
+
+        if self.contact_listeners:
+            row[self._column('contacts')] = mcr_collision.count_contacts(
+                self.contact_listeners)
+
+        self.step_start = None
+        self.num_steps += 1
+
+    def get_trace(self):
+        '''
+        Return the per-step trace, one array per column. The times are in
+        seconds, the phases of the last step are only known after the next
+        step has started.
+
+        :rtype: dict
+        '''
+
+        return {
+            name: self.trace[0:self.num_steps, i].copy()
+            for i, name in enumerate(self.columns)}
+
+    def summary(self):
+        '''
+        Return the mean, 95th percentile and maximum of each column.
+
+        :rtype: dict
+        '''
+
+        summary = {'steps': self.num_steps}
+        for name, values in self.get_trace().items():
+            if name == 'time':
+                continue
+            values = values[~np.isnan(values)]
+            if len(values) == 0:
+                summary[name] = None
+                continue
+            summary[name] = {
+                'mean': float(np.mean(values)),
+                'p95': float(np.percentile(values, 95)),
+                'max': float(np.max(values)),
+                }
+
+        return summary
+
+    def export(self, path):
+        '''
+        Store the per-step trace in <path>.npz and the summary in
+        <path>.json.
+        '''
+
+        np.savez(path + '.npz', **self.get_trace())
+        with open(path + '.json', 'w') as f:
+            json.dump(self.summary(), f, indent=2)
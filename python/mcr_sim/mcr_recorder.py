@@ -0,0 +1,195 @@
+import atexit
+import glob
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import Sofa
+import numpy as np
+
+
+def load_recording(path):
+    '''
+    Load the chunks written by a Recorder and concatenate them.
+
+    :param path: The directory of the recording
+    :type path: str
+    :return: The columns of the recording, see Recorder
+    :rtype: dict
+    '''
+
+    columns = {}
+    for chunk_path in sorted(glob.glob(os.path.join(path, 'chunk_*.npz'))):
+        with np.load(chunk_path) as chunk:
+            for name in chunk.files:
+                columns.setdefault(name, []).append(chunk[name])
+
+    return {
+        name: np.concatenate(values) for name, values in columns.items()}
+
+
+class Recorder(Sofa.Core.Controller):
+    '''
+    A class that records the simulation at every step in a preallocated ring
+    buffer and writes it in compressed chunks from a background thread.
+
+    The recording is a directory of chunk_<index>.npz files with one array
+    per column:
+
+    * time: the simulation time (s)
+    * tip_pose: the pose of the instrument tip [x, y, z, qx, qy, qz, qw]
+    * field_des: the desired field (T)
+    * field: the field at the last magnet (T)
+    * currents: the coil currents (A)
+    * shape: the poses of all instrument nodes, stored in float32 (optional)
+
+    The buffer holds num_chunks chunks of chunk_size steps, so the memory
+    does not grow with the length of the session. A chunk is written while
+    the next ones are filled, and is only overwritten once it is written.
+
+    :param root_node: The sofa root node
+    :param instrument: The object defining the instrument
+    :param mag_controller: The magnetic controller
+    :param path: The directory of the recording
+    :type path: str
+    :param chunk_size: The number of steps per chunk
+    :type chunk_size: int
+    :param num_chunks: The number of chunks of the ring buffer
+    :type num_chunks: int
+    :param record_shape: A flag that records the poses of all nodes
+    :type record_shape: bool
+    :param every: The number of simulation steps between samples
+    :type every: int
+    :param `*args`: The variable arguments are passed to the SofaCoreController
+    :param `**kwargs`: The keyword arguments arguments are passed to the SofaCoreController
+    '''
+
+    def __init__(
+            self,
+            root_node,
+            instrument,
+            mag_controller,
+            path,
+            chunk_size=1000,
+            num_chunks=4,
+            record_shape=True,
+            every=1,
+            *args, **kwargs):
+
+        # These are needed (and the normal way to override from a python class)
+        Sofa.Core.Controller.__init__(self, *args, **kwargs)
+
+        if num_chunks < 2:
+            raise ValueError('The ring buffer needs at least two chunks')
+
+        self.root_node = root_node
+        self.instrument = instrument
+        self.mag_controller = mag_controller
+        self.path = path
+        self.chunk_size = chunk_size
+        self.num_chunks = num_chunks
+        self.record_shape = record_shape
+        self.every = every
+
+        os.makedirs(self.path, exist_ok=True)
+
+        self.buffers = None
+        self.row = 0            # next row of the ring buffer
+        self.chunk_start = 0    # first row of the chunk being filled
+        self.chunk_index = 0    # index of the next chunk file
+        self.step = 0
+        self.pending = [None]*num_chunks
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.closed = False
+
+        atexit.register(self.close)
+
+    def _allocate(self, num_nodes, num_coils):
+        ''' Allocate the ring buffer once the sizes are known. '''
+
+        capacity = self.chunk_size*self.num_chunks
+        self.buffers = {
+            'time': np.empty(capacity),
+            'tip_pose': np.empty((capacity, 7)),
+            'field_des': np.empty((capacity, 3)),
+            'field': np.empty((capacity, 3)),
+            'currents': np.empty((capacity, num_coils)),
+            }
+        if self.record_shape:
+            self.buffers['shape'] = np.empty(
+                (capacity, num_nodes, 7), dtype=np.float32)
+
+    def _write(self, columns, chunk_index):
+        ''' Writer task, stores a chunk atomically. '''
+
+        chunk_path = os.path.join(
+            self.path, 'chunk_{:06d}.npz'.format(chunk_index))
+        with open(chunk_path + '.tmp', 'wb') as f:
+            np.savez_compressed(f, **columns)
+        os.replace(chunk_path + '.tmp', chunk_path)
+
+    def _flush(self):
+        ''' Hand the rows of the current chunk to the writer thread. '''
+
+        if self.row == self.chunk_start:
+            return
+
+        columns = {
+            name: buffer[self.chunk_start:self.row]
+            for name, buffer in self.buffers.items()}
+        slot = self.chunk_start//self.chunk_size
+        self.pending[slot] = self.executor.submit(
+            self._write, columns, self.chunk_index)
+        self.chunk_index += 1
+
+        # move to the next chunk of the ring, wait for its previous write
+        slot = (slot + 1) % self.num_chunks
+        if self.pending[slot] is not None:
+            self.pending[slot].result()
+            self.pending[slot] = None
+        self.row = self.chunk_start = slot*self.chunk_size
+
+    def sample(self):
+        ''' Record the current state. '''
+
+        positions = self.instrument.MO.position.value
+        currents = self.mag_controller.currents
+
+        if self.buffers is None:
+            num_coils = 0 if currents is None else np.shape(currents)[-1]
+            self._allocate(len(positions), num_coils)
+
+        buffers = self.buffers
+        row = self.row
+        buffers['time'][row] = self.root_node.time.value
+        buffers['tip_pose'][row] = positions[-1]
+        buffers['field_des'][row] = self.mag_controller.field_des
+        buffers['field'][row] = self.mag_controller.BG[0:3]
+        if currents is not None:
+            buffers['currents'][row] = currents[-1]
+        else:
+            buffers['currents'][row] = np.nan
+        if self.record_shape:
+            num_nodes = min(len(positions), buffers['shape'].shape[1])
+            buffers['shape'][row, 0:num_nodes] = positions[0:num_nodes]
+            buffers['shape'][row, num_nodes:] = np.nan
+
+        self.row += 1
+        if self.row - self.chunk_start == self.chunk_size:
+            self._flush()
+
+    def onAnimateEndEvent(self, event):
+
+        if self.step % self.every == 0 and not self.closed:
+            self.sample()
+        self.step += 1
+
+    def close(self):
+        ''' Write the remaining rows and wait for the writer thread. '''
+
+        if self.closed:
+            return
+        self.closed = True
+
+        if self.buffers is not None:
+            self._flush()
+        self.executor.shutdown(wait=True)
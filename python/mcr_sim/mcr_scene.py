@@ -0,0 +1,414 @@
+import os
+
+import numpy as np
+from scipy.spatial.transform import Rotation as R
+
+from mcr_sim import \
+    mcr_environment, mcr_instrument, mcr_emns, mcr_simulator, \
+    mcr_controller_sofa, mcr_magnet, mcr_recorder, mcr_profiler, \
+    mcr_collision, mcr_solver, mcr_time_step, mcr_checkpoint, mcr_settle, \
+    mcr_jacobian
+
+# root directory of the repository, the default paths are relative to it
+repo_dir = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+
+def flat_params():
+    '''
+    Return the parameters of the flat model scene of example_flat.py.
+
+    :rtype: dict
+    '''
+
+    return {
+        # eMNS
+        'cal_path': os.path.join(
+            repo_dir, 'calib', 'Navion_2_Calibration_24-02-2020.yaml'),
+        'emns_backend': 'mag_manip',
+        # instrument
+        'young_modulus_body': 170e6,    # (Pa)
+        'young_modulus_tip': 21e6,      # (Pa)
+        'length_body': 0.5,             # (m)
+        'length_tip': 0.034,            # (m)
+        'outer_diam': 0.00133,          # (m)
+        'inner_diam': 0.0008,           # (m)
+        'length_init': 0.35,            # (m)
+        'insertion_speed': 0.05,        # (m/s)
+        # environment
+        'environment_stl': os.path.join(
+            repo_dir, 'mesh', 'flat_models', 'flat_model_circles.stl'),
+        'environment_name': 'environment',
+        'flip_normals': False,
+        'collision_triangles': None,    # decimation of the collision mesh
+        'collision_tolerance': None,    # (m)
+        'collision_primitives': ['triangle', 'line', 'point'],
+        'mesh_cache': True,     # binary mesh already in the simulation frame
+        'centerline': False,    # extract the centerline from the start pose
+        # magnets
+        'magnet_length': 4e-3,          # (m)
+        'magnet_id': 0.86e-3,           # (m)
+        'magnet_od': 1.33e-3,           # (m)
+        'magnet_remanence': 1.45,       # (T)
+        'magnet_index': [0, 1],         # magnetic elements of the tip
+        # beams
+        'nume_nodes_viz': 600,
+        'num_elem_body': 30,
+        'num_elem_tip': 3,
+        # transforms [x, y, z, qx, qy, qz, qw]
+        'T_sim_mns': [0., 0., 0., 0., 0., 0., 1.],
+        'T_env_sim': [0., 0., 0., 0., 0., 0., 1.],
+        'T_start_env': [-0.04, 0.01, 0.002, 0., 0., 0., 1.],
+        'fixed_directions': [0, 0, 1, 0, 0, 0],
+        # simulation
+        'dt': 0.01,                     # (s), initial with adaptive_dt
+        'adaptive_dt': False,   # add a mcr_time_step.AdaptiveTimeStep
+        'dt_min': 0.001,                # (s)
+        'dt_max': 0.02,                 # (s)
+        'friction_coef': 0.04,
+        'solver_profile': 'accurate',   # see mcr_solver.SOLVER_PROFILES
+        'lcp_tolerance': None,          # the one of the profile if None
+        'lcp_max_iterations': None,     # the one of the profile if None
+        'collision_profile': 'brute_force',     # see mcr_collision
+        'proximity': 'fixed',   # or 'radius', from the instrument diameter
+        'collision_culling': False,     # skip instruments far from walls
+        'collision_groups': 1,  # culled groups of the environment mesh
+        'mag_field_init': [0.01, 0.01, 0.],     # (T)
+        'gradient_force': False,    # (m.grad)B force on the magnets
+        'pipelined': False,     # magnetic model of the next step in a thread
+        'settled_state': None,  # mcr_settle state file, or 'auto' to cache
+        'commands': None,   # see mcr_command_player.load_commands
+        'record_path': None,    # directory of a mcr_recorder recording
+        'profile': False,       # add a mcr_profiler.Profiler
+        'visual': True,
+        }
+
+
+def aortic_arch_params():
+    '''
+    Return the parameters of the aortic arch scene of example_aortic_arch.py.
+
+    :rtype: dict
+    '''
+
+    params = flat_params()
+    params.update({
+        'environment_stl': os.path.join(
+            repo_dir, 'mesh', 'anatomies', 'J2-Naviworks.stl'),
+        'environment_name': 'aortic_arch',
+        'flip_normals': True,
+        'T_env_sim': [0., -0.45, 0., -0.7071068, 0, 0, 0.7071068],
+        'T_start_env': [
+            -.075, -.001, -.020, 0., -0.3826834, 0., 0.9238795],
+        'fixed_directions': [0, 0, 0, 0, 0, 0],
+        })
+
+    return params
+
+
+def start_pose(T_env_sim, T_start_env):
+    '''
+    Express the starting pose of the instrument given in the environment
+    frame in the simulation frame.
+
+    :return: The starting pose in the simulation frame [x, y, z, qx, qy, qz, qw]
+    :rtype: list[float]
+    '''
+
+    r = R.from_quat(T_env_sim[3:7])
+    position = r.apply(T_start_env[0:3]) + T_env_sim[0:3]
+    quat = (r*R.from_quat(T_start_env[3:7])).as_quat()
+
+    return list(position) + list(quat)
+
+
+class Scene():
+    '''
+    A class that holds the objects of a scene built by build_scene.
+
+    :param root_node: The sofa root node
+    :param params: The parameters of the scene
+    :type params: dict
+    '''
+
+    def __init__(
+            self,
+            root_node,
+            params,
+            simulator,
+            e_mns,
+            environment,
+            instrument,
+            controller_sofa,
+            recorder=None,
+            profiler=None,
+            culling=None,
+            solver_monitor=None,
+            time_step=None,
+            contact_listeners=None):
+
+        self.root_node = root_node
+        self.params = params
+        self.simulator = simulator
+        self.e_mns = e_mns
+        self.environment = environment
+        self.instrument = instrument
+        self.controller_sofa = controller_sofa
+        self.mag_controller = controller_sofa.mag_controller
+        self.recorder = recorder
+        self.profiler = profiler
+        self.culling = culling
+        self.solver_monitor = solver_monitor
+        self.time_step = time_step
+        self.contact_listeners = contact_listeners or []
+
+    def insertion_length(self):
+        ''' Return the inserted length of the instrument (m). '''
+
+        return float(self.instrument.IRC.xtip.value[0])
+
+    def set_insertion_length(self, length):
+        ''' Set the inserted length of the instrument (m). '''
+
+        self.instrument.IRC.xtip.value = [length]
+        self.instrument.insertion_len = self.instrument.IRC.xtip.value
+
+    def insert(self, dt):
+        '''
+        Advance the insertion towards length_init at insertion_speed for a
+        time step dt.
+
+        :return: True once length_init is reached
+        :rtype: bool
+        '''
+
+        length = self.insertion_length()
+        target = self.params['length_init']
+        if length >= target:
+            return True
+
+        self.set_insertion_length(
+            min(target, length + self.params['insertion_speed']*dt))
+
+        return False
+
+    def checkpoint(self):
+        '''
+        Capture the state of the scene, see mcr_checkpoint.Checkpoint.
+
+        :rtype: mcr_checkpoint.Checkpoint
+        '''
+
+        return mcr_checkpoint.Checkpoint.capture(self)
+
+    def restore(self, checkpoint):
+        ''' Restore a state captured by checkpoint. '''
+
+        checkpoint.restore(self)
+
+    def jacobian(self, **kwargs):
+        '''
+        Estimate the Jacobian of the tip pose with respect to the desired
+        field and the inserted length with serial rollouts, see
+        mcr_jacobian.jacobian for the keyword arguments.
+
+        :rtype: dict
+        '''
+
+        return mcr_jacobian.jacobian(self, **kwargs)
+
+    def progress(self):
+        '''
+        Return the arc length along the centerline of the environment of
+        the projection of the instrument tip (m).
+        '''
+
+        return float(self.environment.progress(
+            self.instrument.tip_pose()[0:3]))
+
+
+def build_scene(root_node, **params):
+    '''
+    Build an m-CR scene from the mcr_sim classes. Parameters that are not
+    given are taken from flat_params().
+
+    :param root_node: The sofa root node
+    :return: The objects of the scene
+    :rtype: Scene
+    '''
+
+    p = flat_params()
+    unknown = set(params) - set(p)
+    if unknown:
+        raise ValueError(
+            'Unknown scene parameters: ' + ', '.join(sorted(unknown)))
+    p.update(params)
+
+    # simulator
+    if p['proximity'] == 'radius':
+        contact_distance, alarm_distance = (
+            mcr_collision.proximity_distances(p['outer_diam']))
+    elif p['proximity'] == 'fixed':
+        contact_distance, alarm_distance = 0.002, 0.003
+    else:
+        raise ValueError('Unknown proximity: {}'.format(p['proximity']))
+    simulator = mcr_simulator.Simulator(
+        root_node=root_node,
+        dt=p['dt'],
+        friction_coef=p['friction_coef'],
+        solver_profile=p['solver_profile'],
+        lcp_tolerance=p['lcp_tolerance'],
+        lcp_max_iterations=p['lcp_max_iterations'],
+        collision_profile=p['collision_profile'],
+        contact_distance=contact_distance,
+        alarm_distance=alarm_distance,
+        visual=p['visual'])
+
+    # eMNS
+    e_mns = mcr_emns.EMNS(
+        name='Navion',
+        calibration_path=p['cal_path'],
+        backend=p['emns_backend'])
+
+    # environment
+    environment = mcr_environment.Environment(
+        root_node=root_node,
+        environment_stl=p['environment_stl'],
+        name=p['environment_name'],
+        T_env_sim=p['T_env_sim'],
+        flip_normals=p['flip_normals'],
+        color=[1., 0., 0., 0.3],
+        visual=p['visual'],
+        collision_triangles=p['collision_triangles'],
+        collision_tolerance=p['collision_tolerance'],
+        collision_primitives=p['collision_primitives'],
+        collision_groups=p['collision_groups'],
+        mesh_cache=p['mesh_cache'])
+    if p['centerline']:
+        environment.enable_centerline(
+            start_pose(p['T_env_sim'], p['T_start_env'])[0:3])
+
+    # magnet
+    magnet = mcr_magnet.Magnet(
+        length=p['magnet_length'],
+        outer_diam=p['magnet_od'],
+        inner_diam=p['magnet_id'],
+        remanence=p['magnet_remanence'])
+
+    magnets = [0. for i in range(p['num_elem_tip'])]
+    for i in p['magnet_index']:
+        magnets[i] = magnet
+
+    # settled state after the insertion, computed once per parameters
+    settled_state = p['settled_state']
+    if settled_state == 'auto':
+        settled_state = mcr_settle.settled_state(p)
+
+    # instrument
+    instrument = mcr_instrument.Instrument(
+        name='mcr',
+        root_node=root_node,
+        length_body=p['length_body'],
+        length_tip=p['length_tip'],
+        outer_diam=p['outer_diam'],
+        inner_diam=p['inner_diam'],
+        young_modulus_body=p['young_modulus_body'],
+        young_modulus_tip=p['young_modulus_tip'],
+        magnets=magnets,
+        num_elem_body=p['num_elem_body'],
+        num_elem_tip=p['num_elem_tip'],
+        nume_nodes_viz=p['nume_nodes_viz'],
+        T_start_sim=start_pose(p['T_env_sim'], p['T_start_env']),
+        fixed_directions=p['fixed_directions'],
+        visual=p['visual'],
+        settled_state=settled_state)
+
+    # sofa-based controller
+    controller_sofa = mcr_controller_sofa.ControllerSofa(
+        name='ControllerSofa',
+        root_node=root_node,
+        e_mns=e_mns,
+        instrument=instrument,
+        T_sim_mns=p['T_sim_mns'],
+        mag_field_init=np.array(p['mag_field_init'], dtype=float),
+        gradient_force=p['gradient_force'],
+        pipelined=p['pipelined'],
+        commands=p['commands'])
+    root_node.addObject(controller_sofa)
+
+    # contact listeners between the instrument and the environment, shared
+    # by the controllers that count contacts
+    contact_listeners = []
+    if (p['collision_culling'] or p['adaptive_dt'] or p['profile']
+            or 'max_tolerance' in mcr_solver.SOLVER_PROFILES[
+                p['solver_profile']]):
+        contact_listeners = mcr_collision.add_contact_listeners(
+            root_node, instrument, environment)
+
+    # collision culling
+    culling = None
+    if p['collision_culling']:
+        culling = mcr_collision.CollisionCulling(
+            name='collision_culling',
+            instrument=instrument,
+            environment=environment,
+            alarm_distance=alarm_distance,
+            contact_listeners=contact_listeners)
+        root_node.addObject(culling)
+
+    # iterations and residuals of the constraint solver
+    solver_monitor = mcr_solver.SolverMonitor(
+        name='solver_monitor',
+        simulator=simulator,
+        contact_listeners=contact_listeners)
+    root_node.addObject(solver_monitor)
+
+    # adaptive time step
+    time_step = None
+    if p['adaptive_dt']:
+        time_step = mcr_time_step.AdaptiveTimeStep(
+            name='time_step',
+            root_node=root_node,
+            simulator=simulator,
+            instrument=instrument,
+            contact_listeners=contact_listeners,
+            dt_min=p['dt_min'],
+            dt_max=p['dt_max'])
+        root_node.addObject(time_step)
+
+    # recorder
+    recorder = None
+    if p['record_path'] is not None:
+        recorder = mcr_recorder.Recorder(
+            name='recorder',
+            root_node=root_node,
+            instrument=instrument,
+            mag_controller=controller_sofa.mag_controller,
+            path=p['record_path'])
+        root_node.addObject(recorder)
+
+    # profiler
+    profiler = None
+    if p['profile']:
+        profiler = mcr_profiler.Profiler(
+            name='profiler',
+            root_node=root_node,
+            simulator=simulator,
+            contact_listeners=contact_listeners,
+            mag_controller=controller_sofa.mag_controller)
+        root_node.addObject(profiler)
+
+    return Scene(
+        root_node=root_node,
+        params=p,
+        simulator=simulator,
+        e_mns=e_mns,
+        environment=environment,
+        instrument=instrument,
+        controller_sofa=controller_sofa,
+        recorder=recorder,
+        profiler=profiler,
+        culling=culling,
+        solver_monitor=solver_monitor,
+        time_step=time_step,
+        contact_listeners=contact_listeners)
@@ -0,0 +1,433 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from mcr_sim import mcr_mesh
+
+# version of the distance computation in the keys of the cached fields, so
+# that fields sampled by an older version are rebuilt
+FIELD_VERSION = 3
+
+# features of a triangle that hold the closest point, see
+# closest_points_on_triangles
+FACE, VERTEX_A, VERTEX_B, VERTEX_C, EDGE_AB, EDGE_BC, EDGE_CA = range(7)
+
+
+def closest_points_on_triangles(points, a, b, c, return_features=False):
+    '''
+    Return the closest points on triangles, row by row (Ericson, Real-Time
+    Collision Detection, 5.1.5).
+
+    :param points: The query points, shape (N, 3)
+    :type points: ndarray
+    :param a: The first corners of the triangles, shape (N, 3)
+    :param b: The second corners of the triangles, shape (N, 3)
+    :param c: The third corners of the triangles, shape (N, 3)
+    :param return_features: A flag that also returns the feature of each
+        triangle that holds the closest point, FACE, VERTEX_A to VERTEX_C or
+        EDGE_AB to EDGE_CA
+    :type return_features: bool
+    :return: The closest points, shape (N, 3), and the features, shape (N,)
+    :rtype: ndarray or tuple[ndarray]
+    '''
+
+    def dot(u, v):
+        return np.einsum('ij,ij->i', u, v)
+
+    ab = b - a
+    ac = c - a
+    ap = points - a
+    bp = points - b
+    cp = points - c
+    d1, d2 = dot(ab, ap), dot(ac, ap)
+    d3, d4 = dot(ab, bp), dot(ac, bp)
+    d5, d6 = dot(ab, cp), dot(ac, cp)
+    va = d3*d6 - d5*d4
+    vb = d5*d2 - d1*d6
+    vc = d1*d4 - d3*d2
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # face region
+        denom = va + vb + vc
+        v = np.where(denom != 0., vb/denom, 0.)
+        w = np.where(denom != 0., vc/denom, 0.)
+        closest = a + v[:, None]*ab + w[:, None]*ac
+        features = np.full(len(points), FACE)
+
+        # edge and vertex regions, in reverse order of precedence
+        t = (d4 - d3)/((d4 - d3) + (d5 - d6))
+        mask = (va <= 0.) & (d4 - d3 >= 0.) & (d5 - d6 >= 0.)
+        closest[mask] = (b + t[:, None]*(c - b))[mask]
+        features[mask] = EDGE_BC
+
+        t = d2/(d2 - d6)
+        mask = (vb <= 0.) & (d2 >= 0.) & (d6 <= 0.)
+        closest[mask] = (a + t[:, None]*ac)[mask]
+        features[mask] = EDGE_CA
+
+        mask = (d6 >= 0.) & (d5 <= d6)
+        closest[mask] = c[mask]
+        features[mask] = VERTEX_C
+
+        t = d1/(d1 - d3)
+        mask = (vc <= 0.) & (d1 >= 0.) & (d3 <= 0.)
+        closest[mask] = (a + t[:, None]*ab)[mask]
+        features[mask] = EDGE_AB
+
+        mask = (d3 >= 0.) & (d4 <= d3)
+        closest[mask] = b[mask]
+        features[mask] = VERTEX_B
+
+        mask = (d1 <= 0.) & (d2 <= 0.)
+        closest[mask] = a[mask]
+        features[mask] = VERTEX_A
+
+    if return_features:
+        return closest, features
+
+    return closest
+
+
+def pseudonormals(corners, normals):
+    '''
+    Return the angle-weighted pseudonormals of the features of the
+    triangles of a mesh (Baerentzen and Aanaes, Signed distance computation
+    using the angle weighted pseudonormal, 2005): the normal of the face,
+    the sum of the normals of the faces around a vertex weighted by their
+    angles at the vertex and the sum of the normals of the faces sharing an
+    edge. The side of a point is the sign of the dot product of its offset
+    from the closest point with the pseudonormal of the feature holding it,
+    whichever of the closest triangles is used. The corners are welded by
+    their coordinates.
+
+    :param corners: The corners of the triangles, shape (M, 3, 3)
+    :type corners: ndarray
+    :param normals: The unit normals of the triangles, shape (M, 3)
+    :type normals: ndarray
+    :return: The pseudonormals of the features FACE to EDGE_CA of each
+        triangle, shape (M, 7, 3)
+    :rtype: ndarray
+    '''
+
+    _, faces = mcr_mesh.weld(corners)
+    num_faces = len(faces)
+
+    # angles of the triangles at their corners
+    angles = np.empty((num_faces, 3))
+    for i in range(3):
+        u = corners[:, (i + 1) % 3] - corners[:, i]
+        v = corners[:, (i + 2) % 3] - corners[:, i]
+        angles[:, i] = np.arctan2(
+            np.linalg.norm(np.cross(u, v), axis=1),
+            np.einsum('ij,ij->i', u, v))
+
+    vertex_normals = np.zeros((faces.max() + 1, 3))
+    np.add.at(
+        vertex_normals, faces.reshape(-1),
+        (angles[:, :, None]*normals[:, None]).reshape(-1, 3))
+
+    # edges ab, bc and ca of each triangle, in any direction
+    edges = np.sort(
+        np.stack((faces, np.roll(faces, -1, axis=1)), axis=2), axis=2)
+    _, edge_index = np.unique(
+        edges.reshape(-1, 2), axis=0, return_inverse=True)
+    edge_index = edge_index.reshape(-1)
+    edge_normals = np.zeros((edge_index.max() + 1, 3))
+    np.add.at(edge_normals, edge_index, np.repeat(normals, 3, axis=0))
+
+    return np.concatenate((
+        normals[:, None],
+        vertex_normals[faces],
+        edge_normals[edge_index].reshape(num_faces, 3, 3)), axis=1)
+
+
+class SignedDistance():
+    '''
+    A class that computes the exact signed distance to a triangle mesh. The
+    distance is positive on the side the triangle normals point to, which is
+    the free space of the environment meshes, and negative behind the
+    walls. The side is given by the pseudonormal of the feature holding the
+    closest point, see pseudonormals.
+
+    The triangles with the nearest centers give an upper bound of the
+    distance of each point. A triangle is at least as far as its center
+    minus the radius of its bounding sphere, so only the triangles whose
+    centers lie within the bound plus their radius, and whose planes are
+    within the bound, are tested. The
+    triangles are grouped by radius, each group has its own tree searched
+    with its largest radius, so that large triangles do not widen the
+    search among small ones.
+
+    :param vertices: The vertices of the mesh, shape (V, 3)
+    :type vertices: ndarray
+    :param faces: The vertex indices of the triangles, shape (M, 3)
+    :type faces: ndarray
+    :param num_candidates: The number of triangles with the nearest centers that give the upper bound
+    :type num_candidates: int
+    '''
+
+    def __init__(self, vertices, faces, num_candidates=16):
+
+        self.corners = np.asarray(vertices, dtype=float)[np.asarray(faces)]
+        normals = np.cross(
+            self.corners[:, 1] - self.corners[:, 0],
+            self.corners[:, 2] - self.corners[:, 0])
+        self.normals = normals/np.linalg.norm(
+            normals, axis=1, keepdims=True).clip(1e-30)
+        self.pseudonormals = pseudonormals(self.corners, self.normals)
+        self.centers = self.corners.mean(axis=1)
+        self.radii = np.max(np.linalg.norm(
+            self.corners - self.centers[:, None], axis=2), axis=1)
+        self.tree = cKDTree(self.centers)
+
+        # groups of triangles whose radii are within a factor 2
+        group = np.floor(np.log2(self.radii/np.min(self.radii).clip(1e-30)))
+        self.groups = []
+        for g in np.unique(group):
+            indices = np.flatnonzero(group == g)
+            self.groups.append((
+                indices, cKDTree(self.centers[indices]),
+                float(np.max(self.radii[indices]))))
+        self.num_candidates = min(num_candidates, len(self.corners))
+
+    def _distances(self, points, candidates):
+        '''
+        Return the offsets from the closest points of candidate triangles
+        to points, their lengths and the features holding the closest
+        points, pair by pair.
+        '''
+
+        corners = self.corners[candidates]
+        closest, features = closest_points_on_triangles(
+            points, corners[:, 0], corners[:, 1], corners[:, 2],
+            return_features=True)
+        offsets = points - closest
+
+        return offsets, np.linalg.norm(offsets, axis=1), features
+
+    def __call__(self, points, chunk_size=20000):
+        '''
+        Return the signed distances of points to the mesh.
+
+        :param points: The points, shape (N, 3)
+        :type points: ndarray
+        :rtype: ndarray
+        '''
+
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        distances = np.empty(len(points))
+
+        for start in range(0, len(points), chunk_size):
+            chunk = points[start:start + chunk_size]
+            n = len(chunk)
+
+            # upper bound from the triangles with the nearest centers
+            _, nearest = self.tree.query(chunk, k=self.num_candidates)
+            nearest = nearest.reshape(n, -1)
+            _, lengths, _ = self._distances(
+                np.repeat(chunk, nearest.shape[1], axis=0),
+                nearest.reshape(-1))
+            bound = np.min(lengths.reshape(n, -1), axis=1) + 1e-9
+
+            # every triangle that may be closer than the bound
+            point_index = []
+            candidates = []
+            for indices, tree, max_radius in self.groups:
+                neighbors = tree.query_ball_point(chunk, bound + max_radius)
+                counts = np.array([len(found) for found in neighbors])
+                if np.sum(counts) == 0:
+                    continue
+                point_index.append(np.repeat(np.arange(n), counts))
+                candidates.append(indices[np.concatenate(
+                    neighbors).astype(int)])
+            point_index = np.concatenate(point_index)
+            candidates = np.concatenate(candidates)
+            # lower bounds of the distances to the triangles, from their
+            # bounding spheres and their planes
+            offsets = chunk[point_index] - self.centers[candidates]
+            keep = (
+                np.maximum(
+                    np.linalg.norm(offsets, axis=1) - self.radii[candidates],
+                    np.abs(np.einsum(
+                        'ij,ij->i', offsets, self.normals[candidates])))
+                <= bound[point_index])
+            point_index = point_index[keep]
+            candidates = candidates[keep]
+
+            offsets, lengths, features = self._distances(
+                chunk[point_index], candidates)
+            nearest = np.full(n, np.inf)
+            np.minimum.at(nearest, point_index, lengths)
+
+            # the side from one closest triangle of each point, the tied
+            # triangles at edges and vertices share their pseudonormal
+            closest = np.flatnonzero(lengths == nearest[point_index])
+            _, first = np.unique(point_index[closest], return_index=True)
+            closest = closest[first]
+            side = np.einsum(
+                'ij,ij->i', offsets[closest],
+                self.pseudonormals[candidates[closest], features[closest]])
+
+            distances[start:start + n] = np.where(
+                side < 0., -nearest, nearest)
+
+        return distances
+
+
+class DistanceField():
+    '''
+    A class that samples the signed distance to a mesh on a regular grid
+    around it and answers queries by trilinear interpolation. The grid is
+    stored as a .npy file keyed by the mesh and the grid parameters, and is
+    memory-mapped when loaded. Points outside the grid are evaluated
+    exactly.
+
+    :param vertices: The vertices of the mesh in the simulation frame, shape (V, 3)
+    :type vertices: ndarray
+    :param faces: The vertex indices of the triangles, shape (M, 3)
+    :type faces: ndarray
+    :param spacing: The distance between grid nodes (m)
+    :type spacing: float
+    :param padding: The margin of the grid around the mesh (m)
+    :type padding: float
+    :param cache_dir: The directory where fields are stored
+    :type cache_dir: str
+    '''
+
+    def __init__(
+            self,
+            vertices,
+            faces,
+            spacing=0.002,
+            padding=0.01,
+            cache_dir=os.path.join('~', '.cache', 'mcr_sim')):
+
+        vertices = np.asarray(vertices, dtype=float)
+        faces = np.asarray(faces)
+
+        self.spacing = float(spacing)
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.signed_distance = SignedDistance(vertices, faces)
+
+        self.origin = vertices.min(axis=0) - padding
+        self.shape = tuple(
+            int(n) + 1 for n in np.ceil(
+                (vertices.max(axis=0) + padding - self.origin)/self.spacing))
+        self.upper = self.origin + self.spacing*(np.array(self.shape) - 1)
+
+        # the distance is 1-Lipschitz, so its interpolation from the corners
+        # of a cell is within the cell diagonal of the exact distance
+        self.error = float(np.sqrt(3.)*self.spacing)
+
+        key = hashlib.sha1(
+            vertices.tobytes() + faces.astype(np.int64).tobytes()
+            + json.dumps(
+                [self.spacing, float(padding), FIELD_VERSION]).encode()
+            ).hexdigest()[:16]
+        self.path = os.path.join(self.cache_dir, 'sdf_' + key + '.npy')
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            axes = [
+                self.origin[i] + self.spacing*np.arange(self.shape[i])
+                for i in range(3)]
+            nodes = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1)
+            values = self.signed_distance(nodes.reshape(-1, 3))
+
+            # write to a temporary file first so that concurrent workers
+            # never load a partially written field
+            tmp_path = self.path + '.' + str(os.getpid()) + '.tmp.npy'
+            np.save(tmp_path, values.reshape(self.shape).astype(np.float32))
+            os.replace(tmp_path, self.path)
+
+        self.values = np.load(self.path, mmap_mode='r')
+        self.flat = np.asarray(self.values).reshape(-1)
+        self.strides = np.array(
+            [self.shape[1]*self.shape[2], self.shape[2], 1])
+        self.corners = np.array(
+            [[dx, dy, dz] for dx in (0, 1) for dy in (0, 1) for dz in (0, 1)])
+        self.corner_offsets = self.corners @ self.strides
+
+    def contains(self, points):
+        ''' Return a mask of the points lying inside the grid. '''
+
+        points = np.atleast_2d(points)
+
+        return np.all(
+            (points >= self.origin) & (points <= self.upper), axis=1)
+
+    def interpolate(self, points):
+        '''
+        Interpolate the signed distance at points inside the grid.
+
+        :param points: The points in the simulation frame, shape (N, 3)
+        :type points: ndarray
+        :return: The signed distances (m)
+        :rtype: ndarray
+        '''
+
+        u = (np.atleast_2d(points) - self.origin)/self.spacing
+        i0 = np.clip(np.floor(u).astype(int), 0, np.array(self.shape) - 2)
+        t = u - i0
+
+        # gather the 8 corners of the cells from the flat array
+        base = i0 @ self.strides
+        values = self.flat[base[:, None] + self.corner_offsets]
+
+        # weights of the lower and upper nodes along each axis
+        w = np.stack((1. - t, t), axis=-1)
+        weights = (
+            w[:, 0, self.corners[:, 0]]
+            * w[:, 1, self.corners[:, 1]]
+            * w[:, 2, self.corners[:, 2]])
+
+        return np.einsum('ij,ij->i', weights, values)
+
+    def distance(self, points):
+        '''
+        Return the signed distances of points to the mesh, positive in the
+        free space.
+
+        :param points: The points in the simulation frame, shape (N, 3)
+        :type points: ndarray
+        :return: The signed distances (m)
+        :rtype: ndarray
+        '''
+
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        inside = self.contains(points)
+
+        if np.all(inside):
+            return self.interpolate(points)
+
+        distances = np.empty(len(points))
+        distances[inside] = self.interpolate(points[inside])
+        distances[~inside] = self.signed_distance(points[~inside])
+
+        return distances
+
+    def gradient(self, points, step=None):
+        '''
+        Return the gradient of the signed distance at points by central
+        differences, which points away from the nearest wall.
+
+        :param points: The points in the simulation frame, shape (N, 3)
+        :type points: ndarray
+        :rtype: ndarray
+        '''
+
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        step = 0.5*self.spacing if step is None else step
+
+        gradient = np.empty_like(points)
+        for i in range(3):
+            offset = np.zeros(3)
+            offset[i] = step
+            gradient[:, i] = (
+                self.distance(points + offset)
+                - self.distance(points - offset))/(2.*step)
+
+        return gradient
@@ -0,0 +1,201 @@
+import hashlib
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+# parameters of mcr_scene.build_scene that do not change the settled state
+# of the instrument
+OUTPUT_PARAMS = (
+    'visual', 'record_path', 'profile', 'commands', 'centerline',
+    'mesh_cache', 'settled_state')
+
+
+def _to_list(value):
+    ''' Make numpy values of the scene parameters JSON serializable. '''
+
+    return np.asarray(value).tolist()
+
+
+def save_state(path, positions, xtip, rest_positions=None, meta=None):
+    '''
+    Store a settled state of an instrument in a .npz file.
+
+    :param path: The path to the file
+    :type path: str
+    :param positions: The poses of the nodes [x, y, z, qx, qy, qz, qw], shape (N, 7)
+    :type positions: ndarray
+    :param xtip: The inserted length (m)
+    :type xtip: float
+    :param rest_positions: The rest poses of the nodes, shape (N, 7)
+    :type rest_positions: ndarray
+    :param meta: The parameters the state was computed with
+    :type meta: dict
+    '''
+
+    arrays = {
+        'positions': np.asarray(positions, dtype=float),
+        'xtip': np.array(float(xtip)),
+        'meta': np.array(json.dumps(meta or {}, default=_to_list)),
+        }
+    if rest_positions is not None:
+        arrays['rest_positions'] = np.asarray(rest_positions, dtype=float)
+
+    # write to a temporary file first so that concurrent workers never load
+    # a partially written state
+    tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_state(path):
+    '''
+    Load a settled state stored by save_state.
+
+    :return: The node poses, the inserted length, the rest poses (None if
+        not stored) and the parameters
+    :rtype: dict
+    '''
+
+    with np.load(path) as arrays:
+        return {
+            'positions': arrays['positions'],
+            'xtip': float(arrays['xtip']),
+            'rest_positions': (
+                arrays['rest_positions'] if 'rest_positions' in arrays.files
+                else None),
+            'meta': json.loads(str(arrays['meta'])),
+            }
+
+
+def state_key(params, settle_steps, speed_tolerance):
+    '''
+    Return the key of the settled state of a scene, the hash of the
+    parameters that change it.
+
+    :rtype: str
+    '''
+
+    relevant = {
+        key: value for key, value in params.items()
+        if key not in OUTPUT_PARAMS}
+
+    return hashlib.sha1(json.dumps(
+        [relevant, settle_steps, speed_tolerance], sort_keys=True,
+        default=_to_list).encode()).hexdigest()[:16]
+
+
+def compute_state(
+        path, params, settle_steps=200, speed_tolerance=1e-4,
+        builder='mcr_sim.mcr_scene:build_scene'):
+    '''
+    Build a scene, insert the instrument to length_init, let it settle
+    until the nodes are slower than speed_tolerance or for settle_steps
+    steps, and store its state.
+
+    :param path: The path to the state file
+    :type path: str
+    :param params: The parameters of the scene
+    :type params: dict
+    :param settle_steps: The maximal number of steps after the insertion
+    :type settle_steps: int
+    :param speed_tolerance: The node speed under which the instrument is settled (m/s)
+    :type speed_tolerance: float
+    :param builder: The scene builder 'module:function'
+    :type builder: str
+    '''
+
+    import Sofa.Simulation
+    from mcr_sim import mcr_sweep, run
+
+    params = {
+        key: value for key, value in params.items()
+        if key not in OUTPUT_PARAMS}
+
+    root_node = run.create_root()
+    scene = mcr_sweep.load_builder(builder)(
+        root_node, visual=False, **params)
+    run.init(root_node)
+
+    while not scene.insert(root_node.dt.value):
+        Sofa.Simulation.animate(root_node, root_node.dt.value)
+
+    steps = 0
+    while steps < settle_steps:
+        Sofa.Simulation.animate(root_node, root_node.dt.value)
+        steps += 1
+        velocities = np.array(scene.instrument.MO.velocity.value)
+        if np.max(np.linalg.norm(velocities[:, 0:3], axis=1)) \
+                < speed_tolerance:
+            break
+
+    save_state(
+        path,
+        positions=scene.instrument.MO.position.value,
+        xtip=scene.insertion_length(),
+        rest_positions=scene.instrument.MO.rest_position.value,
+        meta={'params': params, 'settle_steps': steps,
+              'time': root_node.time.value})
+
+    scene.mag_controller.shutdown()
+    Sofa.Simulation.unload(root_node)
+
+
+def settled_state(
+        params,
+        settle_steps=200,
+        speed_tolerance=1e-4,
+        builder='mcr_sim.mcr_scene:build_scene',
+        cache_dir=os.path.join('~', '.cache', 'mcr_sim')):
+    '''
+    Return the path to the settled state of a scene after the insertion,
+    computed once in a separate process and cached, keyed by the
+    parameters of the scene.
+
+    :param params: The parameters of the scene, see mcr_scene.flat_params
+    :type params: dict
+    :param settle_steps: The maximal number of steps after the insertion
+    :type settle_steps: int
+    :param speed_tolerance: The node speed under which the instrument is settled (m/s)
+    :type speed_tolerance: float
+    :param builder: The scene builder 'module:function'
+    :type builder: str
+    :param cache_dir: The directory where states are stored
+    :type cache_dir: str
+    :rtype: str
+    '''
+
+    cache_dir = os.path.expanduser(cache_dir)
+    path = os.path.join(cache_dir, 'settled_{:s}.npz'.format(
+        state_key(params, settle_steps, speed_tolerance)))
+
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        run_isolated(compute_state, (
+            path, params, settle_steps, speed_tolerance, builder))
+
+    return path
+
+
+def run_isolated(function, args):
+    '''
+    Run a function in a fresh interpreter and return its result. SOFA is
+    not fork-safe and a second scene in this process would share its
+    plugins and timers. Daemonic processes, such as the workers of
+    mcr_sweep.Sweep, cannot have children, they run the function
+    themselves: they only build one scene after it.
+
+    :param function: The function, importable by the child process
+    :type function: callable
+    :param args: The arguments of the function
+    :type args: tuple
+    '''
+
+    if multiprocessing.current_process().daemon:
+        return function(*args)
+
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        return pool.apply(function, args)
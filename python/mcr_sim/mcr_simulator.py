@@ -1,5 +1,7 @@
 import Sofa
 
+from mcr_sim import mcr_collision, mcr_solver
+
 
 class Simulator(Sofa.Core.Controller):
     '''
@@ -13,6 +15,20 @@ class Simulator(Sofa.Core.Controller):
     :type gravity: float
     :param friction_coef: The coeficient of friction
     :type friction_coef: float
+    :param visual: A flag that adds the visual style and background of the SOFA GUI
+    :type visual: bool
+    :param solver_profile: The settings of the constraint solver, a key of mcr_solver.SOLVER_PROFILES
+    :type solver_profile: str
+    :param lcp_tolerance: The tolerance of the constraint solver, the one of the profile if None
+    :type lcp_tolerance: float
+    :param lcp_max_iterations: The maximal number of iterations of the constraint solver, the one of the profile if None
+    :type lcp_max_iterations: int
+    :param collision_profile: The collision detection of the collision pipeline, a key of mcr_collision.COLLISION_PROFILES
+    :type collision_profile: str
+    :param contact_distance: The distance kept between the collision models in contact (m)
+    :type contact_distance: float
+    :param alarm_distance: The distance under which contacts are detected (m)
+    :type alarm_distance: float
     '''
 
     def __init__(
@@ -21,6 +37,13 @@ class Simulator(Sofa.Core.Controller):
             dt=0.01,
             gravity=[0, 0, 0],
             friction_coef=.04,
+            visual=True,
+            solver_profile='accurate',
+            lcp_tolerance=None,
+            lcp_max_iterations=None,
+            collision_profile='brute_force',
+            contact_distance=0.002,
+            alarm_distance=0.003,
             *args, **kwargs):
 
         # These are needed (and the normal way to override from a python class)
@@ -30,6 +53,26 @@ class Simulator(Sofa.Core.Controller):
         self.dt = dt
         self.gravity = gravity
         self.friction_coef = friction_coef
+        self.visual = visual
+
+        if collision_profile not in mcr_collision.COLLISION_PROFILES:
+            raise ValueError(
+                'Unknown collision profile: {:s}'.format(collision_profile))
+        self.collision_profile = collision_profile
+        profile = mcr_collision.COLLISION_PROFILES[collision_profile]
+        self.contact_distance = contact_distance
+        self.alarm_distance = alarm_distance
+
+        if solver_profile not in mcr_solver.SOLVER_PROFILES:
+            raise ValueError(
+                'Unknown solver profile: {:s}'.format(solver_profile))
+        self.solver_profile = solver_profile
+        solver = mcr_solver.SOLVER_PROFILES[solver_profile]
+        self.tolerance = (
+            solver['tolerance'] if lcp_tolerance is None else lcp_tolerance)
+        self.max_iterations = (
+            solver['max_iterations'] if lcp_max_iterations is None
+            else lcp_max_iterations)
 
         self.root_node.addObject(
             'RequiredPlugin',
@@ -43,45 +86,104 @@ class Simulator(Sofa.Core.Controller):
             'RequiredPlugin',
             name='ImportSofaPython3',
             pluginName='SofaPython3')
+        for plugin in profile['plugins']:
+            self.root_node.addObject(
+                'RequiredPlugin',
+                name='Import' + plugin,
+                pluginName=plugin)
 
         self.root_node.dt = self.dt
         self.root_node.animate = True
         self.root_node.gravity = self.gravity
 
-        self.root_node.addObject(
-            'VisualStyle',
-            displayFlags='showVisualModels hideBehaviorModels \
-                hideCollisionModels hideMappings hideForceFields \
-                    hideInteractionForceFields')
+        if self.visual:
+            self.root_node.addObject(
+                'VisualStyle',
+                displayFlags='showVisualModels hideBehaviorModels \
+                    hideCollisionModels hideMappings hideForceFields \
+                        hideInteractionForceFields')
         self.root_node.addObject(
             'FreeMotionAnimationLoop')
-        self.lcp_solver = self.root_node.addObject(
-            'LCPConstraintSolver',
-            mu=str(friction_coef),
-            tolerance='1e-6',
-            maxIt='10000',
-            build_lcp='false')
+        if solver['solver'] == 'LCPConstraintSolver':
+            self.constraint_solver = self.root_node.addObject(
+                'LCPConstraintSolver',
+                mu=str(friction_coef),
+                tolerance=str(self.tolerance),
+                maxIt=str(self.max_iterations),
+                initial_guess=solver['warm_start'],
+                build_lcp='false')
+            response, response_params = 'FrictionContact', ''
+        else:
+            # the friction is a parameter of the contacts with this solver
+            self.constraint_solver = self.root_node.addObject(
+                'GenericConstraintSolver',
+                tolerance=str(self.tolerance),
+                maxIterations=str(self.max_iterations),
+                unbuilt=True,
+                computeConstraintForces=True)
+            response = 'FrictionContactConstraint'
+            response_params = 'mu=' + str(friction_coef)
         self.root_node.addObject(
             'CollisionPipeline',
             draw='0',
             depth='6',
             verbose='1')
-        self.root_node.addObject(
-            'BruteForceDetection',
-            name='N2')
+        for component, kwargs in profile['components']:
+            self.root_node.addObject(component, **kwargs)
         self.root_node.addObject(
             'LocalMinDistance',
-            contactDistance='0.002',
-            alarmDistance='0.003',
+            contactDistance=str(contact_distance),
+            alarmDistance=str(alarm_distance),
             name='localmindistance',
             angleCone='0.02')
         self.root_node.addObject(
             'CollisionResponse',
             name='Response',
-            response='FrictionContact')
+            response=response,
+            responseParams=response_params)
         self.root_node.addObject(
             'CollisionGroup',
             name='Group')
 
         # set backbround color
-        self.root_node.addObject('BackgroundSetting', color='1 1 1')
+        if self.visual:
+            self.root_node.addObject('BackgroundSetting', color='1 1 1')
+
+    def constraint_iterations(self):
+        '''
+        Return the number of iterations of the last constraint solve, or
+        None if the solver does not report it.
+        '''
+
+        data = self.constraint_solver.getData('currentIterations')
+        if data is not None:
+            return int(data.value)
+
+        # the LCPConstraintSolver reports the residual of each iteration
+        data = self.constraint_solver.getData('graph')
+        try:
+            return len(data.value['Error'])
+        except (AttributeError, KeyError, TypeError):
+            return None
+
+    def constraint_residual(self):
+        '''
+        Return the residual reached by the last constraint solve, or None if
+        the solver does not report it.
+        '''
+
+        data = self.constraint_solver.getData('currentError')
+        if data is not None:
+            return float(data.value)
+
+        data = self.constraint_solver.getData('graph')
+        try:
+            return float(data.value['Error'][-1])
+        except (AttributeError, KeyError, TypeError, IndexError):
+            return None
+
+    def set_tolerance(self, tolerance):
+        ''' Set the tolerance of the constraint solver for the next steps. '''
+
+        self.constraint_solver.tolerance.value = tolerance
+        self.tolerance = tolerance
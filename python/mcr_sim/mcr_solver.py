@@ -0,0 +1,155 @@
+import Sofa
+import numpy as np
+
+# settings of the constraint solver of each profile. 'accurate' is the solver
+# of the original scenes. The LCPConstraintSolver starts from the contact
+# forces of the previous step (initial_guess), the GenericConstraintSolver
+# solves without assembling the compliance matrix (unbuilt). The adaptive
+# profile relaxes its tolerance, up to max_tolerance, while the set of
+# contacts does not change.
+SOLVER_PROFILES = {
+    'accurate': {
+        'solver': 'LCPConstraintSolver',
+        'tolerance': 1e-6,
+        'max_iterations': 10000,
+        'warm_start': True},
+    'interactive': {
+        'solver': 'LCPConstraintSolver',
+        'tolerance': 1e-4,
+        'max_iterations': 200,
+        'warm_start': True},
+    'batch': {
+        'solver': 'GenericConstraintSolver',
+        'tolerance': 1e-5,
+        'max_iterations': 1000,
+        'warm_start': False},
+    'adaptive': {
+        'solver': 'LCPConstraintSolver',
+        'tolerance': 1e-6,
+        'max_iterations': 1000,
+        'warm_start': True,
+        'max_tolerance': 1e-4},
+    }
+
+
+class SolverMonitor(Sofa.Core.Controller):
+    '''
+    A class that logs the number of iterations and the residual of the
+    constraint solver at every step. With an adaptive solver profile, it
+    multiplies the tolerance by a factor, up to the max_tolerance of the
+    profile, after each step whose contacts are the same as the previous
+    ones, and resets it when they change.
+
+    :param simulator: The object defining the simulator
+    :param contact_listeners: The contact listeners between the instrument and the environment, needed by the adaptive profile
+    :type contact_listeners: list
+    :param relax_factor: The factor of the tolerance after a step with unchanged contacts
+    :type relax_factor: float
+    :param capacity: The initial number of steps of the log
+    :type capacity: int
+    :param `*args`: The variable arguments are passed to the SofaCoreController
+    :param `**kwargs`: The keyword arguments arguments are passed to the SofaCoreController
+    '''
+
+    def __init__(
+            self,
+            simulator,
+            contact_listeners=None,
+            relax_factor=2.,
+            capacity=10000,
+            *args, **kwargs):
+
+        # These are needed (and the normal way to override from a python class)
+        Sofa.Core.Controller.__init__(self, *args, **kwargs)
+
+        self.simulator = simulator
+        self.relax_factor = relax_factor
+        self.max_tolerance = SOLVER_PROFILES[
+            simulator.solver_profile].get('max_tolerance')
+        self.base_tolerance = simulator.tolerance
+
+        # iterations, residual and tolerance of each step
+        self.log = np.full((capacity, 3), np.nan)
+        self.num_steps = 0
+        self.contacts = None
+
+        self.contact_listeners = contact_listeners or []
+        if self.max_tolerance is not None and not self.contact_listeners:
+            raise ValueError(
+                'The adaptive tolerance needs the contact listeners between '
+                'the instrument and the environment')
+
+    def contact_set(self):
+        ''' Return the pairs of elements in contact in the last step. '''
+
+        contacts = []
+        for listener in self.contact_listeners:
+            elements = np.asarray(listener.getContactElements())
+            contacts.append(frozenset(map(
+                tuple, elements.reshape(len(elements), -1).tolist())))
+
+        return contacts
+
+    def onAnimateEndEvent(self, event):
+
+        if self.num_steps == len(self.log):
+            self.log = np.vstack((self.log, np.full_like(self.log, np.nan)))
+
+        tolerance = self.simulator.tolerance
+        iterations = self.simulator.constraint_iterations()
+        residual = self.simulator.constraint_residual()
+        self.log[self.num_steps] = [
+            np.nan if iterations is None else iterations,
+            np.nan if residual is None else residual,
+            tolerance]
+        self.num_steps += 1
+
+        if self.max_tolerance is None:
+            return
+
+        # the tolerance of the next step
+        contacts = self.contact_set()
+        if contacts == self.contacts:
+            tolerance = min(
+                self.relax_factor*tolerance, self.max_tolerance)
+        else:
+            tolerance = self.base_tolerance
+        self.contacts = contacts
+        self.simulator.set_tolerance(tolerance)
+
+    def get_log(self):
+        '''
+        Return the iterations, residuals and tolerances of the constraint
+        solver at every step.
+
+        :rtype: dict
+        '''
+
+        return {
+            name: self.log[0:self.num_steps, i].copy()
+            for i, name in enumerate(['iterations', 'residual', 'tolerance'])}
+
+    def summary(self):
+        '''
+        Return the mean and maximal iterations, the maximal residual and the
+        number of steps that reached the iteration cap.
+
+        :rtype: dict
+        '''
+
+        log = self.get_log()
+        iterations = log['iterations'][~np.isnan(log['iterations'])]
+        residual = log['residual'][~np.isnan(log['residual'])]
+
+        return {
+            'profile': self.simulator.solver_profile,
+            'steps': self.num_steps,
+            'iterations_mean': (
+                float(np.mean(iterations)) if len(iterations) else None),
+            'iterations_max': (
+                float(np.max(iterations)) if len(iterations) else None),
+            'residual_max': (
+                float(np.max(residual)) if len(residual) else None),
+            'capped_steps': int(np.sum(
+                iterations >= self.simulator.max_iterations)),
+            }
@@ -0,0 +1,425 @@
+import csv
+import hashlib
+import importlib
+import itertools
+import json
+import multiprocessing
+import os
+import time
+import traceback
+
+import numpy as np
+
+
+def parameter_grid(**values):
+    '''
+    Return the cartesian product of parameter values as a list of samples.
+
+    Example: parameter_grid(young_modulus_tip=[21e6, 42e6], length_tip=[0.034])
+
+    :return: The samples
+    :rtype: list[dict]
+    '''
+
+    keys = list(values)
+
+    return [
+        dict(zip(keys, combination))
+        for combination in itertools.product(*values.values())]
+
+
+def _to_list(value):
+    ''' Make numpy values of the samples JSON serializable. '''
+
+    return np.asarray(value).tolist()
+
+
+def run_id(params, steps, builder='mcr_sim.mcr_scene:build_scene'):
+    '''
+    Return an identifier of a run of a sample that does not depend on the
+    key order. The number of steps and the builder are part of it, so that
+    a sweep with other settings does not reuse the results.
+
+    :param params: The sample
+    :type params: dict
+    :param steps: The number of simulation steps
+    :type steps: int
+    :param builder: The scene builder 'module:function'
+    :type builder: str
+    :rtype: str
+    '''
+
+    return hashlib.sha1(json.dumps(
+        [params, steps, builder], sort_keys=True,
+        default=_to_list).encode()).hexdigest()[:16]
+
+
+def available_memory():
+    '''
+    Return the memory available for new processes (bytes), or None if it
+    is unknown.
+    '''
+
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return 1024*int(line.split()[1])
+    except OSError:
+        pass
+
+    return None
+
+
+def process_memory(pid):
+    '''
+    Return the resident memory of a process (bytes), or None if it is
+    unknown.
+    '''
+
+    try:
+        with open('/proc/{:d}/status'.format(pid), 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return 1024*int(line.split()[1])
+    except OSError:
+        pass
+
+    return None
+
+
+def load_builder(builder):
+    '''
+    Import a scene builder given as 'module:function'. The function is
+    called as function(root_node, **params) and returns an
+    mcr_scene.Scene.
+    '''
+
+    module, function = builder.split(':')
+
+    return getattr(importlib.import_module(module), function)
+
+
+def run_sample(params, steps, builder='mcr_sim.mcr_scene:build_scene'):
+    '''
+    Build a scene without visual models, insert the instrument and record
+    the tip pose at every step.
+
+    The sample may contain a 'field_sequence' entry, a list of desired
+    fields (T) applied one per step and held after its end, and a
+    'checkpoint' entry, the path to a mcr_checkpoint file the scene is
+    built from and restored to. The other entries are passed to the
+    builder.
+
+    :param params: The sample
+    :type params: dict
+    :param steps: The number of simulation steps
+    :type steps: int
+    :param builder: The scene builder 'module:function'
+    :type builder: str
+    :return: The time (s), tip pose [x, y, z, qx, qy, qz, qw], inserted length (m) and desired field (T) at every step
+    :rtype: dict
+    '''
+
+    import Sofa.Simulation
+    from mcr_sim import run
+
+    params = dict(params)
+    field_sequence = params.pop('field_sequence', None)
+    checkpoint = params.pop('checkpoint', None)
+
+    root_node = run.create_root()
+    if checkpoint is None:
+        scene = load_builder(builder)(root_node, visual=False, **params)
+        run.init(root_node)
+    else:
+        from mcr_sim import mcr_checkpoint
+        scene = mcr_checkpoint.build_scene(
+            root_node, checkpoint, builder, visual=False, **params)
+
+    result = {
+        'time': np.empty(steps),
+        'tip_pose': np.empty((steps, 7)),
+        'insertion': np.empty(steps),
+        'field_des': np.empty((steps, 3)),
+        }
+
+    for i in range(steps):
+        if field_sequence is not None:
+            scene.mag_controller.field_des = np.array(
+                field_sequence[min(i, len(field_sequence) - 1)], dtype=float)
+        # the time step may change between steps, see mcr_time_step
+        dt = root_node.dt.value
+        scene.insert(dt)
+
+        Sofa.Simulation.animate(root_node, dt)
+
+        result['time'][i] = root_node.time.value
+        result['tip_pose'][i] = scene.instrument.tip_pose()
+        result['insertion'][i] = scene.insertion_length()
+        result['field_des'][i] = scene.mag_controller.field_des
+
+    scene.mag_controller.shutdown()
+    Sofa.Simulation.unload(root_node)
+
+    return result
+
+
+def _worker(params, steps, builder, path):
+    '''
+    Run a sample in a worker process and store the result atomically, a
+    Python error is stored next to it and ends the process with code 1.
+    '''
+
+    start = time.perf_counter()
+    try:
+        result = run_sample(params, steps, builder)
+    except Exception:
+        with open(path + '.failed', 'w') as f:
+            json.dump({'error': traceback.format_exc()}, f, indent=2)
+        raise SystemExit(1)
+    result['wall_time'] = time.perf_counter() - start
+
+    tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **result)
+    os.replace(tmp_path, path)
+
+
+class Sweep():
+    '''
+    A class that runs a list of scene samples in parallel worker processes
+    and collects the tip trajectories in one results table.
+
+    Every sample runs in its own process, so that a crash of SOFA only
+    loses this sample. The result of a sample is stored in
+    output_dir/<run_id>.npz as soon as it finishes, and samples with an
+    existing result are skipped, so an interrupted sweep resumes where it
+    stopped.
+
+    :param samples: The parameters of each run, see mcr_scene.flat_params for the keys
+    :type samples: list[dict]
+    :param output_dir: The directory of the results
+    :type output_dir: str
+    :param steps: The number of simulation steps of each run
+    :type steps: int
+    :param builder: The scene builder 'module:function'
+    :type builder: str
+    :param max_workers: The maximal number of parallel runs, all cores if None
+    :type max_workers: int
+    :param memory_per_worker: The memory needed by one run (bytes), a run is only started if this much memory is available on top of what the running workers have not allocated yet
+    :type memory_per_worker: float
+    :param retries: The number of times a crashed run is restarted
+    :type retries: int
+    :param timeout: The maximal wall time of a run (s), None for no limit
+    :type timeout: float
+    '''
+
+    def __init__(
+            self,
+            samples,
+            output_dir,
+            steps=500,
+            builder='mcr_sim.mcr_scene:build_scene',
+            max_workers=None,
+            memory_per_worker=1e9,
+            retries=1,
+            timeout=None):
+
+        self.samples = [dict(sample) for sample in samples]
+        self.output_dir = output_dir
+        self.steps = steps
+        self.builder = builder
+        self.run_ids = [
+            run_id(sample, steps, builder) for sample in self.samples]
+        self.max_workers = max_workers or os.cpu_count()
+        self.memory_per_worker = memory_per_worker
+        self.retries = retries
+        self.timeout = timeout
+
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        # SOFA is not fork-safe, workers start a fresh interpreter
+        self.context = multiprocessing.get_context('spawn')
+
+    def result_path(self, index):
+        ''' Return the path to the result of a sample. '''
+
+        return os.path.join(self.output_dir, self.run_ids[index] + '.npz')
+
+    def pending(self):
+        ''' Return the indices of the samples without result. '''
+
+        return [
+            i for i in range(len(self.samples))
+            if not os.path.exists(self.result_path(i))]
+
+    def reserved_memory(self, running):
+        '''
+        Return the memory the running workers have not allocated yet
+        (bytes): memory_per_worker minus their resident memory, the whole
+        memory_per_worker if it is unknown.
+        '''
+
+        reserved = 0.
+        for process, start in running.values():
+            memory = process_memory(process.pid)
+            reserved += max(0., self.memory_per_worker - (memory or 0))
+
+        return reserved
+
+    def _can_start(self, running):
+        ''' Check the concurrency and memory limits. '''
+
+        if len(running) >= self.max_workers:
+            return False
+        if not running:
+            return True
+
+        # workers that just started have not allocated their memory yet,
+        # it is reserved so that a burst of starts does not overcommit
+        memory = available_memory()
+
+        return memory is None or (
+            memory - self.reserved_memory(running) >= self.memory_per_worker)
+
+    def _start(self, index):
+
+        path = self.result_path(index)
+        if os.path.exists(path + '.failed'):
+            os.remove(path + '.failed')
+
+        process = self.context.Process(
+            target=_worker,
+            args=(self.samples[index], self.steps, self.builder, path),
+            daemon=True)
+        process.start()
+
+        return process, time.monotonic()
+
+    def _record_failure(self, index, exitcode, attempts):
+        ''' Store the exit code of a run that ended without result. '''
+
+        path = self.result_path(index) + '.failed'
+        record = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                record = json.load(f)
+        record.update({
+            'params': self.samples[index],
+            'exitcode': exitcode,
+            'attempts': attempts})
+
+        with open(path, 'w') as f:
+            json.dump(record, f, indent=2, default=_to_list)
+
+    def run(self, poll_interval=0.1, verbose=True):
+        '''
+        Run the pending samples and write the results table.
+
+        :return: The summary rows, see collect
+        :rtype: list[dict]
+        '''
+
+        queue = self.pending()
+        attempts = {index: 0 for index in queue}
+        running = {}
+        num_done = len(self.samples) - len(queue)
+
+        while queue or running:
+            while queue and self._can_start(running):
+                index = queue.pop(0)
+                attempts[index] += 1
+                running[index] = self._start(index)
+
+            time.sleep(poll_interval)
+
+            for index, (process, start) in list(running.items()):
+                if process.is_alive():
+                    if (self.timeout is not None
+                            and time.monotonic() - start > self.timeout):
+                        process.terminate()
+                        process.join()
+                    else:
+                        continue
+
+                process.join()
+                del running[index]
+
+                if process.exitcode == 0 and os.path.exists(
+                        self.result_path(index)):
+                    num_done += 1
+                    if verbose:
+                        print('[{:d}/{:d}] {:s} done'.format(
+                            num_done, len(self.samples),
+                            self.run_ids[index]))
+                    continue
+
+                self._record_failure(index, process.exitcode, attempts[index])
+                if attempts[index] <= self.retries:
+                    queue.append(index)
+                elif verbose:
+                    print('{:s} failed with exit code {}'.format(
+                        self.run_ids[index], process.exitcode))
+
+        return self.collect()
+
+    def collect(self):
+        '''
+        Gather the stored results in output_dir/results.csv, one summary row
+        per sample, and output_dir/results.npz, the stacked trajectories
+        with NaN for the samples without result.
+
+        :return: The summary rows
+        :rtype: list[dict]
+        '''
+
+        keys = sorted(set().union(*self.samples)) if self.samples else []
+        keys = [key for key in keys if key != 'field_sequence']
+
+        rows = []
+        trajectories = np.full((len(self.samples), self.steps, 7), np.nan)
+        times = np.full((len(self.samples), self.steps), np.nan)
+
+        for i, sample in enumerate(self.samples):
+            row = {'run_id': self.run_ids[i]}
+            row.update({
+                key: json.dumps(sample[key], default=_to_list)
+                if isinstance(sample.get(key), np.ndarray) else sample.get(key)
+                for key in keys})
+
+            path = self.result_path(i)
+            if os.path.exists(path):
+                with np.load(path) as result:
+                    tip_pose = result['tip_pose']
+                    trajectories[i, 0:len(tip_pose)] = tip_pose
+                    times[i, 0:len(tip_pose)] = result['time']
+                    row.update({
+                        'status': 'done',
+                        'wall_time': float(result['wall_time']),
+                        'tip_x': tip_pose[-1, 0],
+                        'tip_y': tip_pose[-1, 1],
+                        'tip_z': tip_pose[-1, 2],
+                        })
+            else:
+                row['status'] = (
+                    'failed' if os.path.exists(path + '.failed')
+                    else 'pending')
+
+            rows.append(row)
+
+        fields = (
+            ['run_id', 'status'] + keys
+            + ['wall_time', 'tip_x', 'tip_y', 'tip_z'])
+        with open(os.path.join(self.output_dir, 'results.csv'), 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(rows)
+
+        np.savez(
+            os.path.join(self.output_dir, 'results.npz'),
+            run_id=np.array(self.run_ids),
+            time=times,
+            tip_pose=trajectories)
+
+        return rows
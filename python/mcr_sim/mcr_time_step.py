@@ -0,0 +1,181 @@
+import warnings
+
+import Sofa
+import numpy as np
+
+from mcr_sim import mcr_collision
+
+
+class AdaptiveTimeStep(Sofa.Core.Controller):
+    '''
+    A class that adapts the time step of the simulation after every step,
+    within [dt_min, dt_max]. The time step shrinks when the number of
+    contacts changes or the constraint solver needs many iterations, and
+    grows when the solver converges in a few iterations. It is also
+    limited so that the tip moves less than max_tip_displacement per step.
+    The time step only grows when both the solver iterations and the
+    contacts are known, it is held otherwise.
+
+    The time step is changed between steps through root_node.dt, the
+    controllers read it from the events of the next step and the recorder
+    stores the simulated time, so they stay in sync. Scripts that advance
+    the simulation must pass root_node.dt.value to every
+    Sofa.Simulation.animate call.
+
+    :param root_node: The sofa root node
+    :param simulator: The object defining the simulator, for the solver iterations
+    :param instrument: The object defining the instrument
+    :param contact_listeners: The contact listeners between the instrument and the environment
+    :type contact_listeners: list
+    :param dt_min: The minimal time step (s)
+    :type dt_min: float
+    :param dt_max: The maximal time step (s)
+    :type dt_max: float
+    :param grow_factor: The factor of the time step after an easy step
+    :type grow_factor: float
+    :param shrink_factor: The factor of the time step after a hard step
+    :type shrink_factor: float
+    :param iterations_low: The number of solver iterations under which the time step grows
+    :type iterations_low: int
+    :param iterations_high: The number of solver iterations over which the time step shrinks
+    :type iterations_high: int
+    :param contact_change: The change of the number of contacts over which the time step shrinks
+    :type contact_change: int
+    :param max_tip_displacement: The maximal displacement of the tip in a step (m)
+    :type max_tip_displacement: float
+    :param capacity: The initial number of steps of the log
+    :type capacity: int
+    :param `*args`: The variable arguments are passed to the SofaCoreController
+    :param `**kwargs`: The keyword arguments arguments are passed to the SofaCoreController
+    '''
+
+    def __init__(
+            self,
+            root_node,
+            simulator,
+            instrument,
+            contact_listeners=None,
+            dt_min=0.001,
+            dt_max=0.02,
+            grow_factor=1.25,
+            shrink_factor=0.5,
+            iterations_low=20,
+            iterations_high=200,
+            contact_change=2,
+            max_tip_displacement=0.001,
+            capacity=10000,
+            *args, **kwargs):
+
+        # These are needed (and the normal way to override from a python class)
+        Sofa.Core.Controller.__init__(self, *args, **kwargs)
+
+        if not 0. < dt_min <= dt_max:
+            raise ValueError(
+                'The time step bounds must be 0 < dt_min <= dt_max')
+
+        self.root_node = root_node
+        self.simulator = simulator
+        self.instrument = instrument
+        self.dt_min = dt_min
+        self.dt_max = dt_max
+        self.grow_factor = grow_factor
+        self.shrink_factor = shrink_factor
+        self.iterations_low = iterations_low
+        self.iterations_high = iterations_high
+        self.contact_change = contact_change
+        self.max_tip_displacement = max_tip_displacement
+
+        self.columns = ['time', 'dt', 'iterations', 'contacts', 'tip_speed']
+        self.log = np.full((capacity, len(self.columns)), np.nan)
+        self.num_steps = 0
+        self.contacts = None
+
+        self.contact_listeners = contact_listeners or []
+
+        # the signals that limit the time step
+        solver = simulator.constraint_solver
+        reports_iterations = (
+            solver.getData('currentIterations') is not None
+            or solver.getData('graph') is not None)
+        if not reports_iterations and not self.contact_listeners:
+            raise ValueError(
+                'The adaptive time step needs the iterations of the '
+                'constraint solver or contact listeners')
+        if not reports_iterations or not self.contact_listeners:
+            warnings.warn(
+                'The {:s} are unknown, the adaptive time step can only '
+                'shrink'.format(
+                    'contacts' if reports_iterations
+                    else 'constraint solver iterations'))
+
+        self.set_dt(np.clip(self.root_node.dt.value, dt_min, dt_max))
+
+    def set_dt(self, dt):
+        ''' Set the time step of the next steps (s). '''
+
+        self.root_node.dt.value = dt
+        self.simulator.dt = dt
+
+    def next_dt(self, dt, iterations, contacts, tip_speed):
+        '''
+        Return the time step of the next step given the last one.
+
+        :param dt: The time step of the last step (s)
+        :type dt: float
+        :param iterations: The number of solver iterations of the last step, None if unknown
+        :type iterations: int
+        :param contacts: The number of contacts of the last step, None if unknown
+        :type contacts: int
+        :param tip_speed: The speed of the tip (m/s)
+        :type tip_speed: float
+        :rtype: float
+        '''
+
+        contacts_changed = (
+            contacts is not None and self.contacts is not None
+            and abs(contacts - self.contacts) > self.contact_change)
+
+        if contacts_changed or (
+                iterations is not None and iterations > self.iterations_high):
+            dt = self.shrink_factor*dt
+        elif (iterations is not None and contacts is not None
+                and iterations < self.iterations_low):
+            dt = self.grow_factor*dt
+
+        if tip_speed > 0.:
+            dt = min(dt, self.max_tip_displacement/tip_speed)
+
+        return float(np.clip(dt, self.dt_min, self.dt_max))
+
+    def onAnimateEndEvent(self, event):
+
+        iterations = self.simulator.constraint_iterations()
+        contacts = (
+            mcr_collision.count_contacts(self.contact_listeners)
+            if self.contact_listeners else None)
+        tip_speed = float(np.linalg.norm(
+            self.instrument.MO.velocity.value[-1][0:3]))
+
+        if self.num_steps == len(self.log):
+            self.log = np.vstack((self.log, np.full_like(self.log, np.nan)))
+        self.log[self.num_steps] = [
+            self.root_node.time.value, event['dt'],
+            np.nan if iterations is None else iterations,
+            np.nan if contacts is None else contacts,
+            tip_speed]
+        self.num_steps += 1
+
+        self.set_dt(self.next_dt(event['dt'], iterations, contacts, tip_speed))
+        self.contacts = contacts
+
+    def get_log(self):
+        '''
+        Return the time, time step, solver iterations, number of contacts
+        and tip speed of every step.
+
+        :rtype: dict
+        '''
+
+        return {
+            name: self.log[0:self.num_steps, i].copy()
+            for i, name in enumerate(self.columns)}
@@ -0,0 +1,121 @@
+import argparse
+import importlib.util
+import os
+import sys
+import time
+
+import Sofa
+import Sofa.Simulation
+import SofaRuntime
+
+# Run an mcr_sim scene headless, without GUI or OpenGL, and report the
+# simulation throughput. Run in terminal from the python directory:
+# python3 -m mcr_sim.run example_flat.py --steps 1000
+
+
+def load_scene(scene_path):
+    '''
+    Import a scene file defining createScene(root_node) as a module.
+
+    :param scene_path: The path to the scene file
+    :type scene_path: str
+    :return: The scene module
+    '''
+
+    name = os.path.splitext(os.path.basename(scene_path))[0]
+    spec = importlib.util.spec_from_file_location(name, scene_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def create_root(name='root'):
+    '''
+    Create a root node with the SOFA components that runSofa loads by
+    default.
+    '''
+
+    SofaRuntime.importPlugin('SofaComponentAll')
+
+    return Sofa.Core.Node(name)
+
+
+def init(root_node):
+    ''' Initialize a built scene. '''
+
+    Sofa.Simulation.init(root_node)
+
+
+def advance(root_node, steps):
+    '''
+    Advance the simulation by a number of steps as fast as possible.
+
+    :param root_node: The sofa root node
+    :param steps: The number of steps
+    :type steps: int
+    :return: The wall time (s) and the simulated time (s)
+    :rtype: tuple[float]
+    '''
+
+    sim_start = root_node.time.value
+    start = time.perf_counter()
+
+    for i in range(steps):
+        Sofa.Simulation.animate(root_node, root_node.dt.value)
+
+    return time.perf_counter() - start, root_node.time.value - sim_start
+
+
+def main(argv=None):
+
+    ap = argparse.ArgumentParser(
+        description='Run an mcr_sim scene headless and report steps/s.')
+    ap.add_argument('scene', help='path to a scene file with createScene')
+    ap.add_argument(
+        '--steps', type=int, default=1000, help='number of timed steps')
+    ap.add_argument(
+        '--warmup', type=int, default=0,
+        help='number of steps run before timing')
+    ap.add_argument(
+        '--no-visual', action='store_true',
+        help='set the visual flag of the scene module to False, which skips '
+        'the visual models of the example scenes')
+    ap.add_argument(
+        '--keep-cwd', action='store_true',
+        help='do not change to the directory of the scene file, which the '
+        'relative paths of the example scenes expect')
+    args = ap.parse_args(argv)
+
+    scene_path = os.path.abspath(args.scene)
+    scene_dir = os.path.dirname(scene_path)
+    if not args.keep_cwd:
+        os.chdir(scene_dir)
+    if scene_dir not in sys.path:
+        sys.path.insert(0, scene_dir)
+
+    scene = load_scene(scene_path)
+    if args.no_visual:
+        scene.visual = False
+
+    root_node = create_root()
+    build_start = time.perf_counter()
+    scene.createScene(root_node)
+    init(root_node)
+    build_time = time.perf_counter() - build_start
+
+    advance(root_node, args.warmup)
+    wall_time, sim_time = advance(root_node, args.steps)
+
+    print('scene:            ' + scene_path)
+    print('build time:       {:.3f} s'.format(build_time))
+    print('steps:            {:d}'.format(args.steps))
+    print('wall time:        {:.3f} s'.format(wall_time))
+    print('steps/s:          {:.1f}'.format(args.steps/wall_time))
+    print('real-time factor: {:.3f}'.format(sim_time/wall_time))
+
+    Sofa.Simulation.unload(root_node)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import argparse
+
+import numpy as np
+import Sofa.Simulation
+
+from mcr_sim import mcr_command_player, mcr_scene, run
+
+# Replay a recorded experiment of data/01_tip_pose headless and report the
+# tip tracking error. Run in terminal from the python directory:
+# python3 replay_tip_pose.py ../data/01_tip_pose/21_rod_sim_tip_topic_9976/tip_pose_9976_2022-02-15-17-31-18.csv
+#
+# The recordings hold the tip pose only, the commands are derived from it
+# with mcr_command_player.commands_from_tip_pose unless a command file is
+# given with --commands.
+
+
+def replay(
+        recording, commands=None, field_magnitude=0.015, dt=0.01,
+        adaptive_dt=False, dt_min=0.001, dt_max=0.02):
+    '''
+    Build the flat model scene starting at the first recorded tip pose,
+    play the commands and record the tip pose at every step, with a fixed
+    time step dt or an adaptive one in [dt_min, dt_max] starting at dt.
+
+    :return: The simulation time (s), the tip poses and the recording
+    :rtype: tuple
+    '''
+
+    time_ref, poses_ref = mcr_command_player.load_tip_pose(recording)
+    if commands is None:
+        commands = mcr_command_player.commands_from_tip_pose(
+            time_ref, poses_ref, field_magnitude=field_magnitude)
+    else:
+        commands = mcr_command_player.load_commands(commands)
+
+    root_node = run.create_root()
+    scene = mcr_scene.build_scene(
+        root_node,
+        T_start_env=list(poses_ref[0]),
+        mag_field_init=list(commands['fields'][0]),
+        commands=commands,
+        dt=dt,
+        adaptive_dt=adaptive_dt,
+        dt_min=dt_min,
+        dt_max=dt_max,
+        visual=False)
+    run.init(root_node)
+
+    end_time = scene.controller_sofa.command_player.end_time
+    time = []
+    poses = []
+    while root_node.time.value < end_time - 1e-9:
+        Sofa.Simulation.animate(root_node, root_node.dt.value)
+        time.append(root_node.time.value)
+        poses.append(scene.instrument.tip_pose())
+    time = np.array(time)
+    poses = np.array(poses)
+
+    scene.mag_controller.shutdown()
+    Sofa.Simulation.unload(root_node)
+
+    return time, poses, (time_ref, poses_ref)
+
+
+if __name__ == '__main__':
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument('recording', help='tip pose topic CSV of data/01_tip_pose')
+    ap.add_argument('--commands', help='command CSV, see load_commands')
+    ap.add_argument('--field-magnitude', type=float, default=0.015)
+    ap.add_argument('--dt', type=float, default=0.01)
+    ap.add_argument('--adaptive-dt', action='store_true',
+                    help='adapt the time step within [--dt-min, --dt-max]')
+    ap.add_argument('--dt-min', type=float, default=0.001)
+    ap.add_argument('--dt-max', type=float, default=0.02)
+    ap.add_argument('--tolerance', type=float, default=None,
+                    help='fail if the RMS tip error exceeds it (m)')
+    ap.add_argument('--save', help='store the simulated tip poses in a .npz')
+    args = ap.parse_args()
+
+    time, poses, (time_ref, poses_ref) = replay(
+        args.recording, args.commands, args.field_magnitude, args.dt,
+        args.adaptive_dt, args.dt_min, args.dt_max)
+
+    rms, max_error = mcr_command_player.tracking_error(
+        time, poses[:, 0:3], time_ref, poses_ref[:, 0:3])
+    print('simulated time:  {:.2f} s'.format(time[-1]))
+    print('steps:           {:d}'.format(len(time)))
+    print('rms tip error:   {:.2f} mm'.format(1e3*rms))
+    print('max tip error:   {:.2f} mm'.format(1e3*max_error))
+
+    if args.save:
+        np.savez(args.save, time=time, tip_pose=poses)
+
+    if args.tolerance is not None and rms > args.tolerance:
+        raise SystemExit(1)
@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+
+from mcr_sim import mcr_centerline, mcr_sdf
+
+RADIUS = 0.01
+LENGTH = 0.1
+
+
+def tube_mesh(num_around=32, num_along=20):
+    '''
+    An open cylinder of axis x from 0 to LENGTH, with the normals pointing
+    into the lumen as in the vessel meshes.
+    '''
+
+    x = np.linspace(0., LENGTH, num_along + 1)
+    angles = np.linspace(0., 2.*np.pi, num_around, endpoint=False)
+    vertices = np.array([
+        [xi, RADIUS*np.cos(angle), RADIUS*np.sin(angle)]
+        for xi in x for angle in angles])
+
+    faces = []
+    for i in range(num_along):
+        for j in range(num_around):
+            a = i*num_around + j
+            b = i*num_around + (j + 1) % num_around
+            faces += [[a, a + num_around, b], [b, a + num_around,
+                                               b + num_around]]
+    faces = np.array(faces)
+
+    # flip the triangles whose normal points away from the axis
+    corners = vertices[faces]
+    normals = np.cross(
+        corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    outward = np.einsum(
+        'ij,ij->i', normals, corners.mean(axis=1)*[0., 1., 1.]) > 0.
+    faces[outward] = faces[outward][:, ::-1]
+
+    return vertices, faces
+
+
+@pytest.fixture(scope='module')
+def centerline(tmp_path_factory):
+
+    cache_dir = str(tmp_path_factory.mktemp('cache'))
+    vertices, faces = tube_mesh()
+    field = mcr_sdf.DistanceField(
+        vertices, faces, spacing=0.002, cache_dir=cache_dir)
+
+    return field, mcr_centerline.Centerline(
+        field, [0.01, 0., 0.], cache_dir=cache_dir)
+
+
+def test_centerline_in_lumen(centerline):
+
+    field, centerline = centerline
+
+    # the points stay in the lumen, and on the axis away from the open
+    # end, where the farthest node of the lumen may be off the axis
+    assert np.all(field.distance(centerline.points) > 0.001)
+    assert np.all(field.signed_distance(centerline.points) > 0.001)
+    middle = centerline.points[:, 0] < LENGTH - 2.*RADIUS
+    assert np.sum(middle) > 0.5*len(middle)
+    np.testing.assert_allclose(
+        centerline.points[middle, 1:3], 0., atol=field.spacing)
+    np.testing.assert_allclose(
+        centerline.radius[middle], RADIUS, atol=field.error)
+
+    # a single branch from the start point to the far end of the tube
+    assert np.all(centerline.branch == 0)
+    assert np.linalg.norm(centerline.points[0] - [0.01, 0., 0.]) \
+        <= field.spacing
+    assert centerline.points[-1, 0] > LENGTH - 0.02
+    assert np.all(np.diff(centerline.points[:, 0]) > 0.)
+
+
+def test_progress_along_axis(centerline):
+
+    field, centerline = centerline
+
+    x = np.linspace(0.015, LENGTH - 0.025, 50)
+    points = np.stack((x, np.full(50, 0.003), np.zeros(50)), axis=1)
+    progress = centerline.progress(points)
+
+    assert np.all(np.diff(progress) > 0.)
+    np.testing.assert_allclose(
+        progress - progress[0], x - x[0], atol=field.spacing)
+
+
+def test_project_nan(centerline):
+
+    field, centerline = centerline
+
+    points = np.array([
+        [[0.03, 0., 0.002], [np.nan, np.nan, np.nan]],
+        [[0.05, 0.001, 0.], [0.07, np.nan, 0.]]])
+    arc_length, distance, radius, branch = centerline.project(points)
+
+    assert arc_length.shape == (2, 2)
+    nan = ~np.all(np.isfinite(points), axis=2)
+    assert np.all(np.isnan(arc_length[nan]))
+    assert np.all(np.isnan(distance[nan]))
+    assert np.all(np.isnan(radius[nan]))
+    assert np.all(branch[nan] == -1)
+
+    # the finite points are projected as without the NaN points
+    expected = centerline.project(points[~nan])
+    for values, reference in zip(
+            (arc_length, distance, radius, branch), expected):
+        np.testing.assert_array_equal(values[~nan], reference)
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from mcr_sim import mcr_checkpoint
+
+
+def test_round_trip(tmp_path):
+
+    rng = np.random.default_rng(0)
+    state = {
+        'time': np.array(1.5),
+        'dt': np.array(0.01),
+        'xtip': np.array([0.35]),
+        'MO_position': rng.normal(size=(34, 7)),
+        'field_des': np.array([0.01, 0.01, 0.]),
+        }
+    checkpoint = mcr_checkpoint.Checkpoint(state, {'dt': 0.01})
+
+    path = str(tmp_path/'checkpoint.npz')
+    checkpoint.save(path)
+    loaded = mcr_checkpoint.Checkpoint.load(path)
+
+    assert loaded.time == 1.5
+    assert loaded.params == {'dt': 0.01}
+    assert set(loaded.state) == set(state)
+    for name, value in state.items():
+        np.testing.assert_array_equal(loaded.state[name], value)
+
+
+def test_restored_continuation():
+
+    pytest.importorskip('Sofa.Simulation')
+    import Sofa.Simulation
+    from mcr_sim import mcr_scene, run
+
+    root_node = run.create_root()
+    scene = mcr_scene.build_scene(
+        root_node, visual=False, emns_backend='numpy', length_init=0.05)
+    run.init(root_node)
+    while not scene.insert(root_node.dt.value):
+        Sofa.Simulation.animate(root_node, root_node.dt.value)
+
+    def continuation(steps=20):
+        for i in range(steps):
+            Sofa.Simulation.animate(root_node, root_node.dt.value)
+        return scene.instrument.tip_pose()
+
+    checkpoint = scene.checkpoint()
+    original = continuation()
+    scene.restore(checkpoint)
+    restored = continuation()
+
+    scene.mag_controller.shutdown()
+    Sofa.Simulation.unload(root_node)
+
+    # the warm start of the constraint solver is not restored, the tips
+    # agree up to the solver tolerance
+    np.testing.assert_allclose(restored[0:3], original[0:3], atol=1e-5)
@@ -0,0 +1,111 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip('Sofa')
+
+from mcr_sim import mcr_collision  # noqa: E402
+
+
+class Listener():
+
+    def __init__(self):
+        self.contacts = 0
+
+    def getNumberOfContacts(self):
+        return self.contacts
+
+
+def models(num):
+    return [SimpleNamespace(active=SimpleNamespace(value=True))
+            for i in range(num)]
+
+
+class Environment():
+
+    def __init__(self, clearance, group_lower=None, group_upper=None):
+        self.clearance = clearance
+        self.distance_field = SimpleNamespace(error=0.0035)
+        self.group_lower = group_lower
+        self.group_upper = group_upper
+        num_groups = 1 if group_lower is None else len(group_lower)
+        self.collision_groups = [models(3) for i in range(num_groups)]
+        self.collision_models = [
+            model for group in self.collision_groups for model in group]
+
+    def distance(self, points):
+        return np.full(len(points), self.clearance)
+
+
+def test_culling_keeps_contacts():
+
+    nodes = np.zeros((10, 7))
+    nodes[:, 2] = np.linspace(0., 0.009, 10)
+    instrument = SimpleNamespace(
+        MO=SimpleNamespace(position=SimpleNamespace(value=nodes.tolist())),
+        collision_models=models(2))
+    environment = Environment(clearance=0.1)
+    listener = Listener()
+    culling = mcr_collision.CollisionCulling(
+        instrument, environment, alarm_distance=0.003,
+        contact_listeners=[listener])
+
+    # the nodes do not move after the first step, far from the walls
+    for i in range(2):
+        culling.onAnimateBeginEvent({})
+    assert not culling.active
+
+    # contacts reported by the listeners reactivate the models, whatever
+    # the distance field says
+    rng = np.random.default_rng(0)
+    for i in range(100):
+        listener.contacts = int(rng.integers(0, 3))
+        environment.clearance = rng.uniform(0., 0.1)
+        culling.onAnimateBeginEvent({})
+        if listener.contacts > 0:
+            assert culling.active
+            assert all(
+                model.active.value for model in instrument.collision_models)
+
+    # the margin covers the error of the distance field
+    listener.contacts = 0
+    environment.clearance = 0.003 + 0.0005 + 0.003
+    culling.onAnimateBeginEvent({})
+    assert culling.active
+
+
+def test_culling_groups():
+
+    nodes = np.zeros((10, 7))
+    nodes[:, 0] = np.linspace(0., 0.009, 10)
+    instrument = SimpleNamespace(
+        MO=SimpleNamespace(position=SimpleNamespace(value=nodes.tolist())),
+        collision_models=models(2))
+
+    # the instrument touches the wall of group 0 and is far from group 2
+    lower = np.array([[0., -0.01, -0.01], [0.0105, -0.01, -0.01],
+                      [0.05, -0.01, -0.01]])
+    upper = lower + [0.01, 0.02, 0.02]
+    environment = Environment(
+        clearance=0., group_lower=lower, group_upper=upper)
+    listeners = [Listener() for i in range(2*9)]
+    culling = mcr_collision.CollisionCulling(
+        instrument, environment, alarm_distance=0.003,
+        contact_listeners=listeners)
+
+    for i in range(2):
+        culling.onAnimateBeginEvent({})
+    assert culling.active
+    assert culling.group_active == [True, True, False]
+    assert not any(
+        model.active.value for model in environment.collision_groups[2])
+
+    # a contact with a model of group 2, e.g. a stale contact of the last
+    # step, keeps the group active, the listener of instrument model 1 and
+    # environment model 7
+    listeners[9 + 7].contacts = 1
+    culling.onAnimateBeginEvent({})
+    assert culling.group_active == [True, True, True]
+    assert all(
+        model.active.value for model in environment.collision_models)
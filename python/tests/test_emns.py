@@ -0,0 +1,63 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+
+pytest.importorskip('mag_manip.mag_manip')
+
+from mcr_sim import mcr_emns  # noqa: E402
+
+cal_path = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)))),
+    'calib', 'Navion_2_Calibration_24-02-2020.yaml')
+
+
+def test_worker_allocator():
+
+    e_mns = mcr_emns.EMNS(
+        calibration_path=cal_path, backend='numpy', max_current=8.,
+        bucket_size=0.002)
+    worker = e_mns.create_allocator()
+
+    assert worker is not e_mns.allocator
+    assert worker.max_current == e_mns.allocator.max_current
+    assert worker.bucket_size == e_mns.allocator.bucket_size
+
+    rng = np.random.default_rng(0)
+    positions = [rng.uniform(-0.03, 0.03, size=(4, 3)) for i in range(50)]
+    fields = [rng.uniform(-0.03, 0.03, size=3) for i in range(50)]
+
+    # serial reference of each sequence with its own allocator
+    expected = []
+    for allocator in (e_mns.create_allocator(), e_mns.create_allocator()):
+        expected.append([
+            e_mns.field_gradient_to_currents_batch(
+                field, position, allocator=allocator)[1]
+            for field, position in zip(fields, positions)])
+
+    # the main thread and the worker allocate concurrently, as in the
+    # pipelined MagController
+    results = {}
+
+    def run(name, allocator, order):
+        results[name] = [
+            e_mns.field_gradient_to_currents_batch(
+                fields[i], positions[i], allocator=allocator)[1]
+            for i in order]
+
+    thread = threading.Thread(
+        target=run, args=('worker', worker, range(50)))
+    thread.start()
+    run('main', None, range(50))
+    thread.join()
+
+    for name, reference in zip(('main', 'worker'), expected):
+        for currents, expected_currents in zip(results[name], reference):
+            np.testing.assert_allclose(currents, expected_currents)
+
+    # the worker cache is cleared with the one of the main allocator
+    assert len(worker.cache) > 0
+    e_mns.disable_grid_cache()
+    assert len(worker.cache) == 0 and worker.warm_start is None
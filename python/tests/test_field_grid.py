@@ -0,0 +1,36 @@
+import os
+
+import numpy as np
+
+from mcr_sim import mcr_field_grid, mcr_mpem
+
+cal_path = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)))),
+    'calib', 'Navion_2_Calibration_24-02-2020.yaml')
+
+
+def test_cubic_boundary_accuracy(tmp_path):
+
+    model = mcr_mpem.ForwardModelMPEM()
+    model.setCalibrationFile(cal_path)
+
+    errors = {}
+    for order in (1, 3):
+        grid = mcr_field_grid.ActuationGrid(
+            model.get_actuation_matrices, cal_path, half_extent=0.05,
+            spacing=0.005, order=order, cache_dir=str(tmp_path))
+        errors[order] = grid.error_bound
+
+    # the padding keeps the cubic splines as accurate in the boundary cells
+    # as inside, and far more accurate than trilinear interpolation
+    cubic = errors[3]
+    assert cubic['boundary']['field_abs'] \
+        < 5.*cubic['interior']['field_abs']
+    assert cubic['boundary']['gradient_abs'] \
+        < 5.*cubic['interior']['gradient_abs']
+    assert cubic['boundary']['field_abs'] \
+        < 0.1*errors[1]['boundary']['field_abs']
+    assert np.isclose(
+        cubic['field_abs'],
+        max(cubic['interior']['field_abs'], cubic['boundary']['field_abs']))
@@ -0,0 +1,80 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from scipy.spatial.transform import Rotation as R
+
+from mcr_sim import mcr_jacobian
+
+
+@pytest.mark.parametrize('central', [True, False])
+def test_assemble(central):
+
+    rng = np.random.default_rng(0)
+    expected = rng.normal(size=(6, 4))
+
+    def tip_pose(inputs):
+        change = expected @ inputs
+        rotation = R.from_rotvec(change[3:])*R.from_quat([0., 0., 0.38, 0.92])
+        return np.concatenate(([0.1, 0.2, 0.3] + change[0:3],
+                               rotation.as_quat()))
+
+    perturbation = mcr_jacobian.perturbations(1e-6, 1e-6, central)
+    poses = np.array([tip_pose(p) for p in perturbation])
+
+    np.testing.assert_allclose(
+        mcr_jacobian.assemble(poses, perturbation, central), expected,
+        atol=1e-6)
+
+
+def test_conditioning():
+
+    singular_values, condition = mcr_jacobian.conditioning(
+        np.diag([2., 1., 0.5, 0.25]), input_scale=[1., 1., 1., 2.])
+    np.testing.assert_allclose(singular_values, [2., 1., 0.5, 0.5])
+    assert condition == pytest.approx(4.)
+
+    assert mcr_jacobian.conditioning(np.zeros((6, 4)))[1] == np.inf
+
+
+def controller():
+
+    return SimpleNamespace(listening=SimpleNamespace(value=True))
+
+
+class Culling():
+
+    def __init__(self, models):
+        self.active = False
+        self.models = models
+
+    def apply(self):
+        for model in self.models:
+            model.active.value = self.active
+
+
+def test_suspended():
+
+    models = [SimpleNamespace(active=SimpleNamespace(value=False))]
+    scene = SimpleNamespace(
+        controller_sofa=SimpleNamespace(command_player=controller()),
+        recorder=controller(),
+        profiler=None,
+        solver_monitor=SimpleNamespace(num_steps=10, contacts=None),
+        time_step=None,
+        culling=Culling(models),
+        instrument=SimpleNamespace(collision_models=models))
+
+    with mcr_jacobian.suspended(scene):
+        assert not scene.controller_sofa.command_player.listening.value
+        assert not scene.recorder.listening.value
+        scene.solver_monitor.num_steps = 90
+        scene.solver_monitor.contacts = [frozenset()]
+        scene.culling.active = True
+        models[0].active.value = True
+
+    assert scene.controller_sofa.command_player.listening.value
+    assert scene.recorder.listening.value
+    assert scene.solver_monitor.num_steps == 10
+    assert scene.solver_monitor.contacts is None
+    assert not scene.culling.active and not models[0].active.value
@@ -0,0 +1,70 @@
+import itertools
+
+import numpy as np
+
+from mcr_sim import mcr_mesh
+
+
+def grid_mesh(num=20):
+    ''' A triangulated unit square in the plane z = 0. '''
+
+    x, y = np.meshgrid(np.linspace(0., 1., num), np.linspace(0., 1., num))
+    vertices = np.stack((x.ravel(), y.ravel(), np.zeros(num*num)), axis=1)
+    faces = []
+    for i, j in itertools.product(range(num - 1), range(num - 1)):
+        k = i*num + j
+        faces += [[k, k + 1, k + num], [k + 1, k + num + 1, k + num]]
+
+    return vertices, np.array(faces)
+
+
+def test_partition():
+
+    vertices, faces = grid_mesh()
+    for num_groups in (1, 3, 8):
+        groups, lower, upper = mcr_mesh.partition(
+            vertices, faces, num_groups)
+        assert len(groups) == num_groups
+
+        # every triangle is in one group, with the same corners
+        triangles = np.concatenate([
+            group_vertices[group_faces]
+            for group_vertices, group_faces in groups])
+        assert len(triangles) == len(faces)
+        key = np.sort(np.round(triangles.reshape(len(triangles), -1), 9),
+                      axis=0)
+        expected = np.sort(np.round(
+            vertices[faces].reshape(len(faces), -1), 9), axis=0)
+        np.testing.assert_array_equal(key, expected)
+
+        sizes = [len(group_faces) for group_vertices, group_faces in groups]
+        assert max(sizes) - min(sizes) <= num_groups
+
+        for (group_vertices, group_faces), low, up in zip(
+                groups, lower, upper):
+            assert np.all(group_vertices >= low) and np.all(
+                group_vertices <= up)
+
+
+def test_box_distances():
+
+    lower = np.array([[0., 0., 0.], [2., 0., 0.]])
+    upper = np.array([[1., 1., 1.], [3., 1., 1.]])
+    points = np.array([[0.5, 0.5, 0.5], [1.5, 2., 0.5]])
+
+    np.testing.assert_allclose(
+        mcr_mesh.box_distances(points, lower, upper), [0., np.hypot(0.5, 1.)])
+    np.testing.assert_allclose(
+        mcr_mesh.box_distances(points[1:], lower, upper),
+        [np.hypot(0.5, 1.), np.hypot(0.5, 1.)])
+
+    # a lower bound of the distances to the triangles of each group
+    vertices, faces = grid_mesh()
+    groups, lower, upper = mcr_mesh.partition(vertices, faces, 4)
+    rng = np.random.default_rng(0)
+    points = rng.uniform(-0.5, 1.5, size=(50, 3))
+    bounds = mcr_mesh.box_distances(points, lower, upper)
+    for bound, (group_vertices, group_faces) in zip(bounds, groups):
+        distances = np.linalg.norm(
+            points[:, np.newaxis] - group_vertices[np.newaxis], axis=2)
+        assert bound <= np.min(distances) + 1e-12
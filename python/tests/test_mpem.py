@@ -0,0 +1,66 @@
+import os
+
+import numpy as np
+import pytest
+
+from mcr_sim import mcr_mpem
+
+mag_manip = pytest.importorskip('mag_manip.mag_manip')
+
+cal_path = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)))),
+    'calib', 'Navion_2_Calibration_24-02-2020.yaml')
+
+
+@pytest.fixture(scope='module')
+def models():
+
+    reference = mag_manip.ForwardModelMPEM()
+    reference.setCalibrationFile(cal_path)
+    model = mcr_mpem.ForwardModelMPEM()
+    model.setCalibrationFile(cal_path)
+
+    return reference, model
+
+
+@pytest.fixture(scope='module')
+def positions(models):
+    ''' Random points of the calibrated workspace. '''
+
+    reference, model = models
+    rng = np.random.default_rng(0)
+    points = rng.uniform(-0.1, 0.1, size=(2000, 3))
+    points = points[[model.pointInWorkspace(point) for point in points]]
+
+    return points[0:200]
+
+
+def test_actuation_matrix(models, positions):
+
+    reference, model = models
+    assert len(positions) > 0
+    assert model.getNumCoils() == reference.getNumCoils()
+
+    for position in positions:
+        expected = np.asarray(reference.getActuationMatrix(
+            position.reshape(3, 1)))
+        scale = np.max(np.abs(expected))
+        np.testing.assert_allclose(
+            model.getActuationMatrix(position), expected,
+            rtol=0., atol=1e-10*scale)
+        np.testing.assert_allclose(
+            model.getFieldActuationMatrix(position), expected[0:3],
+            rtol=0., atol=1e-10*scale)
+
+
+def test_batched_actuation_matrices(models, positions):
+
+    reference, model = models
+    expected = np.array([
+        reference.getActuationMatrix(position.reshape(3, 1))
+        for position in positions])
+
+    np.testing.assert_allclose(
+        model.get_actuation_matrices(positions), expected,
+        rtol=0., atol=1e-10*np.max(np.abs(expected)))
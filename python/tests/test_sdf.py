@@ -0,0 +1,202 @@
+import os
+
+import numpy as np
+import pytest
+
+from mcr_sim import mcr_centerline, mcr_mesh, mcr_sdf
+
+mesh_dir = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)))), 'mesh')
+
+
+def brute_force(points, corners, pseudonormals):
+    ''' Signed distances of points to all triangles of a mesh. '''
+
+    distances = np.empty(len(points))
+    for i, point in enumerate(points):
+        repeated = np.repeat(point[None], len(corners), axis=0)
+        closest, features = mcr_sdf.closest_points_on_triangles(
+            repeated, corners[:, 0], corners[:, 1], corners[:, 2],
+            return_features=True)
+        offsets = repeated - closest
+        lengths = np.linalg.norm(offsets, axis=1)
+        j = np.argmin(lengths)
+        side = offsets[j] @ pseudonormals[j, features[j]]
+        distances[i] = -lengths[j] if side < 0. else lengths[j]
+
+    return distances
+
+
+def box_mesh(half_size, num=4):
+    '''
+    A closed box centered at the origin, each face split into num x num
+    squares cut along alternating diagonals, with outward normals.
+    '''
+
+    triangles = []
+    grid = np.linspace(-1., 1., num + 1)
+    for axis in range(3):
+        for sign in (-1., 1.):
+            u, v = [i for i in range(3) if i != axis]
+            for i in range(num):
+                for j in range(num):
+                    square = []
+                    for du, dv in ((0, 0), (1, 0), (1, 1), (0, 1)):
+                        corner = np.zeros(3)
+                        corner[axis] = sign
+                        corner[u] = grid[i + du]
+                        corner[v] = grid[j + dv]
+                        square.append(corner*half_size)
+                    if (i + j) % 2:
+                        square = square[1:] + square[:1]
+                    for triangle in (square[0:3], [
+                            square[0], square[2], square[3]]):
+                        triangle = np.array(triangle)
+                        normal = np.cross(
+                            triangle[1] - triangle[0],
+                            triangle[2] - triangle[0])
+                        if normal[axis]*sign < 0.:
+                            triangle = triangle[::-1]
+                        triangles.append(triangle)
+
+    return mcr_mesh.weld(np.array(triangles))
+
+
+def box_distance(points, half_size):
+    ''' Exact signed distance to a box, positive outside. '''
+
+    q = np.abs(points) - half_size
+
+    return (np.linalg.norm(np.maximum(q, 0.), axis=1)
+            + np.minimum(np.max(q, axis=1), 0.))
+
+
+def sphere_mesh(subdivisions=3):
+    ''' A unit icosphere with outward normals. '''
+
+    t = (1. + np.sqrt(5.))/2.
+    vertices = [[-1, t, 0], [1, t, 0], [-1, -t, 0], [1, -t, 0],
+                [0, -1, t], [0, 1, t], [0, -1, -t], [0, 1, -t],
+                [t, 0, -1], [t, 0, 1], [-t, 0, -1], [-t, 0, 1]]
+    faces = [[0, 11, 5], [0, 5, 1], [0, 1, 7], [0, 7, 10], [0, 10, 11],
+             [1, 5, 9], [5, 11, 4], [11, 10, 2], [10, 7, 6], [7, 1, 8],
+             [3, 9, 4], [3, 4, 2], [3, 2, 6], [3, 6, 8], [3, 8, 9],
+             [4, 9, 5], [2, 4, 11], [6, 2, 10], [8, 6, 7], [9, 8, 1]]
+    vertices = np.array(vertices, dtype=float)
+    vertices /= np.linalg.norm(vertices, axis=1, keepdims=True)
+    faces = np.array(faces)
+
+    for i in range(subdivisions):
+        triangles = vertices[faces]
+        middles = [0.5*(triangles[:, i] + triangles[:, (i + 1) % 3])
+                   for i in range(3)]
+        a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+        ab, bc, ca = middles
+        triangles = np.concatenate([
+            np.stack(corners, axis=1) for corners in (
+                (a, ab, ca), (ab, b, bc), (ca, bc, c), (ab, bc, ca))])
+        vertices, faces = mcr_mesh.weld(triangles)
+        vertices /= np.linalg.norm(vertices, axis=1, keepdims=True)
+
+    return vertices, faces
+
+
+@pytest.mark.parametrize('stl', [
+    os.path.join('flat_models', 'flat_model_circles.stl'),
+    os.path.join('anatomies', 'J2-Naviworks.stl')])
+def test_signed_distance_brute_force(stl):
+
+    corners = 0.001*mcr_mesh.read_stl(os.path.join(mesh_dir, stl))
+    signed_distance = mcr_sdf.SignedDistance(*mcr_mesh.weld(corners))
+
+    rng = np.random.default_rng(0)
+    lower = corners.reshape(-1, 3).min(axis=0) - 0.01
+    upper = corners.reshape(-1, 3).max(axis=0) + 0.01
+    points = rng.uniform(lower, upper, size=(2000, 3))
+
+    # points close to the triangles, where the nearest centers are the
+    # least reliable
+    faces = rng.integers(len(corners), size=2000)
+    weights = rng.dirichlet(np.ones(3), size=2000)
+    points = np.vstack((points, np.einsum(
+        'ij,ijk->ik', weights, corners[faces])
+        + rng.normal(scale=0.002, size=(2000, 3))))
+
+    expected = brute_force(points, signed_distance.corners,
+                           signed_distance.pseudonormals)
+
+    np.testing.assert_allclose(
+        signed_distance(points), expected, rtol=0., atol=1e-12)
+
+
+def test_signed_distance_box():
+
+    half_size = np.array([0.02, 0.01, 0.015])
+    signed_distance = mcr_sdf.SignedDistance(*box_mesh(half_size))
+
+    rng = np.random.default_rng(0)
+    points = rng.uniform(-0.04, 0.04, size=(5000, 3))
+
+    # points near the edges and corners, inside and outside, where the sum
+    # of the normals of the closest triangles may give the wrong side
+    corners = half_size*rng.choice([-1., 1.], size=(3000, 3))
+    corners[0:1000, 0] *= rng.uniform(-1., 1., size=1000)
+    points = np.vstack((points, corners + rng.normal(
+        scale=0.002, size=(3000, 3))))
+
+    np.testing.assert_allclose(
+        signed_distance(points), box_distance(points, half_size),
+        rtol=0., atol=1e-12)
+
+
+def test_signed_distance_sphere():
+
+    vertices, faces = sphere_mesh()
+    signed_distance = mcr_sdf.SignedDistance(vertices, faces)
+
+    rng = np.random.default_rng(0)
+    directions = rng.normal(size=(4000, 3))
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    points = directions*rng.uniform(0.5, 1.5, size=(4000, 1))
+
+    # the chords of the icosphere are within its sagitta of the sphere
+    edge = np.max(np.linalg.norm(
+        vertices[faces[:, 0]] - vertices[faces[:, 1]], axis=1))
+    sagitta = 1. - np.sqrt(1. - (edge/np.sqrt(3.))**2)
+    distances = signed_distance(points)
+    np.testing.assert_allclose(
+        distances, np.linalg.norm(points, axis=1) - 1., rtol=0.,
+        atol=sagitta)
+
+
+def test_sign_winding_number():
+
+    # a star-shaped surface with concave and saddle vertices, whose faces
+    # are split at random interior points so that the vertices have uneven
+    # fans of coplanar triangles, its inside is where the winding number
+    # is 1
+    vertices, faces = sphere_mesh(1)
+    rng = np.random.default_rng(0)
+    num_vertices = len(vertices)
+    vertices = vertices*rng.uniform(0.4, 1.6, size=(num_vertices, 1))
+    triangles = list(vertices[faces])
+    for i in range(400):
+        a, b, c = triangles.pop(rng.integers(len(triangles)))
+        p = rng.dirichlet(np.ones(3)) @ np.array([a, b, c])
+        triangles += [np.array(corners) for corners in (
+            (a, b, p), (b, c, p), (c, a, p))]
+    triangles = np.array(triangles)
+    signed_distance = mcr_sdf.SignedDistance(*mcr_mesh.weld(triangles))
+
+    # points around the original vertices, where the sum of the normals of
+    # the closest triangles gives the wrong side for some directions
+    directions = rng.normal(size=(10000, 3))
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    points = vertices[rng.integers(num_vertices, size=10000)] \
+        + 1e-3*directions
+
+    distances = signed_distance(points)
+    inside = mcr_centerline.winding_numbers(points, triangles) > 0.5
+
+    np.testing.assert_array_equal(distances < 0., inside)
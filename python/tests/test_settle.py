@@ -0,0 +1,57 @@
+import multiprocessing
+import os
+
+import numpy as np
+import pytest
+
+from mcr_sim import mcr_settle
+
+
+def _report_pid(queue):
+    ''' Report the process that runs run_isolated's function. '''
+
+    queue.put((os.getpid(), mcr_settle.run_isolated(os.getpid, ())))
+
+
+def test_run_isolated_in_daemon():
+
+    # a daemonic process, like a sweep worker, cannot start a pool and runs
+    # the function itself
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_report_pid, args=(queue,), daemon=True)
+    process.start()
+    pid, function_pid = queue.get(timeout=60)
+    process.join()
+
+    assert process.exitcode == 0
+    assert function_pid == pid
+
+    # other processes run it in a child
+    assert mcr_settle.run_isolated(os.getpid, ()) != os.getpid()
+
+
+def test_state_round_trip(tmp_path):
+
+    path = str(tmp_path/'state.npz')
+    positions = np.random.default_rng(0).normal(size=(34, 7))
+    mcr_settle.save_state(
+        path, positions, 0.35, meta={'params': {'dt': np.float64(0.01)}})
+    state = mcr_settle.load_state(path)
+
+    np.testing.assert_array_equal(state['positions'], positions)
+    assert state['xtip'] == 0.35
+    assert state['rest_positions'] is None
+    assert state['meta'] == {'params': {'dt': 0.01}}
+
+
+def test_sweep_settled_state(tmp_path):
+
+    pytest.importorskip('Sofa.Simulation')
+    from mcr_sim import mcr_sweep
+
+    rows = mcr_sweep.Sweep(
+        [{'settled_state': 'auto', 'emns_backend': 'numpy'}],
+        str(tmp_path), steps=5, max_workers=1, retries=0).run(verbose=False)
+
+    assert rows[0]['status'] == 'done'
@@ -0,0 +1,52 @@
+import numpy as np
+
+from mcr_sim import mcr_sweep
+
+
+def test_run_id():
+
+    sample = {'young_modulus_tip': 21e6, 'length_tip': 0.034}
+    reordered = {'length_tip': 0.034, 'young_modulus_tip': 21e6}
+
+    assert mcr_sweep.run_id(sample, 500) == mcr_sweep.run_id(reordered, 500)
+    assert mcr_sweep.run_id(sample, 500) != mcr_sweep.run_id(sample, 800)
+    assert mcr_sweep.run_id(sample, 500) != mcr_sweep.run_id(
+        sample, 500, 'my_scenes:build_scene')
+
+
+def test_run_id_numpy():
+
+    sample = {
+        'field_sequence': np.zeros((10, 3)),
+        'T_sim_mns': np.array([0., 0., 0., 0., 0., 0., 1.])}
+    listed = {key: value.tolist() for key, value in sample.items()}
+
+    assert mcr_sweep.run_id(sample, 500) == mcr_sweep.run_id(listed, 500)
+
+
+class Worker():
+
+    def __init__(self, pid):
+        self.pid = pid
+
+
+def test_memory_reservation(tmp_path, monkeypatch):
+
+    sweep = mcr_sweep.Sweep(
+        [{}], str(tmp_path), max_workers=8, memory_per_worker=1e9)
+    memory = {'available': 4e9, 1: 0., 2: 0.}
+    monkeypatch.setattr(
+        mcr_sweep, 'available_memory', lambda: memory['available'])
+    monkeypatch.setattr(mcr_sweep, 'process_memory', lambda pid: memory[pid])
+
+    # two workers that have not allocated anything yet reserve their memory
+    running = {0: (Worker(1), 0.), 1: (Worker(2), 0.)}
+    assert sweep.reserved_memory(running) == 2e9
+    assert sweep._can_start(running)
+    memory['available'] = 2.5e9
+    assert not sweep._can_start(running)
+
+    # once they allocated it, it is counted in the available memory
+    memory.update({1: 1e9, 2: 1.2e9})
+    assert sweep.reserved_memory(running) == 0.
+    assert sweep._can_start(running)
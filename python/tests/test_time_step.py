@@ -0,0 +1,46 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('Sofa')
+
+from mcr_sim import mcr_time_step  # noqa: E402
+
+
+class Solver():
+
+    def __init__(self, reports_iterations):
+        self.reports_iterations = reports_iterations
+
+    def getData(self, name):
+        if self.reports_iterations and name == 'currentIterations':
+            return SimpleNamespace(value=10)
+        return None
+
+
+def time_step(reports_iterations=True, contact_listeners=['listener']):
+
+    return mcr_time_step.AdaptiveTimeStep(
+        root_node=SimpleNamespace(dt=SimpleNamespace(value=0.01)),
+        simulator=SimpleNamespace(
+            constraint_solver=Solver(reports_iterations), dt=0.01),
+        instrument=None,
+        contact_listeners=contact_listeners,
+        dt_min=0.001, dt_max=0.02)
+
+
+def test_unknown_signals_hold_dt():
+
+    controller = time_step()
+    assert controller.next_dt(0.01, 5, 0, 0.) == pytest.approx(0.0125)
+    assert controller.next_dt(0.01, None, 0, 0.) == 0.01
+    assert controller.next_dt(0.01, 5, None, 0.) == 0.01
+    assert controller.next_dt(0.01, 500, None, 0.) == 0.005
+
+
+def test_missing_signals():
+
+    with pytest.warns(UserWarning):
+        time_step(contact_listeners=[])
+    with pytest.raises(ValueError):
+        time_step(reports_iterations=False, contact_listeners=[])